@@ -2,31 +2,26 @@ import sys
 import os
 import subprocess
 import tarfile
-import requests
 import json
 from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, QDesktopWidget,
                              QLabel, QLineEdit, QPushButton, QComboBox, QGroupBox, QGridLayout,
                              QListWidget, QMessageBox, QTextEdit, QFileDialog, QCheckBox, QRadioButton,
-                             QMenu,QCompleter)
-from PyQt5.QtCore import Qt, QStringListModel, QProcess
+                             QMenu,QCompleter, QProgressBar)
+from PyQt5.QtCore import Qt, QStringListModel, QProcess, QTimer
+from PyQt5.QtGui import QColor, QTextCharFormat, QTextCursor
 
 
 # 将src目录添加到导入路径
 src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "src")
 sys.path.append(src_dir)
 
-# 现在可以从src导入模块
-try:
-    from src import fragpipe_api
-    from src import systemhc_api
-    from src import sptxt2tsv
-    from src import irt_alignment
-except ImportError:
-    # 如果添加路径后仍然无法导入，尝试直接导入
-    import fragpipe_api
-    import systemhc_api
-    import sptxt2tsv
-    import irt_alignment
+# The pipeline modules (pandas, alignment) are imported where the merge runs,
+# so that opening the GUI does not load them; pipeline (DIA-NN settings and
+# commands shared with the headless runner), diann_runner, log_buffer and scheduler are light
+import diann_runner
+import log_buffer
+import pipeline
+import scheduler
 
 class CommandLineGUI(QWidget):
     def __init__(self):
@@ -36,23 +31,22 @@ class CommandLineGUI(QWidget):
                     'systemhc_library_files': None,  # New list for SysteMHC libraries
                     'extra_params': {}
                 }
-        self.default_params = {
-            'threads': '32',
-            'verbose':'5',
-            'qvalue': '0.1',
-            'matrix-qvalue': '0.01',
-            'matrices':'true',
-            'mass-acc': '15',
-            'mass-acc-ms1': '15',
-            'double-search': 'true',
-            'reanalyse':'true',
-            'no-prot-inf': 'true',
-            'rt-profiling': 'true',
-            'pg-level': '1',
-            'report-lib-info': 'true'
-        }
+        self.default_params = dict(pipeline.DEFAULT_DIANN_PARAMS)
+        # one search at a time here, it may use all cores of the machine
+        self.default_params['threads'] = str(scheduler.available_cores())
         self.allele_list = {}
         self.process = QProcess(self)
+        # the library merge runs in its own process, DIA-NN is started when it succeeds
+        self.merge_process = QProcess(self)
+        self.pending_command = None
+        # output of the running task, shown in batches by log_timer
+        self.log_buffer = None
+        self.stdout_format = QTextCharFormat()
+        self.stderr_format = QTextCharFormat()
+        self.stderr_format.setForeground(QColor('red'))
+        self.log_timer = QTimer(self)
+        self.log_timer.timeout.connect(self.flush_log)
+        self.merged_library = None
         self.main_layout = QVBoxLayout()
         self.extra_params_widget = None
         self.selected_pipeline = "FragPipe"  # Default pipeline
@@ -63,6 +57,9 @@ class CommandLineGUI(QWidget):
         self.process.readyReadStandardOutput.connect(self.handle_output)
         self.process.readyReadStandardError.connect(self.handle_error)
         self.process.finished.connect(self.task_finished)
+        self.merge_process.readyReadStandardOutput.connect(self.handle_merge_output)
+        self.merge_process.readyReadStandardError.connect(self.handle_merge_error)
+        self.merge_process.finished.connect(self.merge_finished)
 
     def load_allele_list(self):
         """Load allele list from JSON file"""
@@ -128,6 +125,8 @@ class CommandLineGUI(QWidget):
         # Output area
         self.output_area = QTextEdit()
         self.output_area.setReadOnly(True)
+        # the oldest lines leave the screen, the full output is in the log file
+        self.output_area.document().setMaximumBlockCount(log_buffer.MAX_LINES)
         self.output_area.setStyleSheet("""
         QTextEdit {
             background-color: #1E1E1E;
@@ -139,7 +138,12 @@ class CommandLineGUI(QWidget):
         }
         """)
 
+        # Stage progress of the library merge and file progress of DIA-NN
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setValue(0)
+
         self.main_layout.addLayout(button_layout)
+        self.main_layout.addWidget(self.progress_bar)
         self.main_layout.addWidget(self.output_area)
         self.setLayout(self.main_layout)
 
@@ -525,25 +529,12 @@ class CommandLineGUI(QWidget):
         # Get selected class
         selected_class = self.allele_class_combo.currentText()  # ClassI or ClassII
         
-        # Construct the URL based on allele name and class
-        file_name = f"HCD_cons_{allele_name}_top12_bynam_ptm.tsv"
-        url = f"https://systemhc.sjtu.edu.cn/data/Systemhc_v2_2023/Data/230623_build/SysteMHC_Library/{selected_class}/Allele-specific/{file_name}"
-        
-        # Destination path for the downloaded file
-        dest_path = os.path.join(output_dir, file_name)
-        
+        file_name = pipeline.allele_library_name(allele_name)
+
         try:
             # Download the file
             self.output_area.append(f"Downloading {file_name}...")
-            response = requests.get(url, stream=True)
-            
-            if response.status_code != 200:
-                raise Exception(f"Download Error, HTTP status code: {response.status_code}")
-            
-            # Save the file
-            with open(dest_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            dest_path = pipeline.download_allele_library(allele_name, selected_class, output_dir)
             
             # Add to SysteMHC library list
             self.parameters['systemhc_library_files'].addItem(dest_path)
@@ -555,12 +546,8 @@ class CommandLineGUI(QWidget):
             QMessageBox.critical(self, "Error", f"Download error: {str(e)}")
             self.output_area.append(f"Error: {str(e)}")
 
-    def merge_libraries(self):
-        """Merge sample and SysteMHC libraries by directly calling the appropriate scripts"""
-        output_dir = self.output_dir_field.text().strip()
-        if not output_dir:
-            raise Exception("Output directory not specified")
-            
+    def start_merge(self, output_dir):
+        """Start merging the sample and SysteMHC libraries in a separate process"""
         # Get library files
         sample_libs = [self.parameters['sample_library_files'].item(i).text() 
                     for i in range(self.parameters['sample_library_files'].count())]
@@ -571,61 +558,15 @@ class CommandLineGUI(QWidget):
             raise Exception("Both sample and SysteMHC libraries must be provided")
         
         # Choose the first sample library
-        sample_library_path = sample_libs[0]
-        
-        # Import the appropriate module based on pipeline selection
-        if self.selected_pipeline == "FragPipe":
-            # 从src导入
-            try:
-                from src import fragpipe_api
-                self.output_area.append(f"Merging libraries using FragPipe pipeline...")
-                merged_library = fragpipe_api.merge_libraries(
-                    sample_library_path=sample_library_path,
-                    systemhc_lib_paths=systemhc_libs,
-                    output_dir=output_dir
-                )
-                return merged_library
-            except ImportError:
-                # 如果无法从src导入，尝试直接导入
-                import fragpipe_api
-                self.output_area.append(f"Merging libraries using FragPipe pipeline...")
-                merged_library = fragpipe_api.merge_libraries(
-                    sample_library_path=sample_library_path,
-                    systemhc_lib_paths=systemhc_libs,
-                    output_dir=output_dir
-                )
-                return merged_library
-        else:
-            # 从src导入
-            try:
-                from src import systemhc_api
-                self.output_area.append(f"Merging libraries using SysteMHC pipeline...")
-                merged_library = systemhc_api.merge_libraries(
-                    sample_library_path=sample_library_path,
-                    systemhc_lib_paths=systemhc_libs,
-                    output_dir=output_dir
-                )
-                return merged_library
-            except ImportError:
-                # 如果无法从src导入，使用importlib
-                import importlib.util
-                spec = importlib.util.spec_from_file_location(
-                    "systemhc_api", 
-                    os.path.join(os.path.dirname(os.path.abspath(__file__)), "src", "systemhc_api.py")
-                )
-                systemhc_api = importlib.util.module_from_spec(spec)
-                spec.loader.exec_module(systemhc_api)
-                
-                self.output_area.append(f"Merging libraries using SysteMHC pipeline...")
-                merged_library = systemhc_api.merge_libraries(
-                    sample_library_path=sample_library_path,
-                    systemhc_lib_paths=systemhc_libs,
-                    output_dir=output_dir
-                )
-                return merged_library
+        command = pipeline.merge_command(self.selected_pipeline, sample_libs[0], systemhc_libs, output_dir)
+        self.log_message(f"Merging libraries using {self.selected_pipeline} pipeline...")
+        self.progress_bar.setRange(0, 1)
+        self.progress_bar.setValue(0)
+        self.progress_bar.setFormat("Merging libraries")
+        self.merge_process.start(command[0], command[1:])
 
     def execute_command(self):
-        if self.process.state() == QProcess.Running:
+        if self.process.state() != QProcess.NotRunning or self.merge_process.state() != QProcess.NotRunning:
             QMessageBox.warning(self, 'Warning', 'A task is already running!')
             return
 
@@ -672,76 +613,141 @@ class CommandLineGUI(QWidget):
                     QMessageBox.critical(self, 'Error', f'Failed to create output directory:\n{str(e)}')
                     return
                     
-            # Copy irt_SYSTEMHC.csv to output directory if it exists
-            source_irt_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "src", "irt_SYSTEMHC.csv")
-            dest_irt_file = os.path.join(output_dir, "irt_SYSTEMHC.csv")
-            
-            try:
-                if os.path.exists(source_irt_file):
-                    import shutil
-                    shutil.copy2(source_irt_file, dest_irt_file)
-                    self.output_area.append(f"Copied irt_SYSTEMHC.csv to output directory")
-                else:
-                    self.output_area.append("Warning: irt_SYSTEMHC.csv not found in application directory")
-            except Exception as e:
-                self.output_area.append(f"Warning: Failed to copy irt_SYSTEMHC.csv: {str(e)}")
-                        
-            # First merge libraries
-            self.output_area.append("Merging Sample and SysteMHC libraries...")
-            merged_library = self.merge_libraries()
-            self.output_area.append(f"Libraries merged successfully: {merged_library}")
-
-            # Build command with merged library
-            script_path = os.path.abspath(os.path.join("src", "rundiann_file.sh"))
-            command = [script_path]
-
-            # Add input path or files
-            if input_type == "Folder":
-                command.extend(["--dir", input_dir])
-            elif input_type == "Files":
-                for file in input_files:
-                    command.extend(["--f", file])
-
-            # Add merged library and output parameters
-            command.extend(["--lib", merged_library])
-            command.extend(["--out", "lib-base-result"])
-            command.extend(["--output-dir", output_dir])
-            
-            # Add DIANN path
-            command.extend(["--diann-path", diann_path])
-
-            # Add ALL additional parameters, including those with default values
-            for param, input_widget in self.extra_param_inputs.items():
-                value = input_widget.text().strip()
-                # Always add the parameter, even if using default value
-                command.append(f"--{param}")
-                command.append(value)
-
-            # Display command
-            display_cmd = ' '.join(command)
-            self.output_area.append(f"[run command] {display_cmd}\n")
-
-            # Start process
-            self.process.start("bash", command)
-            self.output_area.append("▶ Start processing data...\n")
+            # Build the DIA-NN command for the merged library, started once the merge succeeded;
+            # like the merge it is skipped when its results are up to date
+            self.merged_library = os.path.join(output_dir, pipeline.MERGED_LIBRARY[self.selected_pipeline])
+            params = {param: input_widget.text().strip() for param, input_widget in self.extra_param_inputs.items()}
+            self.pending_command = pipeline.diann_command(
+                self.selected_pipeline, output_dir, diann_path,
+                dia_dir=input_dir if input_type == "Folder" else None,
+                dia_files=input_files if input_type == "Files" else (),
+                params=params)
+
+            # First merge libraries (the merge also prepares the indexed SysteMHC iRT reference)
+            self.start_log(output_dir)
+            self.log_message("Merging Sample and SysteMHC libraries...")
+            self.start_merge(output_dir)
             
         except Exception as e:
+            self.pending_command = None
+            self.end_log()
             QMessageBox.critical(self, 'Error', f'Execution failed: {str(e)}')
 
+    def start_diann(self, command):
+        # Display command
+        display_cmd = ' '.join(command)
+        self.log_message(f"[run command] {display_cmd}\n")
+
+        # Start process
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.setFormat("Running DIA-NN")
+        self.process.start(command[0], command[1:])
+        self.log_message("▶ Start processing data...\n")
+
     def stop_task(self):
-        if self.process.state() == QProcess.Running:
+        if self.merge_process.state() != QProcess.NotRunning:
+            # DIA-NN is not started after a cancelled merge
+            self.pending_command = None
+            self.merge_process.kill()
+            self.log_message("\nThe library merge has been manually terminated")
+        elif self.process.state() == QProcess.Running:
+            # the diann command stops the runner, which stops DIA-NN with its process group
+            # and writes the run record; it is killed only if it does not exit in time
+            self.process.terminate()
+            QTimer.singleShot((diann_runner.TERMINATE_GRACE + 5) * 1000, self.kill_diann)
+            self.log_message("\nThe task has been manually terminated")
+
+    def kill_diann(self):
+        if self.process.state() != QProcess.NotRunning:
             self.process.kill()
-            self.output_area.append("\nThe task has been manually terminated")
+
+    def start_log(self, output_dir):
+        """Collect the output of the task started now, logged in full to dia_aspire.log in `output_dir`"""
+        self.end_log()
+        self.log_buffer = log_buffer.LogBuffer(os.path.join(output_dir, pipeline.LOG_FILE))
+        self.log_timer.start(log_buffer.FLUSH_MS)
+
+    def log_message(self, message):
+        """Show a message of the GUI after the output received before it"""
+        if self.log_buffer is None:
+            self.output_area.append(message)
+            return
+        for line in message.split('\n'):
+            self.log_buffer.add(line)
+
+    def flush_log(self):
+        """Show the output lines received since the last update and the latest progress"""
+        if self.log_buffer is None:
+            return
+        lines, dropped = self.log_buffer.take()
+        if dropped:
+            lines.insert(0, (f"... {dropped} lines not shown, see {self.log_buffer.path}", 'stderr'))
+        if lines:
+            # one edit per batch, but one block per line so that the block limit caps the lines shown
+            cursor = QTextCursor(self.output_area.document())
+            cursor.movePosition(QTextCursor.End)
+            cursor.beginEditBlock()
+            new_block = not self.output_area.document().isEmpty()
+            for line, stream in lines:
+                if new_block:
+                    cursor.insertBlock()
+                new_block = True
+                cursor.insertText(line, self.stderr_format if stream == 'stderr' else self.stdout_format)
+            cursor.endEditBlock()
+            scrollbar = self.output_area.verticalScrollBar()
+            scrollbar.setValue(scrollbar.maximum())
+        stage = self.log_buffer.take_progress()
+        if stage is not None:
+            step, total, name = stage
+            self.progress_bar.setRange(0, total)
+            self.progress_bar.setValue(step - 1)
+            self.progress_bar.setFormat(f"{name} ({step}/{total})")
+
+    def end_log(self):
+        """Show the rest of the output and close the log file"""
+        if self.log_buffer is None:
+            return
+        self.log_buffer.end()
+        self.flush_log()
+        self.log_timer.stop()
+        self.log_buffer.close()
+        self.log_buffer = None
+
+    def handle_merge_output(self):
+        self.log_buffer.feed(self.merge_process.readAllStandardOutput().data(), 'stdout')
+
+    def handle_merge_error(self):
+        self.log_buffer.feed(self.merge_process.readAllStandardError().data(), 'stderr')
+
+    def merge_finished(self, exit_code, exit_status):
+        command, self.pending_command = self.pending_command, None
+        if command is None:
+            self.end_log()
+            self.progress_bar.setFormat("Stopped")
+            return
+        if exit_status != QProcess.NormalExit or exit_code != 0:
+            self.end_log()
+            self.progress_bar.setFormat("Library merge failed")
+            QMessageBox.critical(self, 'Error', f'Library merge failed, exit code: {exit_code}')
+            return
+        # the last merge lines are shown before DIA-NN starts
+        self.log_buffer.end()
+        self.flush_log()
+        self.progress_bar.setValue(self.progress_bar.maximum())
+        self.log_message(f"Libraries merged successfully: {self.merged_library}")
+        self.start_diann(command)
 
     def handle_output(self):
-        data = self.process.readAllStandardOutput().data().decode()
-        self.output_area.append(data.strip())
+        self.log_buffer.feed(self.process.readAllStandardOutput().data(), 'stdout')
 
     def handle_error(self):
-        error = self.process.readAllStandardError().data().decode()
-        self.output_area.append(f'<span style="color: red;">{error.strip()}</span>')
+        self.log_buffer.feed(self.process.readAllStandardError().data(), 'stderr')
 
     def task_finished(self, exit_code):
+        self.end_log()
+        self.progress_bar.setRange(0, 1)
+        self.progress_bar.setValue(1 if exit_code == 0 else 0)
+        self.progress_bar.setFormat("Finished" if exit_code == 0 else "Failed")
         if exit_code == 0:
             QMessageBox.information(self, 'Success', 'Mission accomplished!')
         else:
@@ -0,0 +1,150 @@
+# batch_alignment.py - Align many runs onto one reference in worker processes
+
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import pandas as pd
+
+import irt_alignment as irt_align
+
+REFERENCE_COLS = ['modified_peptide', 'precursor_charge', 'q_value']
+
+# set in the parent before the pool starts (inherited by forked workers) or by the worker initializer
+_REFERENCE = None
+_SETTINGS = None
+
+
+def read_table(path):
+    """Read a CSV, or a TSV when the file ends in .tsv/.txt/.tab"""
+    sep = '\t' if os.path.splitext(path)[1].lower() in ('.tsv', '.txt', '.tab') else ','
+    return pd.read_csv(path, sep=sep)
+
+
+def run_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def _init_worker(reference, settings):
+    global _REFERENCE, _SETTINGS
+    _REFERENCE = reference
+    _SETTINGS = settings
+
+
+def _align_run(name, run):
+    s = _SETTINGS
+    t0 = time.perf_counter()
+    summary = {'run': name, 'rows': 0, 'status': 'aligned'}
+    try:
+        if isinstance(run, str):
+            run = read_table(run)
+        summary['rows'] = len(run)
+        model = irt_align.fit_run_alignment(run, _REFERENCE, s['xcol'], s['ycol'], s['lowess_frac'],
+                                            s['psm_fdr_threshold'], s['min_peptides'], name, s['precision'])
+        if model is None:
+            summary['status'] = 'skipped'
+            aligned = None
+        else:
+            aligned = run.copy()
+            aligned[s['ycol']] = model.predict(run[s['xcol']].to_numpy())
+            aligned.insert(0, 'run', name)
+            summary.update({'model': model.kind, 'lowess_frac': model.meta.get('lowess_frac'),
+                            'overlap': model.meta.get('n_overlap')})
+            summary.update({k: v for k, v in model.stats.items() if k != 'n'})
+    except Exception as e:
+        summary['status'] = f'failed: {str(e)}'
+        aligned = None
+    summary['seconds'] = round(time.perf_counter() - t0, 3)
+    return aligned, summary
+
+
+def align_runs(runs, reference, xcol='retention_time', ycol='irt', lowess_frac=0.01, psm_fdr_threshold=0.01,
+               min_peptides=50, precision='exact', workers=None):
+    """
+    Align many runs onto one reference with irt_alignment in parallel
+
+    The reference is reduced to the columns the alignment needs and handed
+    to every worker once, when the worker starts (with the fork start
+    method the workers share the parent's copy), instead of with every run.
+    Runs given as paths are read inside the workers.
+
+    Parameters:
+    -----------
+    runs : list or dict
+        Run tables (paths or DataFrames); a dict maps run names to them
+    reference : str or pandas.DataFrame
+        Reference table with modified_peptide, precursor_charge, `ycol` and optionally q_value
+    xcol : str
+        RT column of the runs
+    ycol : str
+        RT column of the reference, added to the aligned runs
+    lowess_frac : float
+        LOWESS fraction; 0 selects it per run by cross-validation
+    psm_fdr_threshold : float
+        q-value cutoff of the peptides used for fitting
+    min_peptides : int
+        Runs with at most this many overlapping peptides are skipped
+    precision : str
+        ALIGNMENT_PRECISION preset
+    workers : int, optional
+        Number of worker processes; None uses all CPU cores
+
+    Returns:
+    --------
+    tuple
+        (aligned, summary): the aligned runs concatenated with a leading
+        'run' column, and one summary row per run (status, overlap, fit
+        settings and residual statistics, time)
+    """
+    if isinstance(reference, str):
+        reference = read_table(reference)
+    reference = reference[[c for c in REFERENCE_COLS + [ycol] if c in reference.columns]]
+    if not isinstance(runs, dict):
+        runs = {(run_name(r) if isinstance(r, str) else f'run{i + 1}'): r for i, r in enumerate(runs)}
+    settings = {'xcol': xcol, 'ycol': ycol, 'lowess_frac': lowess_frac, 'psm_fdr_threshold': psm_fdr_threshold,
+                'min_peptides': min_peptides, 'precision': precision}
+
+    workers = min(workers or os.cpu_count() or 1, len(runs))
+    if workers <= 1:
+        _init_worker(reference, settings)
+        results = [_align_run(name, run) for name, run in runs.items()]
+    else:
+        ctx = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_worker,
+                                 initargs=(reference, settings)) as pool:
+            results = list(pool.map(_align_run, runs.keys(), runs.values()))
+
+    frames = [aligned for aligned, _ in results if aligned is not None]
+    aligned = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    summary = pd.DataFrame([s for _, s in results])
+    if 'overlap' in summary:
+        summary['overlap'] = summary['overlap'].astype('Int64')
+    return aligned, summary
+
+
+@click.command()
+@click.argument('reference', type=click.Path(exists=True))
+@click.argument('runs', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--out', 'out', default='aligned_runs.tsv', show_default=True, help='Aligned runs (TSV).')
+@click.option('--summary', 'summary_path', default=None, help='Per-run summary (TSV), default <out>_summary.tsv.')
+@click.option('--xcol', default='retention_time', show_default=True, help='RT column of the runs.')
+@click.option('--ycol', default='irt', show_default=True, help='RT column of the reference.')
+@click.option('--lowess-frac', default=0.01, show_default=True, type=float, help='LOWESS fraction, 0 to select it by cross-validation.')
+@click.option('--psm-fdr-threshold', default=0.01, show_default=True, type=float, help='q-value cutoff of the fitted peptides.')
+@click.option('--min-peptides', default=50, show_default=True, type=int, help='Minimum peptide overlap of a run.')
+@click.option('--precision', default='exact', show_default=True, type=click.Choice(list(irt_align.ALIGNMENT_PRECISION)), help='Accuracy-versus-speed setting.')
+@click.option('--workers', default=None, type=int, help='Worker processes, default all CPU cores.')
+def main(reference, runs, out, summary_path, xcol, ycol, lowess_frac, psm_fdr_threshold, min_peptides, precision, workers):
+    """Align RUNS onto REFERENCE and write the concatenated aligned table and a per-run summary"""
+    aligned, summary = align_runs(list(runs), reference, xcol, ycol, lowess_frac, psm_fdr_threshold, min_peptides,
+                                  precision, workers)
+    aligned.to_csv(out, sep='\t', index=False)
+    summary_path = summary_path or os.path.splitext(out)[0] + '_summary.tsv'
+    summary.to_csv(summary_path, sep='\t', index=False)
+    irt_align.timestamped_echo(f'Info: Aligned {int((summary["status"] == "aligned").sum())} of {len(summary)} runs into {out}, summary in {summary_path}.')
+
+
+if __name__ == "__main__":
+    main()
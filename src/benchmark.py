@@ -0,0 +1,305 @@
+# benchmark.py - Throughput and peak memory of the library stages on synthetic data, kept across commits
+
+import contextlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(SRC_DIR)
+
+# one JSON line per benchmark run, appended so that earlier commits stay comparable
+# (untracked, see .gitignore, so it survives checking out other commits)
+RESULTS_FILE = os.path.join(ROOT_DIR, 'benchmark_results.jsonl')
+# synthetic data sets are kept here between runs, generating the large ones takes a while
+DATA_DIR = os.path.join(tempfile.gettempdir(), 'dia_aspire_benchmark')
+DEFAULT_ROWS = 100000
+ALLELES = 3
+# slowdown or memory growth against the previous commit that is reported as a regression
+REGRESSION_THRESHOLD = 0.1
+LOWESS_FRAC = 0.01
+# benchmarked code paths, in running order
+CASES = ['sptxt2tsv', 'lowess', 'merge_fragpipe', 'merge_sptxt', 'merge_out_of_core']
+
+
+def dataset(rows, seed=0, data_dir=DATA_DIR):
+    """Paths of the synthetic data set of `rows` fragment rows per library, generated on first use"""
+    import synthetic
+    out = os.path.join(data_dir, f'rows_{rows}_seed_{seed}')
+    index = os.path.join(out, 'dataset.json')
+    if os.path.exists(index):
+        with open(index, 'r') as f:
+            return json.load(f)
+    print(f"Generating synthetic data set of {rows} rows in {out}")
+    t0 = time.perf_counter()
+    paths = synthetic.generate(out, rows, ALLELES, seed)
+    # written last, a partly generated data set is generated again
+    with open(index, 'w') as f:
+        json.dump(paths, f, indent=2)
+    print(f"Generated in {time.perf_counter() - t0:.1f} s")
+    return paths
+
+
+def _run_case(case, data, work_dir):
+    """Run one benchmark case in this process; returns the input rows it processed"""
+    import instrument
+    if case == 'sptxt2tsv':
+        import sptxt2tsv
+        with instrument.report(work_dir, case):
+            sptxt2tsv.convert_sptxt2tsv(data['sptxt'], workers=1)
+        return data['rows']['sptxt']
+    if case == 'lowess':
+        import pandas as pd
+        import irt_alignment
+        run = pd.read_csv(data['irt'])
+        run.columns = ['modified_peptide', 'precursor_charge', 'RT']
+        reference = pd.read_csv(data['fragpipe'], sep='\t', usecols=['ModifiedPeptideSequence', 'PrecursorCharge',
+                                                                     'NormalizedRetentionTime']).drop_duplicates()
+        reference.columns = ['modified_peptide', 'precursor_charge', 'irt']
+        with instrument.report(work_dir, case):
+            irt_alignment.lowess2(run, reference, 'RT', 'irt', LOWESS_FRAC, 0, 10)
+        return len(run)
+    # the merges look for the iRT reference in their output directory
+    shutil.copy2(data['irt'], work_dir)
+    if case == 'merge_sptxt':
+        import systemhc_api as api
+        sample = data['sptxt']
+        rows = data['rows']['sptxt']
+    else:
+        import fragpipe_api as api
+        sample = data['fragpipe']
+        rows = data['rows']['fragpipe']
+    with instrument.report(work_dir, case):
+        api.merge_libraries(sample, data['systemhc'], work_dir, cache=False, out_of_core=case == 'merge_out_of_core')
+    return rows + sum(data['rows']['systemhc'])
+
+
+def run_case(case, data, repeat=1):
+    """
+    Benchmark `case` on the data set `data`, best of `repeat` runs in fresh interpreters
+
+    Each run gets its own interpreter, so the peak RSS is that of the case
+    alone and no library or alignment cache carries over between runs.
+
+    Returns:
+    --------
+    dict
+        Case result: rows_input, seconds, cpu_seconds, rows_per_second,
+        peak_rss_mb, baseline_rss_mb (after the imports) and the stage
+        records with their rows_per_second; None when every run failed
+    """
+    best = None
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory(prefix=f'bench_{case}_') as work_dir:
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), 'case', case,
+                                   json.dumps(data), work_dir], capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"Error: {case} failed: {(proc.stderr.strip().splitlines() or ['no output'])[-1]}")
+            continue
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        best = result if best is None or result['seconds'] < best['seconds'] else best
+    return best
+
+
+def sptxt_parity(rows=20000, workers=2, seed=0):
+    """
+    Whether the parallel SPTXT conversion matches the serial one, on LF and CRLF copies of a synthetic SPTXT
+
+    Returns:
+    --------
+    list
+        Descriptions of the mismatches, empty when all conversions are identical
+    """
+    import synthetic
+    import sptxt2tsv
+    with tempfile.TemporaryDirectory(prefix='sptxt_parity_') as tmp:
+        lf = os.path.join(tmp, 'lf.sptxt')
+        crlf = os.path.join(tmp, 'crlf.sptxt')
+        synthetic.write_sptxt(lf, synthetic.precursor_pool(max(100, rows // 5), seed), rows, seed)
+        with open(lf, 'rb') as src, open(crlf, 'wb') as dst:
+            dst.write(src.read().replace(b'\n', b'\r\n'))
+        serial = sptxt2tsv.convert_sptxt2tsv(lf, workers=1)
+        mismatches = []
+        for name, path in [('LF', lf), ('CRLF', crlf)]:
+            for n in sorted({1, workers}):
+                try:
+                    out = sptxt2tsv.convert_sptxt2tsv(path, workers=n)
+                except Exception as e:
+                    mismatches.append(f"{name}, {n} workers: {type(e).__name__}: {e}")
+                    continue
+                if not out.equals(serial):
+                    mismatches.append(f"{name}, {n} workers: output differs from the serial LF conversion")
+    return mismatches
+
+
+def _rate(rows, seconds):
+    return round(rows / seconds) if rows and seconds else None
+
+
+def git_commit():
+    """Short hash of the checked-out commit, '+dirty' when tracked files are modified; None outside git"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+dirty' if dirty else '')
+
+
+def load_results(path=RESULTS_FILE):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def previous_result(results, record):
+    """Latest stored result of the same case, size and host from another commit"""
+    for old in reversed(results):
+        if (old['case'], old['rows'], old['host']) == (record['case'], record['rows'], record['host']) and \
+                old['commit'] != record['commit']:
+            return old
+    return None
+
+
+def compare(record, old, threshold=REGRESSION_THRESHOLD):
+    """Change of time and peak memory against `old`, and whether either grew by more than `threshold`"""
+    time_change = record['seconds'] / old['seconds'] - 1 if old['seconds'] else 0
+    memory_change = record['peak_rss_mb'] / old['peak_rss_mb'] - 1 if old['peak_rss_mb'] else 0
+    return time_change, memory_change, time_change > threshold or memory_change > threshold
+
+
+def print_record(record, old=None, threshold=REGRESSION_THRESHOLD):
+    """Print a result with its stages; returns whether it regressed against `old`"""
+    line = (f"{record['case']:<18} {record['rows']:>9} rows {record['seconds']:>9.2f} s "
+            f"{record['rows_per_second'] or 0:>10} rows/s {record['peak_rss_mb']:>8.1f} MB peak")
+    regressed = False
+    if old is not None:
+        time_change, memory_change, regressed = compare(record, old, threshold)
+        line += f"  vs {old['commit']}: time {time_change:+.0%}, memory {memory_change:+.0%}"
+        if regressed:
+            line += '  REGRESSION'
+    print(line)
+    for stage in record['stages']:
+        rate = f"{stage['rows_per_second']:>10} rows/s" if stage['rows_per_second'] else ' ' * 17
+        print(f"    {stage['stage']:<16} x{stage['calls']:<4} {stage['seconds']:>9.2f} s {rate} "
+              f"{stage['peak_rss_mb']:>8.1f} MB peak")
+    return regressed
+
+
+@click.group()
+def cli():
+    """Benchmarks of the DIA-Aspire library stages on synthetic data"""
+
+
+@cli.command('generate')
+@click.argument('out_dir')
+@click.option('--rows', default=DEFAULT_ROWS, show_default=True, type=int, help='Fragment rows per library.')
+@click.option('--alleles', default=ALLELES, show_default=True, type=int, help='SysteMHC allele libraries.')
+@click.option('--seed', default=0, show_default=True, type=int, help='Random seed.')
+def generate_main(out_dir, rows, alleles, seed):
+    """Write a synthetic SPTXT, FragPipe library, SysteMHC allele libraries and iRT reference to OUT_DIR"""
+    import synthetic
+    paths = synthetic.generate(out_dir, rows, alleles, seed)
+    for name in ['sptxt', 'fragpipe', 'irt']:
+        print(f"{name}: {paths[name]} ({paths['rows'][name]} rows)")
+    for path, n in zip(paths['systemhc'], paths['rows']['systemhc']):
+        print(f"systemhc: {path} ({n} rows)")
+
+
+@cli.command('run')
+@click.option('--rows', 'sizes', multiple=True, type=int, help=f'Fragment rows per library (10k to 5M), repeatable; default {DEFAULT_ROWS}.')
+@click.option('--case', 'cases', multiple=True, type=click.Choice(CASES), help='Case to run, repeatable; default all.')
+@click.option('--repeat', default=1, show_default=True, type=int, help='Runs per case, the fastest is kept.')
+@click.option('--seed', default=0, show_default=True, type=int, help='Random seed of the synthetic data.')
+@click.option('--data-dir', default=DATA_DIR, show_default=True, help='Where synthetic data sets are kept.')
+@click.option('--results', 'results_path', default=RESULTS_FILE, show_default=True, help='Results file (JSON lines).')
+@click.option('--threshold', default=REGRESSION_THRESHOLD, show_default=True, type=float, help='Slowdown or memory growth reported as a regression.')
+@click.option('--no-save', is_flag=True, help='Do not add the results to the results file.')
+@click.option('--check', is_flag=True, help='Exit with 1 on a regression against the previous commit.')
+def run_main(sizes, cases, repeat, seed, data_dir, results_path, threshold, no_save, check):
+    """Benchmark the library stages and compare them with the previous commit in the results file"""
+    results = load_results(results_path)
+    commit = git_commit()
+    regressions = 0
+    for rows in sizes or [DEFAULT_ROWS]:
+        data = dataset(rows, seed, data_dir)
+        for case in cases or CASES:
+            result = run_case(case, data, repeat)
+            if result is None:
+                continue
+            record = {'case': case, 'rows': rows, 'seed': seed, 'commit': commit,
+                      'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'host': socket.gethostname(),
+                      'python': sys.version.split()[0], 'repeat': repeat, **result}
+            regressions += print_record(record, previous_result(results, record), threshold)
+            results.append(record)
+            if not no_save:
+                with open(results_path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+    if regressions:
+        print(f"{regressions} regressions above {threshold:.0%}")
+    sys.exit(1 if check and regressions else 0)
+
+
+@cli.command('parity')
+@click.option('--rows', default=20000, show_default=True, type=int, help='Peaks of the synthetic SPTXT.')
+@click.option('--workers', default=2, show_default=True, type=int, help='Worker processes of the parallel conversion.')
+def parity_main(rows, workers):
+    """Check that the parallel SPTXT conversion gives the serial output, with LF and CRLF line ends"""
+    mismatches = sptxt_parity(rows, workers)
+    for mismatch in mismatches:
+        print(f"Error: {mismatch}")
+    print('SPTXT conversion: parallel output identical to serial' if not mismatches else
+          f"SPTXT conversion: {len(mismatches)} mismatches")
+    sys.exit(1 if mismatches else 0)
+
+
+@cli.command('history')
+@click.option('--results', 'results_path', default=RESULTS_FILE, show_default=True, help='Results file (JSON lines).')
+@click.option('--case', 'cases', multiple=True, type=click.Choice(CASES), help='Case to show, repeatable; default all.')
+def history_main(results_path, cases):
+    """Print the stored results of every case and size, oldest first"""
+    results = [r for r in load_results(results_path) if not cases or r['case'] in cases]
+    for key in sorted({(r['case'], r['rows'], r['host']) for r in results},
+                      key=lambda k: (CASES.index(k[0]) if k[0] in CASES else len(CASES), k[1], k[2])):
+        print(f"{key[0]}, {key[1]} rows on {key[2]}:")
+        for r in results:
+            if (r['case'], r['rows'], r['host']) == key:
+                print(f"    {r['date']}  {r['commit'] or '-':<14} {r['seconds']:>9.2f} s "
+                      f"{r['rows_per_second'] or 0:>10} rows/s {r['peak_rss_mb']:>8.1f} MB peak")
+
+
+@cli.command('case', hidden=True)
+@click.argument('case', type=click.Choice(CASES))
+@click.argument('data')
+@click.argument('work_dir')
+def case_main(case, data, work_dir):
+    """Run one case in this interpreter and print its result as JSON (used by run)"""
+    import instrument
+    # imports are not timed (import_budget.py checks them); the alignment stacks load on the first fit otherwise
+    import library_schema  # noqa: F401
+    for module in ['statsmodels.nonparametric.smoothers_lowess', 'sklearn.isotonic', 'sklearn.linear_model']:
+        with contextlib.suppress(ImportError):
+            __import__(module)
+    baseline = instrument.peak_rss() / 1024 ** 2
+    with open(os.path.join(work_dir, 'benchmark.log'), 'w') as log, contextlib.redirect_stdout(log):
+        rows = _run_case(case, json.loads(data), work_dir)
+    section = instrument.load_report(work_dir)['sections'][case]
+    stages = [{**s, 'rows_per_second': _rate(s.get('rows'), s['seconds'])} for s in section['stages']]
+    print(json.dumps({'rows_input': rows, 'seconds': section['seconds'], 'cpu_seconds': section['cpu_seconds'],
+                      'rows_per_second': _rate(rows, section['seconds']), 'peak_rss_mb': section['peak_rss_mb'],
+                      'baseline_rss_mb': round(baseline, 1), 'stages': stages}))
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, SRC_DIR)
+    cli()
@@ -0,0 +1,175 @@
+# checkpoint.py - Pipeline stages with declared inputs and outputs, skipped when up to date
+
+import hashlib
+import json
+import os
+import time
+
+import library_cache
+
+MANIFEST_FILE = 'dia_aspire_stages.json'
+# bump whenever the manifest layout changes, manifests of another version are ignored
+MANIFEST_VERSION = '1'
+
+
+def expand_inputs(paths, extensions=None):
+    """
+    Input files of the given paths
+
+    A directory stands for the files directly inside it, only those ending in
+    one of `extensions` when given; a directory ending in one of them (e.g. a
+    Bruker .d folder), given or found inside, stands for all files below it.
+    """
+    def walk(folder):
+        return sorted(os.path.join(root, f) for root, _, names in os.walk(folder) for f in names)
+
+    def is_run_folder(path):
+        return extensions is not None and path.rstrip(os.sep).lower().endswith(tuple(extensions))
+
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        if is_run_folder(path):
+            files.extend(walk(path))
+            continue
+        for name in sorted(os.listdir(path)):
+            entry = os.path.join(path, name)
+            if extensions is not None and not name.lower().endswith(tuple(extensions)):
+                continue
+            if os.path.isfile(entry):
+                files.append(entry)
+            elif is_run_folder(entry):
+                files.extend(walk(entry))
+    return files
+
+
+class StageManifest:
+    """
+    Content-hash record of the completed pipeline stages of an output directory
+
+    Each completed stage is stored with its key (a hash of the content of its
+    input files and of its parameters) and the content hashes of its outputs.
+    A stage is up to date when its key is unchanged and all its outputs still
+    have the recorded content. File hashes are remembered per (size, mtime),
+    so unchanged files are read once. The manifest is rewritten as soon as a
+    stage completes and a stage is dropped from it before it reruns, so an
+    interrupted run resumes after its last completed stage.
+    """
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, MANIFEST_FILE)
+        self.data = {'version': MANIFEST_VERSION, 'stages': {}, 'files': {}}
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                self.data = data
+        except (OSError, ValueError):
+            pass
+
+    @property
+    def stages(self):
+        return self.data['stages']
+
+    def digest(self, path):
+        """Content hash of a file, reusing the recorded one while its size and mtime are unchanged"""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        entry = self.data['files'].get(path)
+        if entry and entry['stamp'] == stamp:
+            return entry['hash']
+        digest = library_cache.file_digest(path)
+        self.data['files'][path] = {'stamp': stamp, 'hash': digest}
+        return digest
+
+    def stage_key(self, inputs, params):
+        """Key of a stage run on the given input files with the given parameters"""
+        h = hashlib.blake2b(digest_size=20)
+        files = [[os.path.abspath(p), self.digest(p)] for p in inputs]
+        h.update(json.dumps([files, sorted(params.items())], default=str).encode())
+        return h.hexdigest()
+
+    def is_current(self, name, key):
+        record = self.stages.get(name)
+        if not record or record['key'] != key:
+            return False
+        try:
+            return all(self.digest(p) == d for p, d in record['outputs'].items())
+        except OSError:
+            return False
+
+    def complete(self, name, key, outputs, seconds):
+        self.stages[name] = {'key': key, 'outputs': {os.path.abspath(p): self.digest(p) for p in outputs},
+                             'seconds': round(seconds, 1), 'completed': time.strftime('%Y-%m-%d %H:%M:%S')}
+        self.save()
+
+    def invalidate(self, name):
+        if self.stages.pop(name, None) is not None:
+            self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+def check_stage(manifest, name, inputs, params):
+    """(key, up to date) of a stage run on the given input files with the given parameters"""
+    key = manifest.stage_key(inputs, params)
+    return key, manifest.is_current(name, key)
+
+
+def finish_stage(manifest, name, key, outputs, optional_outputs=(), seconds=0.0):
+    """Record a stage that has run, checking it produced its outputs"""
+    outputs = list(outputs() if callable(outputs) else outputs)
+    missing = [p for p in outputs if not os.path.exists(p)]
+    if missing or not outputs:
+        raise Exception(f"Stage {name} did not produce {', '.join(missing) or 'any output'}")
+    outputs += [p for p in optional_outputs if os.path.exists(p)]
+    manifest.complete(name, key, outputs, seconds)
+
+
+def run_stage(manifest, name, inputs, params, outputs, run, optional_outputs=(), force=False):
+    """
+    Run a pipeline stage unless the manifest shows it is up to date
+
+    Parameters:
+    -----------
+    manifest : StageManifest
+        Manifest of the output directory
+    name : str
+        Stage name
+    inputs : list
+        Input files; their content is part of the stage key
+    params : dict
+        Parameters of the stage, part of the stage key
+    outputs : list or callable
+        Output files the stage must produce, or a callable returning them
+        once the stage has run
+    run : callable
+        Runs the stage
+    optional_outputs : list
+        Outputs recorded only when the stage produced them
+    force : bool
+        Run the stage even when it is up to date
+
+    Returns:
+    --------
+    bool
+        True when the stage ran, False when it was skipped
+    """
+    key, current = check_stage(manifest, name, inputs, params)
+    if current and not force:
+        print(f"Stage {name}: up to date, skipped")
+        return False
+    # a stage that is interrupted from here on is not taken as complete by the next run
+    manifest.invalidate(name)
+    t0 = time.perf_counter()
+    run()
+    finish_stage(manifest, name, key, outputs, optional_outputs, time.perf_counter() - t0)
+    return True
@@ -0,0 +1,234 @@
+# diann_runner.py - Run DIA-NN from an argument list, streaming its output and recording the run
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import click
+
+import instrument
+
+DEFAULT_DIANN_PATH = '/usr/diann/1.8.1/diann-1.8.1'
+# run record written next to the DIA-NN reports
+RUN_RECORD = 'diann_run.json'
+# seconds DIA-NN gets to exit after SIGTERM before it is killed
+TERMINATE_GRACE = 10
+POLL_SECONDS = 0.1
+# exit code of a run stopped by its timeout, as with coreutils timeout
+TIMEOUT_EXIT = 124
+
+
+def param_args(params):
+    """
+    DIA-NN arguments of a parameter dict (name without dashes to value)
+
+    A value of 'true' or '' gives a switch without value, 'false' leaves the
+    parameter out.
+    """
+    args = []
+    for name, value in params.items():
+        value = str(value).strip()
+        if value.lower() == 'false':
+            continue
+        args.append(f'--{name}')
+        if value and value.lower() != 'true':
+            args.append(value)
+    return args
+
+
+def diann_argv(diann_path, library, out, dia_dir=None, dia_files=(), args=()):
+    """DIA-NN argument list searching a folder or a list of DIA files with `library`"""
+    argv = [diann_path, '--lib', library, '--out', out]
+    if dia_dir:
+        argv += ['--dir', dia_dir]
+    for file in dia_files:
+        argv += ['--f', file]
+    return argv + list(args)
+
+
+class ProcessRunner:
+    """
+    External command run in its own process group, with its output streamed line by line
+
+    Parameters:
+    -----------
+    argv : list
+        Command and arguments, started without a shell
+    cwd : str, optional
+        Working directory
+    on_line : callable, optional
+        Called with each output line (without newline) and 'stdout' or 'stderr';
+        calls are serialised. Default prints the line to the matching stream
+    timeout : float, optional
+        Seconds after which the run is cancelled
+    memory_limit : int, optional
+        Bytes of address space the command may use (RLIMIT_AS)
+    grace : float
+        Seconds between SIGTERM and SIGKILL when the run is cancelled
+    """
+
+    def __init__(self, argv, cwd=None, on_line=None, timeout=None, memory_limit=None, grace=TERMINATE_GRACE):
+        self.argv = [str(a) for a in argv]
+        self.cwd = cwd
+        self.on_line = on_line or self._print
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.grace = grace
+        self.proc = None
+        self.readers = []
+        self.lock = threading.Lock()
+        self.started = None
+        self.cancelled_at = None
+        self.timed_out = False
+        self.killed = False
+
+    @staticmethod
+    def _print(line, stream):
+        print(line, file=sys.stderr if stream == 'stderr' else sys.stdout, flush=True)
+
+    def _limits(self):
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (self.memory_limit, self.memory_limit))
+
+    def _read(self, pipe, stream):
+        for raw in iter(pipe.readline, b''):
+            with self.lock:
+                self.on_line(raw.decode(errors='replace').rstrip('\r\n'), stream)
+        pipe.close()
+
+    def start(self):
+        self.started = time.time()
+        self.t0 = time.perf_counter()
+        # own process group, so cancel() also reaches processes DIA-NN starts
+        self.proc = subprocess.Popen(self.argv, cwd=self.cwd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE, start_new_session=True,
+                                     preexec_fn=self._limits if self.memory_limit else None)
+        self.readers = [threading.Thread(target=self._read, args=(pipe, name), daemon=True)
+                        for pipe, name in ((self.proc.stdout, 'stdout'), (self.proc.stderr, 'stderr'))]
+        for reader in self.readers:
+            reader.start()
+        return self
+
+    def _signal(self, sig):
+        try:
+            os.killpg(self.proc.pid, sig)
+        except OSError:
+            pass
+
+    def cancel(self):
+        """Ask the process group to terminate; it is killed if still running after `grace` seconds"""
+        if self.proc is None or self.cancelled_at is not None:
+            return
+        self.cancelled_at = time.perf_counter()
+        self._signal(signal.SIGTERM)
+
+    def wait(self):
+        """Wait for the command to exit, applying the timeout; returns the run record"""
+        while True:
+            pid, status, rusage = os.wait4(self.proc.pid, os.WNOHANG)
+            if pid:
+                break
+            now = time.perf_counter()
+            if self.timeout and not self.timed_out and now - self.t0 > self.timeout:
+                self.timed_out = True
+                self.cancel()
+            if self.cancelled_at is not None and not self.killed and now - self.cancelled_at > self.grace:
+                self.killed = True
+                self._signal(signal.SIGKILL)
+            time.sleep(POLL_SECONDS)
+        seconds = time.perf_counter() - self.t0
+        self.proc.returncode = os.waitstatus_to_exitcode(status)
+        # descendants left in the group would keep the pipes open
+        self._signal(signal.SIGKILL)
+        for reader in self.readers:
+            reader.join(timeout=5)
+        if self.timed_out:
+            state = 'timed out'
+        elif self.cancelled_at is not None:
+            state = 'cancelled'
+        else:
+            state = 'done' if self.proc.returncode == 0 else 'failed'
+        # ru_maxrss is in kilobytes on Linux
+        return {'argv': self.argv, 'cwd': os.path.abspath(self.cwd or '.'), 'status': state,
+                'returncode': self.proc.returncode,
+                'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+                'seconds': round(seconds, 1), 'cpu_seconds': round(rusage.ru_utime + rusage.ru_stime, 1),
+                'peak_rss_mb': round(rusage.ru_maxrss / 1024, 1),
+                'timeout': self.timeout, 'memory_limit_mb': None if self.memory_limit is None
+                else round(self.memory_limit / 1024 ** 2)}
+
+    def run(self):
+        return self.start().wait()
+
+
+def exit_code(record):
+    """Exit code reporting a run record: the command's, 128 + signal when killed, TIMEOUT_EXIT on timeout"""
+    if record['status'] == 'timed out':
+        return TIMEOUT_EXIT
+    code = record['returncode']
+    return 128 - code if code < 0 else code
+
+
+def save_record(record, path):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(record, f, indent=2)
+    os.replace(tmp, path)
+
+
+@click.command(context_settings={'ignore_unknown_options': True})
+@click.option('--lib', 'library', required=True, help='Spectral library.')
+@click.option('--out', default='result_peptide.tsv', show_default=True, help='DIA-NN report.')
+@click.option('--output-dir', required=True, help='Directory DIA-NN runs in, created when missing.')
+@click.option('--dir', 'dia_dir', default=None, help='Folder of DIA files.')
+@click.option('--f', 'dia_files', multiple=True, help='DIA file, repeated for several.')
+@click.option('--diann-path', default=DEFAULT_DIANN_PATH, show_default=True, help='DIA-NN executable.')
+@click.option('--timeout', default=None, type=float, help='Hours after which DIA-NN is stopped.')
+@click.option('--memory-limit', default=None, type=float, help='GB of address space DIA-NN may use.')
+@click.option('--record', default=RUN_RECORD, show_default=True, help='Run record (JSON), relative to the output directory.')
+@click.argument('diann_args', nargs=-1, type=click.UNPROCESSED)
+def main(library, out, output_dir, dia_dir, dia_files, diann_path, timeout, memory_limit, record, diann_args):
+    """Run DIA-NN with LIB on the DIA files, passing DIANN_ARGS (e.g. --threads 8) through"""
+    if not os.path.isdir(output_dir):
+        print(f"Creating output directory: {output_dir}")
+        os.makedirs(output_dir, exist_ok=True)
+    # DIA-NN runs in the output directory, the inputs are given from here
+    argv = diann_argv(diann_path, os.path.abspath(library), out, dia_dir and os.path.abspath(dia_dir),
+                      [os.path.abspath(f) for f in dia_files], diann_args)
+    print(f"Executing: {subprocess.list2cmdline(argv)}", flush=True)
+    runner = ProcessRunner(argv, cwd=output_dir, timeout=timeout * 3600 if timeout else None,
+                           memory_limit=int(memory_limit * 1024 ** 3) if memory_limit else None)
+    # a stop request (SIGTERM from the GUI or the scheduler, Ctrl-C) ends DIA-NN with its group
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(sig, lambda signum, frame: runner.cancel())
+    # the search is also recorded as a stage of the run report of the output directory
+    result = None
+    with instrument.report(output_dir, 'diann'):
+        with instrument.stage('diann_run', rows=len(dia_files) or None) as stage:
+            try:
+                result = runner.run()
+            except OSError as e:
+                stage['error'] = f"Cannot start DIA-NN: {e}"
+            else:
+                stage['peak_rss_mb'] = result['peak_rss_mb']
+                if result['status'] != 'done':
+                    stage['error'] = f"DIA-NN {result['status']} (exit code {result['returncode']})"
+    if result is None:
+        print(f"Error: {stage['error']}")
+        sys.exit(127)
+    save_record(result, os.path.join(output_dir, record))
+    if result['status'] == 'timed out':
+        print(f"Error: DIA-NN timed out after {timeout} h")
+    elif result['status'] == 'cancelled':
+        print("DIA-NN was stopped")
+    print(f"DIA-NN {result['status']} (exit code {result['returncode']}) in {result['seconds']} s, "
+          f"peak RSS {result['peak_rss_mb']:.0f} MB")
+    sys.exit(exit_code(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# fake_diann.py - Stand-in for the DIA-NN executable to test the pipeline without DIA-NN
+#
+# Accepts the DIA-NN command line built by diann_runner.py, works for a while with
+# the requested threads and memory, then writes reports named after --out.
+# Behaviour is set by environment variables:
+#   FAKE_DIANN_SECONDS    seconds of work per DIA file (default 1)
+#   FAKE_DIANN_MEMORY_MB  memory held while working (default 50)
+#   FAKE_DIANN_LINES      extra output lines per DIA file, as with --verbose 5 (default 0)
+#   FAKE_DIANN_EXIT       exit code (default 0; no reports unless 0)
+#   FAKE_DIANN_FAIL_ONCE  exit with code 3 the first time a DIA file whose name
+#                         contains this text is searched in the working directory
+# With --temp the per-run quantification is saved there as <file name>.quant;
+# with --use-quant runs that have one are not searched again.
+
+import os
+import sys
+import time
+
+DIA_EXTENSIONS = ('.raw', '.wiff', '.mzml', '.dia', '.d')
+
+
+def parse_args(argv):
+    """Options of a DIA-NN command line as a dict of lists (flags without a value map to [])"""
+    opts = {}
+    i = 0
+    while i < len(argv):
+        name = argv[i].lstrip('-')
+        values = opts.setdefault(name, [])
+        if i + 1 < len(argv) and not argv[i + 1].startswith('--'):
+            values.append(argv[i + 1])
+            i += 1
+        i += 1
+    return opts
+
+
+def log(t0, message):
+    """Print a line the way DIA-NN does, prefixed with the elapsed [m:ss]"""
+    minutes, seconds = divmod(int(time.perf_counter() - t0), 60)
+    print(f"[{minutes}:{seconds:02d}] {message}", flush=True)
+
+
+def main(argv):
+    t0 = time.perf_counter()
+    opts = parse_args(argv)
+    files = list(opts.get('f', []))
+    for folder in opts.get('dir', []):
+        files += sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(DIA_EXTENSIONS))
+    lib = opts.get('lib', [''])[0]
+    out = opts.get('out', ['report.tsv'])[0]
+    threads = int(opts.get('threads', ['1'])[0])
+    temp = opts.get('temp', [None])[0]
+    print(f"Fake DIA-NN: {len(files)} files, library {lib}, {threads} threads")
+    if not files:
+        print("No DIA files")
+        return 1
+    if lib and not os.path.exists(lib):
+        print(f"Library {lib} not found")
+        return 1
+
+    ballast = bytearray(int(float(os.environ.get('FAKE_DIANN_MEMORY_MB', 50)) * 1024 ** 2))
+    ballast[::4096] = b'\x01' * len(ballast[::4096])  # touch every page so it is resident
+    fail_once = os.environ.get('FAKE_DIANN_FAIL_ONCE')
+    for i, file in enumerate(files):
+        quant = os.path.join(temp, f'{os.path.basename(file.rstrip(os.sep))}.quant') if temp else None
+        if 'use-quant' in opts and quant and os.path.exists(quant):
+            log(t0, f"Using {quant}")
+            continue
+        log(t0, f"File #{i + 1}/{len(files)}")
+        log(t0, f"Loading run {file}")
+        for n in range(int(os.environ.get('FAKE_DIANN_LINES', 0))):
+            log(t0, f"Precursor {n}: score {n % 97 / 97:.4f}")
+        time.sleep(float(os.environ.get('FAKE_DIANN_SECONDS', 1)))
+        if fail_once and fail_once in os.path.basename(file) and not os.path.exists('fake_diann.failed'):
+            open('fake_diann.failed', 'w').close()
+            print(f"Crashed on {file}")
+            return 3
+        if quant:
+            os.makedirs(temp, exist_ok=True)
+            with open(quant, 'w') as f:
+                f.write(f"{file}\n")
+    del ballast
+
+    code = int(os.environ.get('FAKE_DIANN_EXIT', 0))
+    if code != 0:
+        return code
+    base = out[:-4] if out.endswith('.tsv') else out
+    with open(out, 'w') as f:
+        f.write("File.Name\tRun\tPrecursor.Id\tQ.Value\n")
+        for file in files:
+            run = os.path.splitext(os.path.basename(file))[0]
+            f.write(f"{file}\t{run}\tPEPTIDE2\t0.001\n")
+    with open(f'{base}.stats.tsv', 'w') as f:
+        f.write("File.Name\tPrecursors.Identified\n")
+        for file in files:
+            f.write(f"{file}\t1\n")
+    print(f"Report saved to {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -7,8 +7,64 @@ import pandas as pd
 import os
 import sys
 import irt_alignment as irt_align
+import instrument
+import irt_store
+import library_schema
+import library_stream
+import progress as progress_module
+import precursor_index
+import rt_model
 
-def merge_libraries(sample_library_path, systemhc_lib_paths, output_dir):
+# FragPipe library columns
+MERGED_COLS = ['PrecursorMz', 'ProductMz', 'ProteinId',
+               'PeptideSequence', 'ModifiedPeptideSequence', 'PrecursorCharge',
+               'LibraryIntensity', 'NormalizedRetentionTime']
+# SysteMHC library columns they are taken from
+SYSTEMHC_COLS = ['PrecursorMz', 'ProductMz', 'Protein_name',
+                 'StrippedPeptide', 'ModifiedPeptide', 'PrecursorCharge',
+                 'LibraryIntensity', 'NormalizedRetentionTime']
+
+# stages reported through the progress callback of merge_libraries
+MERGE_STAGES = [
+    'Loading sample library', 'Loading SysteMHC libraries', 'Aligning retention times',
+    'Writing merged library']
+
+def select_columns(ds2):
+    """SysteMHC library rows renamed to the FragPipe library columns, missing columns filled with NaN"""
+    try:
+        ds3 = ds2[SYSTEMHC_COLS]
+        ds3.columns = MERGED_COLS
+    except KeyError as e:
+        print(f"Warning: Column mapping issue - {str(e)}")
+        # Try a more flexible approach for column mapping
+        required_cols = ['ModifiedPeptide', 'PrecursorCharge']
+        for col in required_cols:
+            if col not in ds2.columns:
+                raise Exception(f"Required column '{col}' not found in SysteMHC libraries")
+        
+        # Map available columns and fill missing ones with NaN
+        col_map = {
+            'PrecursorMz': 'PrecursorMz', 
+            'ProductMz': 'ProductMz',
+            'Protein_name': 'ProteinId',
+            'StrippedPeptide': 'PeptideSequence',
+            'ModifiedPeptide': 'ModifiedPeptideSequence',
+            'PrecursorCharge': 'PrecursorCharge',
+            'LibraryIntensity': 'LibraryIntensity',
+            'NormalizedRetentionTime': 'NormalizedRetentionTime'
+        }
+        
+        ds3 = pd.DataFrame(index=ds2.index)
+        for src_col, dst_col in col_map.items():
+            if src_col in ds2.columns:
+                ds3[dst_col] = ds2[src_col]
+            else:
+                ds3[dst_col] = np.nan
+    return ds3
+
+def merge_libraries(sample_library_path, systemhc_lib_paths, output_dir, cache=None,
+                    out_of_core=False, chunksize=library_stream.DEFAULT_CHUNKSIZE, rt_precision='exact',
+                    lowess_frac=0.01, progress=None):
     """
     Merge sample library with SysteMHC libraries
     
@@ -20,6 +76,23 @@ def merge_libraries(sample_library_path, systemhc_lib_paths, output_dir):
         List of paths to SysteMHC library TSV files
     output_dir : str
         Directory where the merged library will be saved
+    cache : LibraryCache or bool, optional
+        Cache of parsed libraries; None uses the default cache directory,
+        False always re-reads the input files
+    out_of_core : bool
+        Stream the SysteMHC libraries in chunks straight to the merged file
+        instead of loading them all; a precursor found in several libraries
+        keeps the rows of the first one
+    chunksize : int
+        Rows read per chunk when out_of_core is set
+    rt_precision : str
+        Accuracy-versus-speed setting of the RT alignment ('exact', 'balanced'
+        or 'fast', see irt_alignment.ALIGNMENT_PRECISION)
+    lowess_frac : float
+        LOWESS fraction of the RT alignment; 0 selects it by cross-validation
+    progress : callable, optional
+        Called as progress(step, total, stage) when each of MERGE_STAGES
+        starts; the default prints a 'Stage i/n: stage' line
     
     Returns:
     --------
@@ -29,25 +102,63 @@ def merge_libraries(sample_library_path, systemhc_lib_paths, output_dir):
     print(f"Sample library: {sample_library_path}")
     print(f"SysteMHC libraries: {systemhc_lib_paths}")
     print(f"Output directory: {output_dir}")
+    progress = progress or progress_module.print_stage
+
+    def stage(i):
+        progress(i + 1, len(MERGE_STAGES), MERGE_STAGES[i])
     
     # Create output directory if it doesn't exist
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
     # Load sample library
-    sample_library = pd.read_csv(sample_library_path, sep='\t')
+    stage(0)
+    with instrument.stage('library_load') as s:
+        sample_library = library_schema.read_library(sample_library_path, cache=cache)
+        s['rows'] = len(sample_library)
     sample_library2 = sample_library.copy()
-    sample_library2['ions'] = sample_library2['ModifiedPeptideSequence'] + sample_library2['PrecursorCharge'].astype(str)
+    
+    # Precursor ids shared by all libraries, used for joins and deduplication
+    keys = precursor_index.PrecursorIndex()
+    sample_ids = keys.encode_frame(sample_library2, 'ModifiedPeptideSequence')
+    
+    # Precursors of the SysteMHC libraries
+    stage(1)
+    with instrument.stage('library_load') as s:
+        if out_of_core:
+            # only their precursor columns are read now, the rows are streamed below
+            library_stream.scan_precursors(systemhc_lib_paths, keys, chunksize=chunksize)
+        else:
+            # Combine SysteMHC libraries (read concurrently, only the merged columns)
+            systemhc_libs = []
+            for libp, datmp, seconds, error in library_schema.read_libraries(systemhc_lib_paths, cache=cache,
+                                                                             usecols=SYSTEMHC_COLS):
+                if error is None:
+                    systemhc_libs.append(datmp)
+                    print(f"Loaded SysteMHC library: {libp} ({seconds:.2f}s)")
+                else:
+                    print(f"Warning: Failed to load {libp} - {str(error)}")
+    
+            if not systemhc_libs:
+                raise Exception("No valid SysteMHC libraries were loaded")
+    
+            da = library_schema.concat_frames(systemhc_libs)
+            s['rows'] = len(da)
+    if not out_of_core:
+        with instrument.stage('dedup_merge') as s:
+            da = da.drop_duplicates()
+            da_ids = keys.encode_frame(da, 'ModifiedPeptide')
+            s['rows'] = len(da)
     
     # Load irt data for RT normalization (if available)
+    stage(2)
     try:
-        # Try to use the irt file in the output directory
-        irt_file_path = os.path.join(output_dir, 'irt_SYSTEMHC.csv')
-        if os.path.exists(irt_file_path):
-            df_need = pd.read_csv(irt_file_path)
-        else:
-            # if file doesn't exist in output dir
-            print(f"Failed:  {irt_file_path} not found")
+        # Indexed SysteMHC iRT reference, only the rows of the sample and SysteMHC precursors are read
+        with instrument.stage('irt_load') as s:
+            irt_ref = irt_store.open_reference(output_dir)
+            df_need = irt_ref.lookup(keys.peptides, keys.charges)
+            s['rows'] = len(df_need)
+        print(f"SysteMHC iRT reference: {irt_ref.path} ({len(df_need)} of {len(irt_ref)} rows used)")
         
         # RT normalization
         rt_reference_run = sample_library[['ModifiedPeptideSequence','PrecursorCharge','NormalizedRetentionTime']].drop_duplicates()
@@ -55,7 +166,14 @@ def merge_libraries(sample_library_path, systemhc_lib_paths, output_dir):
     
         df_need.columns = ['modified_peptide','precursor_charge','RT']
     
-        aligned_runs1 = irt_align.lowess2(df_need, rt_reference_run, 'RT', 'irt', 0.01, 0, 10)
+        # Reuse the alignment fitted earlier for this sample library and reference, if any
+        model = rt_model.cached_model(
+            lambda: irt_align.fit_alignment(df_need, rt_reference_run, 'RT', 'irt', lowess_frac, rt_precision),
+            sample_library_path, irt_ref.digest, cache=cache,
+            pipeline='fragpipe', lowess_frac=lowess_frac, precision=rt_precision)
+        print(f"RT alignment model: {model.describe()}")
+        aligned_runs1 = irt_align.lowess2(df_need, rt_reference_run, 'RT', 'irt', lowess_frac, 0, 10,
+                                          precision=rt_precision, model=model)
         pepida1 = aligned_runs1
         pepida1 = pepida1.loc[np.isfinite(pepida1['irt'])]
         pqp = pepida1
@@ -70,95 +188,69 @@ def merge_libraries(sample_library_path, systemhc_lib_paths, output_dir):
         print(f"Warning: RT normalization skipped - {str(e)}")
         # Continue without RT normalization
     
-    # Combine SysteMHC libraries
-    systemhc_libs = []
-    for libp in systemhc_lib_paths:
+    merged_lib_path = os.path.join(output_dir, 'merged_Sample+SysteMHC_library.tsv')
+    stage(3)
+    if out_of_core:
+        # Stream the SysteMHC libraries to the merged file chunk by chunk
         try:
-            datmp = pd.read_csv(libp, sep='\t')
-            systemhc_libs.append(datmp)
-            print(f"Loaded SysteMHC library: {libp}")
-        except Exception as e:
-            print(f"Warning: Failed to load {libp} - {str(e)}")
-    
-    if not systemhc_libs:
-        raise Exception("No valid SysteMHC libraries were loaded")
-    
-    da = pd.concat(systemhc_libs)
-    da = da.drop_duplicates()
-    da1 = da.copy()
-    da1['ions'] = da1['ModifiedPeptide'] + da1['PrecursorCharge'].astype(str)
+            rt = pqp2.copy()
+            rt = (keys.encode_frame(rt, 'ModifiedPeptide'), rt['NormalizedRetentionTime'].to_numpy())
+        except NameError:
+            rt = None
+        with instrument.stage('dedup_merge'):
+            library_stream.stream_merge(merged_lib_path, sample_library2[MERGED_COLS], sample_ids, systemhc_lib_paths,
+                                        keys, select_columns, rt=rt, chunksize=chunksize,
+                                        usecols=SYSTEMHC_COLS)
+        print(f"Merged library saved to: {merged_lib_path}")
+        return merged_lib_path
     
     # Try to apply RT normalization if available
-    try:
-        rt = pqp2.copy()
-        ds1 = pd.merge(da1, rt, on=['ModifiedPeptide','PrecursorCharge'], how='outer')
-        ds2 = ds1[ds1['ions'].isnull()==False]
-        ds2 = ds2[ds2['NormalizedRetentionTime'].isnull()==False]
-    except NameError:
-        # If RT normalization was not performed
-        ds2 = da1
-    
-    # FragPipe library columns
-    cols = ['PrecursorMz', 'ProductMz', 'ProteinId', 
-            'PeptideSequence', 'ModifiedPeptideSequence', 'PrecursorCharge', 
-            'LibraryIntensity', 'NormalizedRetentionTime', 'ions']
-    
-    # Prepare datasets for merging
-    try:
-        ds3 = ds2[['PrecursorMz', 'ProductMz', 'Protein_name',
-               'StrippedPeptide', 'ModifiedPeptide', 'PrecursorCharge',
-               'LibraryIntensity', 'NormalizedRetentionTime', 'ions']]
-        ds3.columns = cols
-    except KeyError as e:
-        print(f"Warning: Column mapping issue - {str(e)}")
-        # Try a more flexible approach for column mapping
-        required_cols = ['ModifiedPeptide', 'PrecursorCharge']
-        for col in required_cols:
-            if col not in ds2.columns:
-                raise Exception(f"Required column '{col}' not found in SysteMHC libraries")
-        
-        # Map available columns and fill missing ones with NaN
-        col_map = {
-            'PrecursorMz': 'PrecursorMz', 
-            'ProductMz': 'ProductMz',
-            'Protein_name': 'ProteinId',
-            'StrippedPeptide': 'PeptideSequence',
-            'ModifiedPeptide': 'ModifiedPeptideSequence',
-            'PrecursorCharge': 'PrecursorCharge',
-            'LibraryIntensity': 'LibraryIntensity',
-            'NormalizedRetentionTime': 'NormalizedRetentionTime'
-        }
-        
-        ds3 = pd.DataFrame()
-        for src_col, dst_col in col_map.items():
-            if src_col in ds2.columns:
-                ds3[dst_col] = ds2[src_col]
-            else:
-                ds3[dst_col] = np.nan
-        
-        ds3['ions'] = ds2['ions']
+    with instrument.stage('dedup_merge') as s:
+        try:
+            rt = pqp2.copy()
+            rt_ids = keys.encode_frame(rt, 'ModifiedPeptide')
+            nrt = keys.map_values(da_ids, rt_ids, rt['NormalizedRetentionTime'].to_numpy())
+            # keep precursors with an aligned RT, fragments grouped by precursor in order of first appearance
+            hit = np.flatnonzero(~np.isnan(nrt))
+            order = hit[np.argsort(pd.factorize(da_ids[hit])[0], kind='stable')]
+            ds2 = da.iloc[order].copy()
+            ds2['NormalizedRetentionTime'] = nrt[order]
+            ds2_ids = da_ids[order]
+        except NameError:
+            # If RT normalization was not performed
+            ds2 = da
+            ds2_ids = da_ids
     
-    sample_library3 = sample_library2[cols]
+        # Prepare datasets for merging
+        ds3 = select_columns(ds2)
+        sample_library3 = sample_library2[MERGED_COLS]
     
-    # Merge libraries (exclude duplicates)
-    ds4 = ds3[~ds3['ions'].isin(sample_library3['ions'])]
-    lib_merge = pd.concat([sample_library3, ds4])
+        # Merge libraries (exclude duplicates)
+        new = ~keys.isin(ds2_ids, sample_ids)
+        ds4 = ds3[new]
+        lib_merge = library_schema.concat_frames([sample_library3, ds4])
+        lib_merge['ions'] = keys.labels(np.concatenate([sample_ids, ds2_ids[new]]))
+        s['rows'] = len(lib_merge)
     
     # Save merged library
-    merged_lib_path = os.path.join(output_dir, 'merged_Sample+SysteMHC_library.tsv')
-    lib_merge.to_csv(merged_lib_path, sep='\t', index=False)
+    library_schema.write_library(lib_merge, merged_lib_path)
     print(f"Merged library saved to: {merged_lib_path}")
     
     return merged_lib_path
 
 # Allow script to be run directly or imported as a module
 if __name__ == "__main__":
-    if len(sys.argv) < 4:
-        print("Usage: python for_fragpipe.py <sample_library_path> <output_dir> <systemhc_lib1> [systemhc_lib2 ...]")
+    args = sys.argv[1:]
+    out_of_core = '--out-of-core' in args
+    if out_of_core:
+        args.remove('--out-of-core')
+
+    if len(args) < 3:
+        print("Usage: python for_fragpipe.py [--out-of-core] <sample_library_path> <output_dir> <systemhc_lib1> [systemhc_lib2 ...]")
         sys.exit(1)
     
-    sample_library_path = sys.argv[1]
-    output_dir = sys.argv[2]
-    systemhc_lib_paths = sys.argv[3:]
+    sample_library_path = args[0]
+    output_dir = args[1]
+    systemhc_lib_paths = args[2:]
     
-    merge_libraries(sample_library_path, systemhc_lib_paths, output_dir)
\ No newline at end of file
+    merge_libraries(sample_library_path, systemhc_lib_paths, output_dir, out_of_core=out_of_core)
@@ -0,0 +1,77 @@
+# import_budget.py - Check the import time of the pipeline modules against a budget
+
+import json
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(SRC_DIR)
+
+# seconds allowed for a cold import of each module in a fresh interpreter
+IMPORT_BUDGET = {
+    'dia_aspire': 0.5,
+    'irt_alignment': 0.9,
+    'fragpipe_api': 0.9,
+    'systemhc_api': 0.9,
+}
+
+# modules that must only be loaded once an alignment actually runs
+DEFERRED_MODULES = ['sklearn', 'statsmodels', 'scipy', 'matplotlib', 'seaborn', 'pyprophet']
+
+_PROBE = """
+import sys, time, json
+sys.path[:0] = [{root!r}, {src!r}]
+t0 = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - t0
+loaded = sorted({{m.split('.')[0] for m in sys.modules}} & set({deferred!r}))
+print(json.dumps([seconds, loaded]))
+"""
+
+
+def measure(module, repeat=3):
+    """
+    Cold import time of `module`, best of `repeat` fresh interpreters
+
+    Returns:
+    --------
+    tuple
+        (seconds, deferred modules it loaded), or (None, error message)
+        when the module cannot be imported here
+    """
+    best = None
+    for _ in range(repeat):
+        code = _PROBE.format(root=ROOT_DIR, src=SRC_DIR, module=module, deferred=DEFERRED_MODULES)
+        proc = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+        if proc.returncode != 0:
+            return None, proc.stderr.strip().splitlines()[-1]
+        seconds, loaded = json.loads(proc.stdout.strip().splitlines()[-1])
+        best = (seconds, loaded) if best is None or seconds < best[0] else best
+    return best
+
+
+def check(budget=IMPORT_BUDGET, repeat=3):
+    """Print the import time of every module of `budget`; returns False when one is over budget or loads a deferred module"""
+    ok = True
+    for module, limit in budget.items():
+        seconds, loaded = measure(module, repeat)
+        if seconds is None:
+            print(f"{module}: skipped, not importable here ({loaded})")
+            continue
+        status = 'ok'
+        if seconds > limit:
+            status = f'OVER BUDGET ({limit:.2f} s)'
+            ok = False
+        if loaded:
+            status += f", loads {', '.join(loaded)} at import"
+            ok = False
+        print(f"{module}: {seconds:.3f} s {status}")
+    return ok
+
+
+# Allow the budget to be checked from the command line, exits with 1 when it is exceeded
+if __name__ == "__main__":
+    modules = sys.argv[1:]
+    budget = {m: IMPORT_BUDGET.get(m, 1.0) for m in modules} if modules else IMPORT_BUDGET
+    sys.exit(0 if check(budget) else 1)
@@ -0,0 +1,284 @@
+# instrument.py - Wall time, CPU time, peak memory and row counts of the pipeline stages, in a JSON run report
+
+import contextlib
+import json
+import os
+import signal
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+REPORT_FILE = 'dia_aspire_report.json'
+# stages recorded by the pipeline, in running order
+STAGES = ['library_load', 'sptxt_parse', 'fragment_decode', 'top_n', 'dedup_merge', 'irt_load', 'lowess_fit',
+          'tsv_write', 'diann_run']
+# bump whenever the report layout changes, reports of another version are replaced
+REPORT_VERSION = '1'
+# "<stage>" or "<stage>:py-spy": stage profiled with cProfile (or py-spy), also in child processes
+PROFILE_ENV = 'DIA_ASPIRE_PROFILE'
+PROFILERS = ['cprofile', 'py-spy']
+
+# active recorders, innermost last, and the stages open in this process
+_recorders = []
+_open = []
+_profiles = {}
+
+
+def _fold_peak():
+    """Keep the peak reached so far in the open stages, before it is reset or read"""
+    peak = peak_rss()
+    for outer in _open:
+        outer['_peak'] = max(outer['_peak'], peak)
+
+
+def peak_rss():
+    """Peak resident set of this process in bytes, since the last _reset_peak where supported"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        # kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return 0
+
+
+def _reset_peak():
+    # Linux resets the peak of /proc/self/status on writing 5 to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _cpu_seconds():
+    """CPU time of this process and of its waited-for children"""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class Recorder:
+    """
+    Measurements of the stages run while it is active, summed per stage name
+
+    A stage run several times (e.g. once per batch) is kept as one record
+    with the number of calls, the total wall and CPU time, the highest peak
+    RSS and the total rows.
+    """
+
+    def __init__(self, output_dir=None):
+        self.output_dir = output_dir
+        self.stages = {}
+
+    def add(self, record):
+        total = self.stages.get(record['stage'])
+        if total is None:
+            self.stages[record['stage']] = dict(record)
+            return
+        total['calls'] += record['calls']
+        total['seconds'] += record['seconds']
+        total['cpu_seconds'] += record['cpu_seconds']
+        total['peak_rss_mb'] = max(total['peak_rss_mb'], record['peak_rss_mb'])
+        if record.get('rows') is not None:
+            total['rows'] = (total.get('rows') or 0) + record['rows']
+        if record.get('error'):
+            total['error'] = record['error']
+
+    def records(self):
+        return [{**r, 'seconds': round(r['seconds'], 3), 'cpu_seconds': round(r['cpu_seconds'], 3)}
+                for r in self.stages.values()]
+
+
+def add(records):
+    """Add stage records measured elsewhere (e.g. returned by a worker process) to the active recorder"""
+    if not _recorders:
+        return
+    # records of a worker process belong to the stage open here
+    parent = _open[-1]['stage'] if _open else None
+    for record in records:
+        _recorders[-1].add({**record, 'parent': record.get('parent') or parent})
+
+
+def profile_setting():
+    """(stage, profiler) of PROFILE_ENV, (None, None) when unset"""
+    spec = os.environ.get(PROFILE_ENV, '')
+    if not spec:
+        return None, None
+    name, _, tool = spec.partition(':')
+    tool = tool or 'cprofile'
+    if name not in STAGES:
+        raise ValueError(f"unknown stage {name}, expected one of {STAGES}")
+    if tool not in PROFILERS:
+        raise ValueError(f"unknown profiler {tool}, expected one of {PROFILERS}")
+    return name, tool
+
+
+def set_profile(spec):
+    """Profile the stage of `spec` ('<stage>' or '<stage>:<profiler>') in this process and the processes it starts"""
+    os.environ[PROFILE_ENV] = spec
+    try:
+        return profile_setting()
+    except ValueError:
+        del os.environ[PROFILE_ENV]
+        raise
+
+
+@contextlib.contextmanager
+def _profiled(name):
+    """Run the block under the profiler of PROFILE_ENV when it names this stage"""
+    target, tool = profile_setting()
+    if target != name:
+        yield
+        return
+    out_dir = _recorders[-1].output_dir if _recorders and _recorders[-1].output_dir else os.getcwd()
+    path = os.path.join(out_dir, f'profile_{name}_{os.getpid()}')
+    if tool == 'py-spy':
+        exe = shutil.which('py-spy')
+        if exe is None:
+            print("Warning: py-spy not found, stage not profiled")
+            yield
+            return
+        spy = subprocess.Popen([exe, 'record', '--pid', str(os.getpid()), '--output', f'{path}.svg'],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            yield
+        finally:
+            # py-spy writes its flame graph when interrupted
+            spy.send_signal(signal.SIGINT)
+            spy.wait()
+        return
+    import cProfile
+    # the calls of a stage run repeatedly are added up in one profile
+    profile = _profiles.setdefault(name, cProfile.Profile())
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(f'{path}.prof')
+
+
+@contextlib.contextmanager
+def stage(name, rows=None):
+    """
+    Measure a pipeline stage
+
+    Records the wall time, the CPU time (of this process and the children it
+    waited for), the peak RSS and the rows of the block, e.g.
+
+        with instrument.stage('tsv_write') as s:
+            s['rows'] = len(da)
+
+    The peak RSS is that of the stage where Linux lets the high-water mark be
+    reset, otherwise the process peak up to the end of the stage; a stage
+    waiting for an external command may set 'peak_rss_mb' to the command's. Outside a
+    recorder (see report and capture) only the profiler hook applies.
+    """
+    if not _recorders:
+        record = {'rows': rows}
+        with _profiled(name):
+            yield record
+        return
+    _fold_peak()
+    _reset_peak()
+    record = {'stage': name, 'parent': _open[-1]['stage'] if _open else None, 'calls': 1, 'rows': rows,
+              '_peak': 0}
+    _open.append(record)
+    t0 = time.perf_counter()
+    c0 = _cpu_seconds()
+    try:
+        with _profiled(name):
+            yield record
+    except BaseException as e:
+        record.setdefault('error', str(e) or type(e).__name__)
+        raise
+    finally:
+        record['seconds'] = time.perf_counter() - t0
+        record['cpu_seconds'] = _cpu_seconds() - c0
+        _fold_peak()
+        _open.remove(record)
+        record['peak_rss_mb'] = max(round(record.pop('_peak') / 1024 ** 2, 1), record.get('peak_rss_mb') or 0)
+        if _recorders:
+            _recorders[-1].add(record)
+
+
+@contextlib.contextmanager
+def capture():
+    """Record the stages run in the block on their own; yields the Recorder, whose records() can be add()ed later"""
+    recorder = Recorder(_recorders[-1].output_dir if _recorders else None)
+    _recorders.append(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorders.remove(recorder)
+
+
+def load_report(output_dir):
+    """Run report of `output_dir`, an empty one when missing or of another version"""
+    try:
+        with open(os.path.join(output_dir, REPORT_FILE), 'r') as f:
+            data = json.load(f)
+        if data.get('version') == REPORT_VERSION:
+            return data
+    except (OSError, ValueError):
+        pass
+    return {'version': REPORT_VERSION, 'sections': {}}
+
+
+def save_section(output_dir, section, data):
+    """Store `data` as `section` of the run report of `output_dir`, replacing the previous one"""
+    path = os.path.join(output_dir, REPORT_FILE)
+    report = load_report(output_dir)
+    report['host'] = socket.gethostname()
+    report['sections'][section] = data
+    os.makedirs(output_dir, exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp, path)
+    return path
+
+
+@contextlib.contextmanager
+def report(output_dir, section):
+    """
+    Record the stages run in the block as `section` of the run report of `output_dir`
+
+    The section holds the start, wall and CPU time, peak RSS (of the process
+    or of a command a stage waited for) and outcome of the block and its
+    stage records in order of first call; it is written when the block ends,
+    also when it fails.
+    """
+    recorder = Recorder(output_dir)
+    _recorders.append(recorder)
+    # collects the peak RSS of the whole block, the stages in it reset the process high-water mark
+    top = {'stage': None, '_peak': 0}
+    _open.append(top)
+    started = time.strftime('%Y-%m-%d %H:%M:%S')
+    t0 = time.perf_counter()
+    c0 = _cpu_seconds()
+    error = None
+    try:
+        yield recorder
+    except BaseException as e:
+        error = str(e) or type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - t0
+        cpu_seconds = _cpu_seconds() - c0
+        _fold_peak()
+        _open.remove(top)
+        _recorders.remove(recorder)
+        peak = max([top['_peak'] / 1024 ** 2] + [r['peak_rss_mb'] for r in recorder.stages.values()])
+        save_section(output_dir, section, {
+            'started': started, 'seconds': round(seconds, 3), 'cpu_seconds': round(cpu_seconds, 3),
+            'peak_rss_mb': round(peak, 1), 'pid': os.getpid(),
+            'python': sys.version.split()[0], 'error': error, 'stages': recorder.records()})
@@ -1,101 +1,134 @@
 import warnings
 # from .util import timestamped_echo
 
-try:
-    import matplotlib
-    matplotlib.use('Agg')
-    import matplotlib.pyplot as plt
-except ImportError:
-    plt = None
-
 import click
-import os
-import sys
-import pathlib
-import posixpath, ntpath
-import re
-import operator
 import numpy as np
 import pandas as pd
 
-# alignment
-from sklearn import preprocessing
-import sklearn.isotonic
-import sklearn.linear_model
-import statsmodels.api as sm
-from scipy.interpolate import interp1d
-
-try:
-    
-    from pyprophet.stats import pemp, qvalue, pi0est
-    from pyprophet.ipf import compute_model_fdr
-except ModuleNotFoundError:
-    pass
-
-from scipy.stats import gaussian_kde
-from numpy import linspace, concatenate
-from seaborn import lmplot
+import instrument
+import modifications
+from rt_model import MonotoneCurve, AlignmentModel, alignment_stats
 
 from datetime import datetime
-import click
+
+# The alignment stacks (statsmodels, scikit-learn) take seconds to import, so
+# they are imported by the functions that fit, on the first alignment only;
+# importing this module (and the GUI or the merge APIs) stays cheap.
 
 def timestamped_echo(message):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     click.echo(f"{timestamp} - {message}")
 
     
-def lowess_iso(x, y, lowess_frac):
-    with warnings.catch_warnings():
-        warnings.filterwarnings('ignore', message='invalid value encountered in ', category=RuntimeWarning)
-        lwf = sm.nonparametric.lowess(y, x.ravel(), frac=lowess_frac)
-    while pd.isna(lwf[:, 1]).any():
-        lowess_frac *= 2
-        lwf = sm.nonparametric.lowess(y, x.ravel(), frac=lowess_frac)
+# Accuracy-versus-speed presets of the alignment engine: the LOWESS is fitted on at
+# most `max_anchors` points (medians of equally populated RT bins) and `delta`, as a
+# fraction of the RT range, lets LOWESS interpolate between nearby points
+ALIGNMENT_PRECISION = {
+    'exact': {'max_anchors': None, 'delta': 0.0},
+    'balanced': {'max_anchors': 20000, 'delta': 0.0},
+    'fast': {'max_anchors': 5000, 'delta': 0.002},
+}
+
+def rt_anchors(x, y, n_anchors):
+    """Median (x, y) of `n_anchors` equally populated bins along x"""
+    order = np.argsort(x, kind='stable')
+    bins = np.arange(len(x)) * n_anchors // len(x)
+    med = pd.DataFrame({'x': x[order], 'y': y[order], 'bin': bins}).groupby('bin').median()
+    return med['x'].to_numpy(), med['y'].to_numpy()
+
+def _sm_lowess(*args, **kwargs):
+    from statsmodels.nonparametric.smoothers_lowess import lowess as sm_lowess
+    return sm_lowess(*args, **kwargs)
+
+def _monotone_curve(lwf):
+    from sklearn.isotonic import IsotonicRegression
     lwf_x = lwf[:, 0]
-    ir = sklearn.isotonic.IsotonicRegression()  # make the regression strictly increasing
+    ir = IsotonicRegression()  # make the regression strictly increasing
     lwf_y = ir.fit_transform(lwf_x, lwf[:, 1])
     mask = np.concatenate([[True], np.diff(lwf_y) != 0])  # remove non increasing points
     try:
-        return interp1d(lwf_x[mask], lwf_y[mask], bounds_error=False, fill_value="extrapolate")
+        return MonotoneCurve(lwf_x[mask], lwf_y[mask])
     except ValueError as e:
         timestamped_echo(e)
-    return interp1d(lwf_x, lwf_y, bounds_error=False, fill_value="extrapolate")
-
-class LowessIsoEstimator:
-    def __init__(self, lowess_frac):
-        self.lowess_frac = lowess_frac
-
-    def fit(self, x, y):
-        self.lwi = lowess_iso(x, y, self.lowess_frac)
-        return self
-
-    def get_params(self, deep=False):
-        return {'lowess_frac': self.lowess_frac}
-
-    def set_params(self, lowess_frac):
-        self.lowess_frac = lowess_frac
-        return self
-
-    def score(self, x, y):
-        resid = self.lwi(x.ravel()) - y
-        return 1 / resid.dot(resid)
-
-    def predict(self, x):
-        return self.lwi(x.ravel())
-
-    def __repr__(self):
-        return str(self.get_params())
-
-def lowess_iso_predictor(filename, x, y, xpred):
-    gsc = sklearn.model_selection.GridSearchCV(LowessIsoEstimator(None), {'lowess_frac': [0.01, 0.02, 0.04, 0.08]},
-                                             cv=sklearn.model_selection.KFold(4, shuffle=True, random_state=0),
-                                             n_jobs=min(os.cpu_count(), 61))
-
-    gsc.fit(x.reshape(-1, 1), y)
-    timestamped_echo(f'Info: {filename}; Lowess fraction used: {gsc.best_params_["lowess_frac"]}.')
-    return gsc.best_estimator_.predict(xpred)
-      
-def lowess(run, reference_run, xcol, ycol, lowess_frac, psm_fdr_threshold, min_peptides, filename, main_path):
+    return MonotoneCurve(lwf_x, lwf_y)
+
+def _fit_points(x, y, settings):
+    if settings['max_anchors'] and len(x) > settings['max_anchors']:
+        x, y = rt_anchors(x, y, settings['max_anchors'])
+    delta = settings['delta'] * (np.ptp(x) if len(x) else 0)
+    return x, y, delta
+
+def lowess_iso(x, y, lowess_frac, precision='exact'):
+    """LOWESS + isotonic fit of y on x as a MonotoneCurve, with the ALIGNMENT_PRECISION preset `precision`"""
+    x = np.asarray(x, dtype=float).ravel()
+    y = np.asarray(y, dtype=float)
+    x, y, delta = _fit_points(x, y, ALIGNMENT_PRECISION[precision])
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='invalid value encountered in ', category=RuntimeWarning)
+        lwf = _sm_lowess(y, x, frac=lowess_frac, delta=delta)
+    while pd.isna(lwf[:, 1]).any():
+        lowess_frac *= 2
+        lwf = _sm_lowess(y, x, frac=lowess_frac, delta=delta)
+    return _monotone_curve(lwf)
+
+# candidate fractions of the automatic LOWESS fraction selection (lowess_frac=0)
+LOWESS_FRACS = [0.01, 0.02, 0.04, 0.08]
+# cross-validation fits compute at most about this many local regressions (LOWESS delta)
+CV_FIT_POINTS = 500
+
+def select_lowess_frac(x, y, fracs=LOWESS_FRACS, n_folds=4, precision='exact', random_state=0):
+    """
+    Choose the LOWESS fraction by K-fold cross-validation
+
+    Scores are the same as the former GridSearchCV over the LOWESS + isotonic
+    fit (mean inverse squared residual of the held-out fold), but everything
+    is done in this process: each training fold is sorted (and reduced to
+    anchors) once and shared by all candidate fractions, the LOWESS is told
+    the data is already sorted, and its delta limits every fit to about
+    CV_FIT_POINTS local regressions whatever the overlap size. Only the
+    final fit with the chosen fraction uses the full `precision` setting.
+
+    Parameters:
+    -----------
+    x, y : array-like
+        RTs of the run and of the reference for the overlapping precursors
+    fracs : list
+        Candidate fractions
+    n_folds : int
+        Number of folds
+    precision : str
+        ALIGNMENT_PRECISION preset used for the fits
+    random_state : int
+        Seed of the fold shuffling
+
+    Returns:
+    --------
+    float
+        The fraction with the best cross-validated score
+    """
+    from sklearn.model_selection import KFold
+    x = np.asarray(x, dtype=float).ravel()
+    y = np.asarray(y, dtype=float)
+    settings = ALIGNMENT_PRECISION[precision]
+    scores = np.zeros(len(fracs))
+    for train, test in KFold(n_folds, shuffle=True, random_state=random_state).split(x):
+        order = np.argsort(x[train], kind='stable')
+        xs, ys, delta = _fit_points(x[train][order], y[train][order], settings)
+        delta = max(delta, np.ptp(xs) / CV_FIT_POINTS)
+        for i, frac in enumerate(fracs):
+            with warnings.catch_warnings():
+                warnings.filterwarnings('ignore', message='invalid value encountered in ', category=RuntimeWarning)
+                lwf = _sm_lowess(ys, xs, frac=frac, delta=delta, is_sorted=True)
+            while pd.isna(lwf[:, 1]).any():
+                frac *= 2
+                lwf = _sm_lowess(ys, xs, frac=frac, delta=delta, is_sorted=True)
+            resid = _monotone_curve(lwf)(x[test]) - y[test]
+            scores[i] += 1 / resid.dot(resid) / n_folds
+    return fracs[int(np.argmax(scores))]
+
+def fit_run_alignment(run, reference_run, xcol, ycol, lowess_frac, psm_fdr_threshold, min_peptides, filename,
+                      precision='exact'):
+    """Fit the alignment of one run onto the reference, None when too few peptides overlap"""
   # Filter alignment data
     run_alignment = run[run['q_value'] < psm_fdr_threshold] if 'q_value' in run else run
     
@@ -108,45 +141,54 @@ def lowess(run, reference_run, xcol, ycol, lowess_frac, psm_fdr_threshold, min_p
     timestamped_echo(f'Info: {filename}; Peptide overlap between run and reference: {dfm.shape[0]}.')
     if dfm.shape[0] <= min_peptides:
         timestamped_echo(f'Info: {filename}; Skipping run because not enough peptides could be found for alignment.')
+        return None
+    return fit_points(dfm[xcol].to_numpy(), dfm[ycol].to_numpy(), lowess_frac, precision, filename)
+      
+def lowess(run, reference_run, xcol, ycol, lowess_frac, psm_fdr_threshold, min_peptides, filename, main_path,
+           precision='exact'):
+    model = fit_run_alignment(run, reference_run, xcol, ycol, lowess_frac, psm_fdr_threshold, min_peptides, filename,
+                              precision)
+    if model is None:
         return pd.DataFrame()
-
-    if dfm.shape[0] < 50:  # use linear regression for small reference size
-        linreg = sklearn.linear_model.LinearRegression().fit(dfm[xcol].to_numpy().reshape(-1, 1), dfm[ycol])
-        run[ycol] = linreg.predict(run[xcol].to_numpy().reshape(-1, 1))
-    else:
-    # Fit and apply the lowess model
-        run[ycol] = lowess_iso_predictor(filename, dfm[xcol].to_numpy(), dfm[ycol].to_numpy(), run[xcol].to_numpy()) \
-        if lowess_frac == 0 else \
-        lowess_iso(dfm[xcol].to_numpy(), dfm[ycol].to_numpy(), lowess_frac)(run[xcol].to_numpy())
-
+    run[ycol] = model.predict(run[xcol].to_numpy())
     return run
 
 def submod(text):
-    t1 = re.sub('M\[147\]', 'M(UniMod:35)', text)
-    t2 = re.sub('S\[167\]', 'S(UniMod:21)', t1)
-    t3 = re.sub('T\[181\]', 'T(UniMod:21)', t2)
-    t4 = re.sub('Y\[243\]', 'Y(UniMod:21)', t3)
-    t5 = re.sub('N\[115\]', 'N(UniMod:7)', t4)
-    t6 = re.sub('Q\[129\]', 'Q(UniMod:7)', t5)
-    t7 = re.sub('S\[129\]', 'Q(UniMod:1)', t6)
-    t8 = re.sub('n\[43\]', '(UniMod:1)', t7)
-    return t8 
-
-def lowess2(run, reference_run, xcol, ycol, lowess_frac, psm_fdr_threshold, min_peptides):
-  # Filter alignment data
-    run_alignment = run
-    
-    reference_run_alignment = reference_run
-
-    dfm = pd.merge(run_alignment, reference_run_alignment, on=['modified_peptide','precursor_charge'])
+    return modifications.translate(text)
+
+def fit_points(x, y, lowess_frac, precision='exact', label='SysteMHC'):
+    """
+    Fit the mapping of RTs `x` onto reference RTs `y` of the same precursors as an AlignmentModel
+
+    Below 50 points a linear regression is used, otherwise the LOWESS +
+    isotonic curve (lowess_frac=0 selects the fraction by cross-validation).
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    with instrument.stage('lowess_fit', rows=len(x)):
+        if len(x) < 50:  # use linear regression for small reference size
+            from sklearn.linear_model import LinearRegression
+            linreg = LinearRegression().fit(x.reshape(-1, 1), y)
+            model = AlignmentModel.linear(linreg.coef_[0], linreg.intercept_)
+        else:
+            if lowess_frac == 0:
+                lowess_frac = select_lowess_frac(x, y, precision=precision)
+                timestamped_echo(f'Info: {label}; Lowess fraction used: {lowess_frac}.')
+            model = AlignmentModel.from_curve(lowess_iso(x, y, lowess_frac, precision))
+    model.meta.update({'lowess_frac': lowess_frac, 'precision': precision, 'n_overlap': int(len(x))})
+    model.stats = alignment_stats(model.predict(x), y)
+    return model
+
+def fit_alignment(run, reference_run, xcol, ycol, lowess_frac, precision='exact'):
+    """Fit the mapping of `run` RTs onto `reference_run` RTs (matched on modified_peptide and precursor_charge)"""
+    dfm = pd.merge(run, reference_run, on=['modified_peptide','precursor_charge'])
     timestamped_echo(f'Info: Peptide overlap between SysteMHC and reference: {dfm.shape[0]}.')
-
-    if dfm.shape[0] < 50:  # use linear regression for small reference size
-        linreg = sklearn.linear_model.LinearRegression().fit(dfm[xcol].to_numpy().reshape(-1, 1), dfm[ycol])
-        run[ycol] = linreg.predict(run[xcol].to_numpy().reshape(-1, 1))
-    else:
-    # Fit and apply the lowess model
-        run[ycol] = lowess_iso_predictor(filename, dfm[xcol].to_numpy(), dfm[ycol].to_numpy(), run[xcol].to_numpy()) \
-        if lowess_frac == 0 else \
-        lowess_iso(dfm[xcol].to_numpy(), dfm[ycol].to_numpy(), lowess_frac)(run[xcol].to_numpy())
-    return run
\ No newline at end of file
+    return fit_points(dfm[xcol].to_numpy(), dfm[ycol].to_numpy(), lowess_frac, precision)
+
+def lowess2(run, reference_run, xcol, ycol, lowess_frac, psm_fdr_threshold, min_peptides, precision='exact',
+            model=None):
+    # Fit the alignment unless a fitted model is given, then apply it to the whole run
+    if model is None:
+        model = fit_alignment(run, reference_run, xcol, ycol, lowess_frac, precision)
+    run[ycol] = model.predict(run[xcol].to_numpy())
+    return run
@@ -0,0 +1,289 @@
+# irt_store.py - Indexed binary store of the SysteMHC iRT reference
+
+import json
+import os
+import shutil
+import sys
+import numpy as np
+import pandas as pd
+
+import library_cache
+
+# bump whenever the store layout changes, stores of another version are rebuilt
+STORE_VERSION = '2'
+
+IRT_FILE = 'irt_SYSTEMHC.csv'
+STORE_SUFFIX = '.irtidx'
+# reference shipped next to the pipeline modules (unzipped irt_SYSTEMHC.zip)
+DEFAULT_IRT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), IRT_FILE)
+# stores built on demand are kept in the library cache, keyed by the content of their CSV
+STORE_DIR = 'irt_stores'
+
+_ARRAYS = ['peptides', 'charges', 'rt', 'row']
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _encode(peptides):
+    # fixed-width ASCII byte strings, comparable with the stored peptides
+    return pd.Series(peptides, dtype=object).astype(str).to_numpy().astype('S')
+
+
+class IrtStore:
+    """
+    Memory-mapped SysteMHC iRT reference sorted by precursor
+
+    The reference is kept as .npy arrays (fixed-width peptide byte strings,
+    int8 charges, float64 RTs and the row number in the source CSV) sorted by
+    (modified peptide, charge). Opening a store maps the arrays without
+    parsing anything, and a lookup is a binary search per queried precursor,
+    so only the rows of the requested precursors are ever read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        for name in _ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'))
+
+    @classmethod
+    def in_memory(cls, csv_path):
+        """Store of `csv_path` held in memory, when no store can be written"""
+        store = cls.__new__(cls)
+        store.path = csv_path
+        arrays, store.meta = _index_csv(csv_path)
+        for name, arr in arrays.items():
+            setattr(store, name, arr)
+        return store
+
+    def __len__(self):
+        return len(self.rt)
+
+    @property
+    def digest(self):
+        """Content hash of the source CSV"""
+        return self.meta.get('digest')
+
+    @property
+    def columns(self):
+        """Column names of the source CSV (peptide, charge, RT)"""
+        return self.meta['columns']
+
+    def find(self, peptides, charges):
+        """
+        Store rows of the given precursors
+
+        Parameters:
+        -----------
+        peptides : array-like
+            Modified sequences
+        charges : array-like
+            Precursor charges, paired with `peptides`
+
+        Returns:
+        --------
+        numpy.ndarray
+            Positions of all matching rows (duplicates included), in source CSV order
+        """
+        charges = pd.to_numeric(pd.Series(charges), errors='coerce').to_numpy(dtype=float)
+        valid = pd.notna(pd.Series(peptides)).to_numpy() & np.isfinite(charges)
+        query = _encode(np.asarray(peptides, dtype=object)[valid])
+        charges = charges[valid]
+        lo = np.searchsorted(self.peptides, query, side='left')
+        hi = np.searchsorted(self.peptides, query, side='right')
+        # expand every peptide hit to its rows, then keep the rows of the queried charge
+        n = hi - lo
+        idx = np.repeat(lo, n) + np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        idx = idx[self.charges[idx] == np.repeat(charges, n)]
+        idx = np.unique(idx)
+        return idx[np.argsort(self.row[idx], kind='stable')]
+
+    def lookup(self, peptides, charges):
+        """Reference rows of the given precursors as a DataFrame with the source CSV columns"""
+        return self.frame(self.find(peptides, charges))
+
+    def frame(self, rows=None):
+        """DataFrame of the given store rows (all rows in source CSV order when None)"""
+        if rows is None:
+            rows = np.argsort(self.row, kind='stable')
+        pep_col, charge_col, rt_col = self.columns
+        return pd.DataFrame({pep_col: self.peptides[rows].astype(str).astype(object),
+                             charge_col: self.charges[rows].astype(np.int64),
+                             rt_col: self.rt[rows]})
+
+    def __repr__(self):
+        return f'IrtStore({len(self)} rows, {self.path})'
+
+
+def store_path(csv_path):
+    """Location of the store built ahead of time from `csv_path`, next to it"""
+    return os.path.splitext(csv_path)[0] + STORE_SUFFIX
+
+
+def cache_store_path(csv_path, cache_dir=None):
+    """Location of the store of `csv_path` in the library cache, keyed by the CSV content"""
+    try:
+        digest = library_cache.LibraryCache(cache_dir or library_cache.DEFAULT_CACHE_DIR).content_hash(csv_path)
+    except OSError:
+        # the cache is not writable, the store is not written either
+        digest = library_cache.file_digest(csv_path)
+    # named by version too, so a store in the cache is never replaced, only added
+    return os.path.join(cache_dir or library_cache.DEFAULT_CACHE_DIR, STORE_DIR,
+                        f'irt-{digest}-v{STORE_VERSION}{STORE_SUFFIX}')
+
+
+def _index_csv(csv_path):
+    """(sorted arrays, meta) of the store of an iRT reference CSV"""
+    da = pd.read_csv(csv_path)
+    if da.shape[1] != 3:
+        raise ValueError(f"Expected 3 columns (peptide, charge, RT) in {csv_path}, found {da.shape[1]}")
+    peptides = _encode(da.iloc[:, 0])
+    charges = da.iloc[:, 1].to_numpy().astype(np.int8)
+    order = np.lexsort((charges, peptides))
+    arrays = {'peptides': peptides[order], 'charges': charges[order],
+              'rt': da.iloc[:, 2].to_numpy(dtype=np.float64)[order], 'row': order.astype(np.int64)}
+    meta = {'version': STORE_VERSION, 'source': os.path.abspath(csv_path), 'stamp': _stamp(csv_path),
+            'digest': library_cache.file_digest(csv_path),
+            'columns': [str(c) for c in da.columns]}
+    return arrays, meta
+
+
+def _same_store(path, meta):
+    """Whether `path` holds a store of this STORE_VERSION built from the CSV content of `meta`"""
+    try:
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            found = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return found.get('version') == meta['version'] and found.get('digest') == meta['digest']
+
+
+def build_store(csv_path, path=None):
+    """
+    Build the indexed store of an iRT reference CSV
+
+    Parameters:
+    -----------
+    csv_path : str
+        Reference CSV with modified peptide, charge and RT columns
+    path : str, optional
+        Store directory to write; defaults to store_path (next to the CSV)
+
+    Returns:
+    --------
+    str
+        Path to the store directory
+    """
+    path = path or store_path(csv_path)
+    arrays, meta = _index_csv(csv_path)
+
+    # write to a temporary directory and swap it in, readers never see a partial store
+    tmp = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(tmp, exist_ok=True)
+    try:
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp, f'{name}.npy'), arr)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    # another process may have built the same store meanwhile, it is used as it is
+    if _same_store(path, meta):
+        shutil.rmtree(tmp, ignore_errors=True)
+        return path
+    if os.path.exists(path):
+        # a store of another version or CSV is moved aside first, readers already using it keep their maps
+        old = f'{path}.{os.getpid()}.old'
+        try:
+            os.replace(path, old)
+            shutil.rmtree(old, ignore_errors=True)
+        except FileNotFoundError:
+            pass
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not _same_store(path, meta):
+            raise
+    return path
+
+
+def open_store(path, cache_dir=None):
+    """
+    Open an iRT store, building it first when needed
+
+    `path` is either a store directory or a reference CSV. For a CSV, a
+    current store next to it (built ahead of time) is used, otherwise the
+    store of its content in the library cache, built when missing. When that
+    cannot be written (e.g. a read-only cache), the store is held in memory.
+    """
+    if os.path.isdir(path):
+        return IrtStore(path)
+    spath = store_path(path)
+    try:
+        store = IrtStore(spath)
+        if not os.path.exists(path):
+            return store
+        if store.meta.get('version') == STORE_VERSION and store.meta.get('stamp') == _stamp(path):
+            return store
+    except (OSError, ValueError, KeyError):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} not found")
+    cpath = cache_store_path(path, cache_dir)
+    try:
+        store = IrtStore(cpath)
+        if store.meta.get('version') == STORE_VERSION:
+            return store
+    except (OSError, ValueError, KeyError):
+        pass
+    print(f"Building iRT store for {path}")
+    try:
+        os.makedirs(os.path.dirname(cpath), exist_ok=True)
+        return IrtStore(build_store(path, cpath))
+    except OSError as e:
+        print(f"Warning: iRT store unavailable, reading {path} into memory - {str(e)}")
+        return IrtStore.in_memory(path)
+
+
+def find_reference(output_dir=None):
+    """
+    Locate the SysteMHC iRT reference
+
+    A copy of irt_SYSTEMHC.csv (or its store) in `output_dir` takes
+    precedence over the reference shipped with the pipeline.
+
+    Returns:
+    --------
+    str or None
+        Path to the reference CSV or store, None when there is none
+    """
+    candidates = []
+    if output_dir:
+        candidates.append(os.path.join(output_dir, IRT_FILE))
+    candidates.append(DEFAULT_IRT_PATH)
+    for csv_path in candidates:
+        if os.path.exists(csv_path) or os.path.isdir(store_path(csv_path)):
+            return csv_path
+    return None
+
+
+def open_reference(output_dir=None):
+    """Open the store of the SysteMHC iRT reference found by find_reference"""
+    path = find_reference(output_dir)
+    if path is None:
+        raise FileNotFoundError(f"{IRT_FILE} not found")
+    return open_store(path)
+
+
+# Allow the store to be built ahead of time from the command line
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python irt_store.py <irt_SYSTEMHC.csv> [store_dir]")
+        sys.exit(1)
+    store = IrtStore(build_store(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None))
+    print(f"Built {store}")
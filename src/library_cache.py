@@ -0,0 +1,195 @@
+# library_cache.py - Persistent cache of converted spectral libraries
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401
+    import pyarrow.parquet  # noqa: F401
+    CACHE_FORMAT = 'parquet'
+except ImportError:
+    CACHE_FORMAT = 'pkl'
+
+DEFAULT_CACHE_DIR = os.environ.get('DIA_ASPIRE_CACHE',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'dia-aspire', 'libraries'))
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+_HASH_INDEX = 'hash_index.json'
+
+
+def file_digest(path, chunk_size=16 * 1024 * 1024):
+    """blake2b digest of the file content"""
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class LibraryCache:
+    """
+    Columnar on-disk cache of converted libraries
+
+    Entries are keyed by the content hash of the source file, the name and
+    version of the converter and its parameters, so a changed input or a new
+    converter release never returns a stale library. Content hashes are
+    remembered per (path, size, mtime) to avoid re-reading unchanged inputs.
+    Entries are stored as Parquet when pyarrow is installed, otherwise as
+    pickled DataFrames, and the least recently used ones are evicted once the
+    cache exceeds `max_bytes`.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # libraries may be loaded from several threads at once
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _index_path(self):
+        return os.path.join(self.cache_dir, _HASH_INDEX)
+
+    def _load_index(self):
+        try:
+            with open(self._index_path(), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def content_hash(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        with self._lock:
+            entry = self._load_index().get(path)
+        if entry and entry['stamp'] == stamp:
+            return entry['hash']
+        digest = file_digest(path)
+        with self._lock:
+            index = self._load_index()
+            index[path] = {'stamp': stamp, 'hash': digest}
+            tmp = self._index_path() + f'.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp, self._index_path())
+        return digest
+
+    def key(self, path, converter, version, **params):
+        h = hashlib.blake2b(digest_size=20)
+        h.update(self.content_hash(path).encode())
+        h.update(json.dumps([converter, str(version), sorted(params.items())], default=str).encode())
+        return f'{converter}-{h.hexdigest()}'
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.{CACHE_FORMAT}')
+
+    def get(self, key):
+        path = self._entry_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            da = pd.read_parquet(path) if CACHE_FORMAT == 'parquet' else pd.read_pickle(path)
+        except Exception as e:
+            print(f"Warning: Dropping unreadable cache entry {path} - {str(e)}")
+            os.remove(path)
+            return None
+        os.utime(path)  # mark as recently used
+        return da
+
+    def put(self, key, da):
+        path = self._entry_path(key)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        if CACHE_FORMAT == 'parquet':
+            da.to_parquet(tmp)
+        else:
+            da.to_pickle(tmp)
+        os.replace(tmp, path)
+        with self._lock:
+            self.evict()
+        return path
+
+    def entries(self):
+        """Cache entries as (path, size, last use), most recently used first"""
+        out = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.' + CACHE_FORMAT):
+                p = os.path.join(self.cache_dir, name)
+                st = os.stat(p)
+                out.append((p, st.st_size, st.st_mtime))
+        return sorted(out, key=lambda e: e[2], reverse=True)
+
+    def evict(self):
+        total = 0
+        for p, size, _ in self.entries():
+            total += size
+            if total > self.max_bytes:
+                os.remove(p)
+
+    def clear(self):
+        for p, _, _ in self.entries():
+            os.remove(p)
+
+
+def cached(path, converter, version, loader, cache=None, **params):
+    """
+    Return loader(path, **params), served from the cache when possible
+
+    Parameters:
+    -----------
+    path : str
+        Source library file
+    converter : str
+        Name of the conversion, part of the cache key
+    version : str
+        Converter version; bump it whenever the converter output changes
+    loader : callable
+        Function doing the actual conversion
+    cache : LibraryCache, optional
+        Cache to use; None uses a LibraryCache at DEFAULT_CACHE_DIR, False
+        disables caching
+
+    Returns:
+    --------
+    pandas.DataFrame
+        The converted library
+    """
+    if cache is False:
+        return loader(path, **params)
+    try:
+        if cache is None:
+            cache = LibraryCache()
+        key = cache.key(path, converter, version, **params)
+        da = cache.get(key)
+    except OSError as e:
+        print(f"Warning: Library cache unavailable - {str(e)}")
+        return loader(path, **params)
+    if da is not None:
+        print(f"Loaded {path} from library cache")
+        return da
+    da = loader(path, **params)
+    try:
+        cache.put(key, da)
+    except Exception as e:
+        print(f"Warning: Failed to cache {path} - {str(e)}")
+    return da
+
+
+def read_tsv(path, cache=None):
+    """pd.read_csv(path, sep='\\t') through the library cache"""
+    return cached(path, 'tsv', 1, lambda p: pd.read_csv(p, sep='\t'), cache=cache)
+
+
+# Allow the cache to be inspected or cleared from the command line
+if __name__ == "__main__":
+    cache = LibraryCache()
+    if len(sys.argv) > 1 and sys.argv[1] == 'clear':
+        cache.clear()
+        print(f"Cleared library cache: {cache.cache_dir}")
+    else:
+        entries = cache.entries()
+        print(f"Library cache: {cache.cache_dir}")
+        print(f"{len(entries)} entries, {sum(e[1] for e in entries) / 1024 ** 2:.1f} MB")
@@ -0,0 +1,230 @@
+# library_schema.py - Compact typed representation of spectral library frames
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+import instrument
+import library_cache
+
+try:
+    import pyarrow.csv  # noqa: F401
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    CSV_ENGINE = 'c'
+
+# bump whenever the typed layout changes, it keys the library cache
+SCHEMA_VERSION = '2'
+
+# Repeated strings are stored once as categories
+CATEGORY_COLS = ['ProteinId', 'Protein_name', 'uniprot_id', 'GeneName',
+                 'PeptideSequence', 'StrippedPeptide', 'ModifiedPeptideSequence', 'ModifiedPeptide',
+                 'FragmentType', 'Annotation']
+BOOL_COLS = ['shared', 'decoy']
+INT8_COLS = ['PrecursorCharge', 'FragmentCharge']
+FLOAT32_COLS = ['LibraryIntensity', 'RelativeIntensity']
+FLOAT64_COLS = ['PrecursorMz', 'ProductMz', 'iRT', 'Tr_recalibrated', 'NormalizedRetentionTime']
+
+# dtypes the parser can produce directly; flags and charges are left to compact_frame
+COLUMN_DTYPES = dict([(c, 'category') for c in CATEGORY_COLS] + [(c, np.float32) for c in FLOAT32_COLS]
+                     + [(c, np.float64) for c in FLOAT64_COLS])
+
+# Columns describing a precursor rather than a fragment
+PRECURSOR_COLS = ['ModifiedPeptide', 'ModifiedPeptideSequence', 'PrecursorCharge', 'PrecursorMz',
+                  'StrippedPeptide', 'PeptideSequence', 'Protein_name', 'ProteinId', 'GeneName', 'uniprot_id',
+                  'iRT', 'Tr_recalibrated', 'NormalizedRetentionTime', 'PrecursorIonMobility', 'shared', 'decoy']
+
+_BOOL_VALUES = {'TRUE': True, 'FALSE': False, 'True': True, 'False': False, 'true': True, 'false': False,
+                True: True, False: False, 1: True, 0: False}
+
+
+def _to_bool(s):
+    if s.dtype == bool:
+        return s
+    mapped = s.map(_BOOL_VALUES)
+    if mapped.isna().any():
+        return s
+    return mapped.astype(bool)
+
+
+def compact_frame(da):
+    """
+    Convert a library frame to its compact dtypes
+
+    Protein, peptide and ion label strings become categoricals, shared/decoy
+    flags ('TRUE'/'FALSE') become booleans, charges int8 and intensities
+    float32 (7 significant digits). m/z and retention times keep float64.
+    Columns that cannot be converted losslessly (e.g. charges with missing
+    values) are left as they are.
+    """
+    da = da.copy()
+    for col in da.columns:
+        s = da[col]
+        if col in CATEGORY_COLS and s.dtype == object:
+            da[col] = s.astype('category')
+        elif col in BOOL_COLS:
+            da[col] = _to_bool(s)
+        elif col in INT8_COLS and pd.api.types.is_numeric_dtype(s) and not s.isna().any():
+            da[col] = s.astype(np.int8)
+        elif col in FLOAT32_COLS and pd.api.types.is_numeric_dtype(s):
+            da[col] = s.astype(np.float32)
+    return da
+
+
+def concat_frames(frames):
+    """pd.concat that keeps categorical columns categorical by unifying their categories"""
+    frames = [f for f in frames if f is not None]
+    if not frames:
+        return pd.DataFrame()
+    frames = [f.copy() for f in frames]
+    for col in frames[0].columns:
+        if all(col in f.columns and isinstance(f[col].dtype, pd.CategoricalDtype) for f in frames):
+            categories = union_categoricals([f[col] for f in frames]).categories
+            for f in frames:
+                f[col] = f[col].cat.set_categories(categories)
+    return pd.concat(frames)
+
+
+def read_header(path):
+    """Column names of a library TSV"""
+    with open(path, 'r') as f:
+        return f.readline().rstrip('\r\n').split('\t')
+
+
+def read_options(path, usecols=None):
+    """pd.read_csv keyword arguments reading `usecols` (those present in the file) with their typed dtypes"""
+    if usecols is not None:
+        usecols = [c for c in read_header(path) if c in set(usecols)]
+    dtype = {c: t for c, t in COLUMN_DTYPES.items() if usecols is None or c in usecols}
+    return {'sep': '\t', 'usecols': usecols, 'dtype': dtype}
+
+
+def _read_tsv(path, usecols=None, engine=None):
+    return compact_frame(pd.read_csv(path, engine=engine or CSV_ENGINE, **read_options(path, usecols)))
+
+
+def read_library(path, cache=None, usecols=None):
+    """
+    Read a library TSV into compact dtypes, through the library cache
+
+    Uses the multithreaded pyarrow CSV parser when pyarrow is installed.
+    `usecols` restricts the columns read (names missing from the file are
+    ignored), which is also part of the cache key.
+    """
+    if usecols is None:
+        return library_cache.cached(path, 'library', SCHEMA_VERSION, _read_tsv, cache=cache)
+    return library_cache.cached(path, 'library', SCHEMA_VERSION, _read_tsv, cache=cache, usecols=sorted(usecols))
+
+
+def read_libraries(paths, cache=None, usecols=None, workers=None):
+    """
+    Read several library TSVs concurrently
+
+    Parameters:
+    -----------
+    paths : list
+        Library TSV files
+    cache : LibraryCache or bool, optional
+        Passed to read_library
+    usecols : list, optional
+        Columns to read from every file
+    workers : int, optional
+        Number of reading threads; None reads all files at once (up to the CPU count)
+
+    Returns:
+    --------
+    list
+        (path, frame, seconds, error) per file in input order; frame is None
+        and error holds the exception when the file could not be read
+    """
+    def load(path):
+        t0 = time.perf_counter()
+        try:
+            return path, read_library(path, cache=cache, usecols=usecols), time.perf_counter() - t0, None
+        except Exception as e:
+            return path, None, time.perf_counter() - t0, e
+
+    if cache is None:
+        # one cache object, so the threads share its lock
+        try:
+            cache = library_cache.LibraryCache()
+        except OSError as e:
+            print(f"Warning: Library cache unavailable - {str(e)}")
+            cache = False
+    if workers is None:
+        workers = min(len(paths), os.cpu_count() or 1)
+    if workers <= 1 or len(paths) <= 1:
+        return [load(p) for p in paths]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(load, paths))
+
+
+def write_library(da, path, mode='w', header=True):
+    """Write a library frame as TSV, with boolean flags spelled 'TRUE'/'FALSE' (mode='a' appends)"""
+    with instrument.stage('tsv_write', rows=len(da)):
+        da = da.copy()
+        for col in BOOL_COLS:
+            if col in da.columns and (da[col].dtype == bool or da[col].dtype == object):
+                da[col] = [('TRUE' if v else 'FALSE') if isinstance(v, (bool, np.bool_)) else v for v in da[col]]
+        da.to_csv(path, sep='\t', index=False, mode=mode, header=header)
+    return path
+
+
+def memory_usage(da):
+    """Deep memory usage of a frame in bytes"""
+    return int(da.memory_usage(deep=True).sum())
+
+
+class SpectralLibrary:
+    """
+    Library split into one row per precursor and flat fragment arrays
+
+    `precursors` holds the precursor-level columns once, indexed by a dense
+    precursor id; `fragments` holds the remaining columns as flat arrays plus
+    the int32 `precursor_id` of every fragment, sorted by precursor.
+    """
+
+    def __init__(self, precursors, fragments):
+        self.precursors = precursors
+        self.fragments = fragments
+
+    @classmethod
+    def from_frame(cls, da, key_cols=('ModifiedPeptide', 'PrecursorCharge')):
+        da = compact_frame(da)
+        key_cols = [c for c in key_cols if c in da.columns]
+        prec_cols = [c for c in PRECURSOR_COLS if c in da.columns]
+        codes = da.groupby(key_cols, sort=True, observed=True).ngroup().to_numpy()
+        order = np.argsort(codes, kind='stable')
+        codes = codes[order]
+        da = da.iloc[order]
+        first = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        precursors = da.iloc[first][prec_cols].reset_index(drop=True)
+        fragments = da.drop(columns=prec_cols).reset_index(drop=True)
+        fragments.insert(0, 'precursor_id', codes.astype(np.int32))
+        return cls(precursors, fragments)
+
+    def to_frame(self):
+        """Fragment-level frame with the precursor columns broadcast back"""
+        ids = self.fragments['precursor_id'].to_numpy()
+        da = self.precursors.take(ids).reset_index(drop=True)
+        for col in self.fragments.columns.drop('precursor_id'):
+            da[col] = self.fragments[col].to_numpy()
+        return da
+
+    @property
+    def n_precursors(self):
+        return len(self.precursors)
+
+    def __len__(self):
+        return len(self.fragments)
+
+    def memory_usage(self):
+        return memory_usage(self.precursors) + memory_usage(self.fragments)
+
+    def __repr__(self):
+        return (f'SpectralLibrary({self.n_precursors} precursors, {len(self)} fragments, '
+                f'{self.memory_usage() / 1024 ** 2:.1f} MB)')
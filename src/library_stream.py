@@ -0,0 +1,127 @@
+# library_stream.py - Out-of-core merge of SysteMHC allele libraries
+
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import library_schema
+
+DEFAULT_CHUNKSIZE = 500000
+
+
+def _grow(flags, n):
+    if len(flags) < n:
+        flags = np.concatenate([flags, np.zeros(n - len(flags), dtype=bool)])
+    return flags
+
+
+def scan_precursors(systemhc_lib_paths, keys, chunksize=DEFAULT_CHUNKSIZE):
+    """Add the precursors of the SysteMHC libraries to `keys`, reading only the precursor columns"""
+    for libp in systemhc_lib_paths:
+        try:
+            for chunk in pd.read_csv(libp, chunksize=chunksize,
+                                     **library_schema.read_options(libp, ['ModifiedPeptide', 'PrecursorCharge'])):
+                keys.encode_frame(chunk, 'ModifiedPeptide')
+        except Exception:
+            # reported when the library is streamed
+            continue
+    return keys
+
+
+def stream_merge(output_path, sample_frame, sample_ids, systemhc_lib_paths, keys, prepare,
+                 rt=None, chunksize=DEFAULT_CHUNKSIZE, usecols=None):
+    """
+    Merge SysteMHC allele libraries into a TSV without loading them fully
+
+    The sample library is written first; each allele library is then read in
+    chunks of `chunksize` rows and only the rows of precursors that are not in
+    the sample library or in an earlier allele library are appended to the
+    output, once the whole library was read (a library failing part way adds
+    no rows). Exact duplicate rows inside a library are dropped as well. Memory
+    is bounded by one chunk, the precursor index and the row hashes of the
+    library being read, however many alleles are merged.
+
+    Parameters:
+    -----------
+    output_path : str
+        Merged library TSV to write
+    sample_frame : pandas.DataFrame
+        Sample library already in the output columns
+    sample_ids : numpy.ndarray
+        Precursor ids of the sample library rows
+    systemhc_lib_paths : list
+        SysteMHC library TSV files, in priority order
+    keys : PrecursorIndex
+        Index shared with the sample library
+    prepare : callable
+        Maps a chunk of SysteMHC rows to the output columns
+    rt : tuple, optional
+        (precursor ids, NormalizedRetentionTime) of the RT alignment; when given,
+        only precursors with an aligned RT are kept and it replaces their RT
+    chunksize : int
+        Rows read per chunk
+    usecols : list, optional
+        Columns read from the SysteMHC libraries
+
+    Returns:
+    --------
+    int
+        Number of SysteMHC rows written
+    """
+    sample_out = sample_frame.copy()
+    sample_out['ions'] = keys.labels(sample_ids)
+    library_schema.write_library(sample_out, output_path)
+    del sample_out
+
+    seen = keys.mask(sample_ids)
+    n_loaded = 0
+    n_written = 0
+    # rows of the library being read, appended to the output only once it was read completely
+    part_path = f'{output_path}.{os.getpid()}.part'
+    for libp in systemhc_lib_paths:
+        lib_ids = []
+        lib_hashes = np.empty(0, dtype=np.uint64)
+        n_rows = 0
+        try:
+            open(part_path, 'w').close()
+            for chunk in pd.read_csv(libp, chunksize=chunksize, **library_schema.read_options(libp, usecols)):
+                chunk = library_schema.compact_frame(chunk)
+                ids = keys.encode_frame(chunk, 'ModifiedPeptide')
+                seen = _grow(seen, len(keys))
+
+                hashes = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+                keep = ~pd.Series(hashes).duplicated().to_numpy() & ~np.isin(hashes, lib_hashes)
+                lib_hashes = np.union1d(lib_hashes, hashes)
+
+                keep &= ~np.append(seen, False).take(ids)
+                if rt is not None:
+                    nrt = keys.map_values(ids, rt[0], rt[1])
+                    keep &= ~np.isnan(nrt)
+                    chunk['NormalizedRetentionTime'] = nrt
+
+                ds2 = chunk[keep]
+                ds3 = prepare(ds2).copy()
+                ds3['ions'] = keys.labels(ids[keep])
+                library_schema.write_library(ds3, part_path, mode='a', header=False)
+                lib_ids.append(ids[keep])
+                n_rows += len(ds3)
+            with open(part_path, 'rb') as src, open(output_path, 'ab') as dst:
+                shutil.copyfileobj(src, dst)
+        except Exception as e:
+            # nothing of a library that fails part way is merged
+            print(f"Warning: Failed to load {libp} - {str(e)}")
+            continue
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        n_loaded += 1
+        n_written += n_rows
+        print(f"Merged SysteMHC library: {libp}")
+        if lib_ids:
+            seen[keys.mask(np.concatenate(lib_ids))[:len(seen)]] = True
+
+    if not n_loaded:
+        raise Exception("No valid SysteMHC libraries were loaded")
+    return n_written
@@ -0,0 +1,90 @@
+# log_buffer.py - Output of the running task batched for display, logged in full and read for progress
+
+import codecs
+import collections
+
+import progress
+
+# lines kept for display between two updates, and on screen
+MAX_LINES = 5000
+# milliseconds between display updates
+FLUSH_MS = 200
+
+
+class LogBuffer:
+    """
+    Output lines of a task, queued until the display takes them
+
+    Every line goes to the log file. Progress lines (see progress.parse_progress)
+    only update `progress`, the other lines are queued for display; when more
+    than `max_lines` are queued, the oldest are dropped and counted.
+
+    Parameters:
+    -----------
+    path : str, optional
+        Log file the lines are appended to
+    max_lines : int
+        Lines queued at most
+    """
+
+    def __init__(self, path=None, max_lines=MAX_LINES):
+        self.path = path
+        self.file = open(path, 'a', encoding='utf-8') if path else None
+        self.pending = collections.deque(maxlen=max_lines)
+        self.dropped = 0
+        self.partial = {}
+        self.decoders = {}
+        self.progress = None
+        self.progress_changed = False
+
+    def feed(self, data, stream='stdout'):
+        """Add raw output (bytes or str) of `stream`; complete lines are logged and queued"""
+        if isinstance(data, bytes):
+            decoder = self.decoders.setdefault(stream, codecs.getincrementaldecoder('utf-8')(errors='replace'))
+            data = decoder.decode(data)
+        *lines, self.partial[stream] = (self.partial.get(stream, '') + data).split('\n')
+        for line in lines:
+            self.add(line.rstrip('\r'), stream)
+
+    def end(self):
+        """Add the unterminated last lines of the streams, e.g. when the process has exited"""
+        for stream, line in list(self.partial.items()):
+            if line.strip():
+                self.add(line.rstrip('\r'), stream)
+        self.partial.clear()
+        self.decoders.clear()
+
+    def add(self, line, stream='stdout'):
+        """Add one line"""
+        if self.file is not None:
+            self.file.write(line + '\n')
+        stage = progress.parse_progress(line)
+        if stage is not None:
+            self.progress = stage
+            self.progress_changed = True
+            return
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+        self.pending.append((line, stream))
+
+    def take(self):
+        """(lines, dropped): the queued (line, stream) pairs and the number of older lines dropped since the last call"""
+        lines, dropped = list(self.pending), self.dropped
+        self.pending.clear()
+        self.dropped = 0
+        if self.file is not None:
+            self.file.flush()
+        return lines, dropped
+
+    def take_progress(self):
+        """Latest (step, total, stage) if it changed since the last call, else None"""
+        if not self.progress_changed:
+            return None
+        self.progress_changed = False
+        return self.progress
+
+    def close(self):
+        self.end()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
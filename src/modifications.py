@@ -0,0 +1,58 @@
+# modifications.py - Translation of SpectraST mass tags to UniMod notation
+
+import re
+import numpy as np
+import pandas as pd
+
+# SpectraST mass tag -> UniMod notation used in DIA-NN libraries
+MOD_TABLE = {
+    'M[147]': 'M(UniMod:35)',
+    'S[167]': 'S(UniMod:21)',
+    'T[181]': 'T(UniMod:21)',
+    'Y[243]': 'Y(UniMod:21)',
+    'N[115]': 'N(UniMod:7)',
+    'Q[129]': 'Q(UniMod:7)',
+    'S[129]': 'Q(UniMod:1)',
+    'n[43]': '(UniMod:1)',
+}
+
+
+class ModTranslator:
+    """
+    Translate mass-tagged peptides with a single compiled pattern
+
+    All tags of the table are joined into one alternation, so a peptide is
+    scanned once whatever the number of modifications. New PTMs are added by
+    passing an extended table, e.g. ModTranslator({**MOD_TABLE, 'K[170]': 'K(UniMod:34)'}).
+    """
+
+    def __init__(self, table=None):
+        self.table = dict(MOD_TABLE if table is None else table)
+        # longest tags first so that overlapping tags resolve to the most specific one
+        tags = sorted(self.table, key=len, reverse=True)
+        self.pattern = re.compile('|'.join(re.escape(tag) for tag in tags))
+
+    def translate(self, text):
+        return self.pattern.sub(lambda m: self.table[m.group(0)], text)
+
+    def translate_series(self, peptides):
+        """Translate a Series of peptides, each distinct sequence only once"""
+        codes, uniques = pd.factorize(peptides)
+        # trailing NaN is picked up by the -1 code of missing peptides
+        translated = np.array([self.translate(p) for p in uniques] + [np.nan], dtype=object)
+        return pd.Series(translated.take(codes), index=peptides.index, name=peptides.name)
+
+    def __repr__(self):
+        return f'ModTranslator({self.table})'
+
+
+_default_translator = ModTranslator()
+
+
+def translate(text):
+    return _default_translator.translate(text)
+
+
+def translate_series(peptides, table=None):
+    translator = _default_translator if table is None else ModTranslator(table)
+    return translator.translate_series(peptides)
@@ -0,0 +1,751 @@
+# pipeline.py - Headless DIA-Aspire pipeline: merge the libraries and run DIA-NN for many samples
+
+import contextlib
+import json
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+
+import diann_runner
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+DIANN_RUNNER = os.path.join(SRC_DIR, 'diann_runner.py')
+
+PIPELINES = ['FragPipe', 'SysteMHC']
+# merged library written by each pipeline's merge_libraries
+MERGED_LIBRARY = {'FragPipe': 'merged_Sample+SysteMHC_library.tsv',
+                  'SysteMHC': 'merged_Sample+SysteMHC_library_sptxt.tsv'}
+RT_ALIGNED = {'FragPipe': 'rt_aligned2reference.csv',
+              'SysteMHC': 'rt_aligned2reference_sptxt.csv'}
+# bump whenever a stage writes different outputs for the same inputs, it keys the checkpoints
+STAGE_VERSION = '1'
+DEFAULT_DIANN_PATH = diann_runner.DEFAULT_DIANN_PATH
+DIANN_OUT = 'lib-base-result'
+DEFAULT_DIANN_PARAMS = {
+    'threads': '32',
+    'verbose': '5',
+    'qvalue': '0.1',
+    'matrix-qvalue': '0.01',
+    'matrices': 'true',
+    'mass-acc': '15',
+    'mass-acc-ms1': '15',
+    'double-search': 'true',
+    'reanalyse': 'true',
+    'no-prot-inf': 'true',
+    'rt-profiling': 'true',
+    'pg-level': '1',
+    'report-lib-info': 'true'
+}
+
+SYSTEMHC_LIBRARY_URL = ('https://systemhc.sjtu.edu.cn/data/Systemhc_v2_2023/Data/230623_build/SysteMHC_Library/'
+                        '{allele_class}/Allele-specific/{file_name}')
+
+# raw files DIA-NN reads from an input folder
+DIA_EXTENSIONS = ['.raw', '.wiff', '.mzml', '.dia', '.d']
+
+# GB reserved for a DIA-NN search in a batch run
+DEFAULT_JOB_MEMORY_GB = 8
+
+LOG_FILE = 'dia_aspire.log'
+SUMMARY_FILE = 'batch_summary.json'
+
+# manifest entries holding paths, resolved against the manifest directory
+_PATH_KEYS = ['output_dir', 'dia_dir', 'sample_library', 'library_dir']
+_PATH_LIST_KEYS = ['dia_files', 'systemhc_libraries']
+
+
+def allele_library_name(allele):
+    """File name of the SysteMHC allele-specific library of `allele` (e.g. HLA-A01_01)"""
+    return f"HCD_cons_{allele}_top12_bynam_ptm.tsv"
+
+
+def allele_library_url(allele, allele_class='ClassI'):
+    return SYSTEMHC_LIBRARY_URL.format(allele_class=allele_class, file_name=allele_library_name(allele))
+
+
+def download_allele_library(allele, allele_class, dest_dir):
+    """
+    Download the SysteMHC allele-specific library of `allele` into `dest_dir`
+
+    Returns:
+    --------
+    str
+        Path to the downloaded library
+    """
+    import requests
+    url = allele_library_url(allele, allele_class)
+    dest_path = os.path.join(dest_dir, allele_library_name(allele))
+    response = requests.get(url, stream=True)
+    if response.status_code != 200:
+        raise Exception(f"Download Error, HTTP status code: {response.status_code}")
+    # concurrent samples may share a library directory, only complete files are moved in place
+    tmp = f'{dest_path}.{os.getpid()}.tmp'
+    with open(tmp, "wb") as f:
+        for chunk in response.iter_content(chunk_size=8192):
+            f.write(chunk)
+    os.replace(tmp, dest_path)
+    return dest_path
+
+
+def rundiann_command(library, output_dir, diann_path=DEFAULT_DIANN_PATH, dia_dir=None, dia_files=(),
+                     params=None, out=DIANN_OUT, timeout=None, memory_limit=None):
+    """
+    Command line of diann_runner.py (Python first) for one DIA-NN search
+
+    Parameters:
+    -----------
+    library : str
+        Spectral library searched
+    output_dir : str
+        Directory DIA-NN runs in
+    diann_path : str
+        DIA-NN executable
+    dia_dir : str, optional
+        Folder of DIA files
+    dia_files : list
+        DIA files, used when no folder is given
+    params : dict, optional
+        DIA-NN parameters (name without dashes to value), default DEFAULT_DIANN_PARAMS
+    out : str
+        DIA-NN report name
+    timeout : float, optional
+        Hours after which DIA-NN is stopped
+    memory_limit : float, optional
+        GB of address space DIA-NN may use
+
+    Returns:
+    --------
+    list
+    """
+    command = [sys.executable, '-u', DIANN_RUNNER]
+    if dia_dir:
+        command.extend(["--dir", dia_dir])
+    else:
+        for file in dia_files:
+            command.extend(["--f", file])
+    command.extend(["--lib", library, "--out", out, "--output-dir", output_dir, "--diann-path", diann_path])
+    if timeout:
+        command.extend(["--timeout", str(timeout)])
+    if memory_limit:
+        command.extend(["--memory-limit", str(memory_limit)])
+    # DIA-NN parameters are passed through as they are
+    return command + ["--"] + diann_runner.param_args(DEFAULT_DIANN_PARAMS if params is None else params)
+
+
+def merge_command(pipeline, sample_library, systemhc_lib_paths, output_dir, force=False):
+    """Command line of the checkpointed library merge in a separate Python process (unbuffered, so progress streams)"""
+    command = [sys.executable, '-u', os.path.abspath(__file__), 'merge', '--pipeline', pipeline]
+    if force:
+        command.append('--force')
+    return command + [sample_library, output_dir] + list(systemhc_lib_paths)
+
+
+def diann_command(pipeline, output_dir, diann_path, dia_dir=None, dia_files=(), params=None, force=False):
+    """Command line of the checkpointed DIA-NN search of the merged library in a separate Python process (unbuffered, so progress streams)"""
+    command = [sys.executable, '-u', os.path.abspath(__file__), 'diann', '--pipeline', pipeline,
+               '--diann-path', diann_path]
+    if dia_dir:
+        command.extend(['--dir', dia_dir])
+    else:
+        for file in dia_files:
+            command.extend(['--f', file])
+    for name, value in (DEFAULT_DIANN_PARAMS if params is None else params).items():
+        command.extend(['--param', f'{name}={value}'])
+    if force:
+        command.append('--force')
+    return command + [output_dir]
+
+
+def _resolve(base, path):
+    return os.path.abspath(os.path.join(base, os.path.expanduser(path)))
+
+
+def load_manifest(path):
+    """
+    Read a JSON sample manifest
+
+    The manifest holds a list of `samples` and optional `defaults` shared by
+    all of them, and an `output_dir` under which every sample gets its own
+    directory (unless the sample sets output_dir). A sample has:
+
+    - name: sample name (required)
+    - sample_library: sample library, FragPipe TSV or SysteMHC sptxt (required)
+    - dia_dir or dia_files: folder or list of DIA files (one is required)
+    - pipeline: 'FragPipe' (default) or 'SysteMHC'
+    - alleles: alleles whose SysteMHC libraries are merged; they are taken from
+      library_dir (default the sample output directory) and downloaded when missing
+    - allele_class: 'ClassI' (default) or 'ClassII'
+    - systemhc_libraries: SysteMHC library files, merged after the allele ones
+    - diann_path: DIA-NN executable
+    - diann_params: DIA-NN parameters overriding DEFAULT_DIANN_PARAMS; without
+      threads, a batch run gives each search its share of the cores
+    - memory_gb: memory reserved for the sample's DIA-NN search in a batch run
+    - timeout_hours, memory_limit_gb: DIA-NN is stopped after this time, and
+      may use this much address space
+    - shard_size: DIA files per first-pass DIA-NN search; a sample with more
+      files is searched in shards followed by a cross-run pass (see sharding)
+    - merge: keyword arguments of merge_libraries (e.g. out_of_core, rt_precision)
+
+    Relative paths are taken from the manifest directory.
+
+    Returns:
+    --------
+    list
+        One dict per sample with the defaults applied
+    """
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {'samples': manifest}
+    base = os.path.dirname(os.path.abspath(path))
+    defaults = manifest.get('defaults', {})
+    output_root = _resolve(base, manifest.get('output_dir', '.'))
+
+    samples = []
+    names = set()
+    for i, entry in enumerate(manifest.get('samples', [])):
+        sample = {'pipeline': 'FragPipe', 'allele_class': 'ClassI', 'alleles': [], 'systemhc_libraries': [],
+                  'dia_files': [], 'diann_path': DEFAULT_DIANN_PATH, 'merge': {}}
+        sample.update({k: v for k, v in defaults.items() if k not in ('diann_params', 'merge')})
+        sample.update({k: v for k, v in entry.items() if k not in ('diann_params', 'merge')})
+        sample['diann_params'] = {**DEFAULT_DIANN_PARAMS, **defaults.get('diann_params', {}),
+                                  **entry.get('diann_params', {})}
+        sample['merge'] = {**defaults.get('merge', {}), **entry.get('merge', {})}
+        threads = sample['diann_params']['threads'] if 'threads' in {**defaults.get('diann_params', {}),
+                                                                     **entry.get('diann_params', {})} else None
+        sample['threads'] = int(threads) if threads is not None else None
+
+        name = sample.get('name')
+        if not name:
+            raise ValueError(f"Sample {i + 1} of {path} has no name")
+        if name in names:
+            raise ValueError(f"Duplicate sample name in {path}: {name}")
+        names.add(name)
+        if not sample.get('sample_library'):
+            raise ValueError(f"Sample {name}: no sample_library")
+        if not sample.get('dia_dir') and not sample['dia_files']:
+            raise ValueError(f"Sample {name}: no dia_dir or dia_files")
+        if sample['pipeline'] not in PIPELINES:
+            raise ValueError(f"Sample {name}: unknown pipeline {sample['pipeline']}, expected one of {PIPELINES}")
+        if not sample['alleles'] and not sample['systemhc_libraries']:
+            raise ValueError(f"Sample {name}: no alleles or systemhc_libraries")
+        if sample.get('shard_size') is not None and (not isinstance(sample['shard_size'], int)
+                                                     or sample['shard_size'] < 1):
+            raise ValueError(f"Sample {name}: shard_size must be a positive integer")
+
+        sample.setdefault('output_dir', os.path.join(output_root, name))
+        for key in _PATH_KEYS:
+            if sample.get(key):
+                sample[key] = _resolve(base, sample[key])
+        for key in _PATH_LIST_KEYS:
+            sample[key] = [_resolve(base, p) for p in sample[key]]
+        if os.sep in sample['diann_path'] or sample['diann_path'].startswith('.'):
+            sample['diann_path'] = _resolve(base, sample['diann_path'])
+        sample.setdefault('library_dir', sample['output_dir'])
+        samples.append(sample)
+    if not samples:
+        raise ValueError(f"No samples in {path}")
+    return samples
+
+
+def systemhc_libraries(sample, download=True):
+    """SysteMHC libraries of a sample: its allele libraries (downloaded when missing) then the listed files"""
+    paths = []
+    for allele in sample['alleles']:
+        path = os.path.join(sample['library_dir'], allele_library_name(allele))
+        if not os.path.exists(path):
+            if not download:
+                raise FileNotFoundError(f"{path} not found")
+            print(f"Downloading {allele_library_name(allele)}...")
+            os.makedirs(sample['library_dir'], exist_ok=True)
+            download_allele_library(allele, sample['allele_class'], sample['library_dir'])
+        paths.append(path)
+    return paths + list(sample['systemhc_libraries'])
+
+
+def merge_sample(sample, systemhc_lib_paths):
+    """Merge the sample library with its SysteMHC libraries using the pipeline's API; returns the merged library"""
+    if sample['pipeline'] == 'FragPipe':
+        import fragpipe_api as api
+    else:
+        import systemhc_api as api
+    import instrument
+    print(f"Merging libraries using {sample['pipeline']} pipeline...")
+    # stage times, CPU, memory and rows go to the run report of the output directory
+    with instrument.report(sample['output_dir'], 'merge'):
+        return api.merge_libraries(sample['sample_library'], systemhc_lib_paths, sample['output_dir'],
+                                   **sample['merge'])
+
+
+def merged_library_path(sample):
+    return os.path.join(sample['output_dir'], MERGED_LIBRARY[sample['pipeline']])
+
+
+def runner_limits(sample):
+    """Keyword arguments of rundiann_command limiting the DIA-NN search of a sample"""
+    return {'timeout': sample.get('timeout_hours'), 'memory_limit': sample.get('memory_limit_gb')}
+
+
+def sample_command(sample, threads=None):
+    """diann_runner.py command line of a sample, with `threads` DIA-NN threads when given"""
+    params = sample['diann_params'] if threads is None else {**sample['diann_params'], 'threads': str(threads)}
+    return rundiann_command(merged_library_path(sample), sample['output_dir'], sample['diann_path'],
+                            sample.get('dia_dir'), sample['dia_files'], params, **runner_limits(sample))
+
+
+def merge_stage(sample, systemhc_lib_paths, manifest, force=False):
+    """
+    Checkpointed library merge (sample library conversion, RT alignment, merge)
+
+    Its inputs are the sample library, the SysteMHC libraries and the iRT
+    reference, its outputs the merged library (merged_library_path) and the
+    RT alignment table. Returns True when the stage ran, False when skipped.
+    """
+    import checkpoint
+    import irt_store
+    out = sample['output_dir']
+    reference = irt_store.find_reference(out)
+    inputs = [sample['sample_library']] + list(systemhc_lib_paths)
+    if reference is not None and os.path.exists(reference):
+        inputs.append(reference)
+    return checkpoint.run_stage(manifest, 'merge', inputs,
+                                {'version': STAGE_VERSION, 'pipeline': sample['pipeline'], 'merge': sample['merge'],
+                                 'reference': reference},
+                                [merged_library_path(sample)], lambda: merge_sample(sample, systemhc_lib_paths),
+                                optional_outputs=[os.path.join(out, RT_ALIGNED[sample['pipeline']])], force=force)
+
+
+def dia_runs(sample):
+    """DIA runs of a sample: its dia_files, or the files and .d folders of its dia_dir that DIA-NN reads"""
+    if not sample.get('dia_dir'):
+        return list(sample['dia_files'])
+    return sorted(os.path.join(sample['dia_dir'], f) for f in os.listdir(sample['dia_dir'])
+                  if f.lower().endswith(tuple(DIA_EXTENSIONS)))
+
+
+def diann_stage_params(sample, params):
+    """Checkpoint parameters of a DIA-NN search with `params` (the thread count does not change the results and is left out)"""
+    return {'version': STAGE_VERSION, 'diann_path': sample['diann_path'], 'out': DIANN_OUT,
+            'params': {k: v for k, v in params.items() if k != 'threads'}}
+
+
+def diann_checkpoint(sample):
+    """
+    (inputs, params, outputs) of the DIA-NN stage of a sample
+
+    Its inputs are the merged library and the DIA files, its parameters the
+    DIA-NN executable and parameters, its outputs the lib-base-result* files.
+    """
+    import checkpoint
+    out = sample['output_dir']
+    dia_inputs = checkpoint.expand_inputs(dia_runs(sample), DIA_EXTENSIONS)
+
+    def outputs():
+        return sorted(os.path.join(out, f) for f in os.listdir(out) if f.startswith(DIANN_OUT))
+
+    return [merged_library_path(sample)] + dia_inputs, diann_stage_params(sample, sample['diann_params']), outputs
+
+
+def diann_stage(sample, manifest, log=None, force=False):
+    """Checkpointed DIA-NN search of the DIA files with the merged library; returns True when it ran, False when skipped"""
+    import checkpoint
+    command = sample_command(sample, sample.get('threads'))
+    print(f"[run command] {' '.join(command)}")
+
+    def run():
+        if log is not None:
+            log.flush()
+        proc = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT if log else None)
+        try:
+            returncode = proc.wait()
+        except BaseException:
+            # interrupted (e.g. the diann command terminated): the runner stops DIA-NN and writes its record
+            proc.terminate()
+            proc.wait()
+            raise
+        if returncode != 0:
+            raise Exception(f"DIA-NN exited with code {returncode}")
+
+    inputs, params, outputs = diann_checkpoint(sample)
+    return checkpoint.run_stage(manifest, 'diann', inputs, params, outputs, run, force=force)
+
+
+def merge_step(sample, download=True, force=False):
+    """
+    Checkpointed merge of one sample, logged to dia_aspire.log in its output directory
+
+    Returns:
+    --------
+    dict
+        Summary with the sample name, status ('merged' or 'failed'), merged
+        library, stages done or skipped, log file, error and time
+    """
+    t0 = time.perf_counter()
+    summary = {'name': sample['name'], 'status': 'failed', 'output_dir': sample['output_dir'],
+               'merged_library': merged_library_path(sample), 'error': None, 'stages': {}}
+    os.makedirs(sample['output_dir'], exist_ok=True)
+    summary['log'] = os.path.join(sample['output_dir'], LOG_FILE)
+    with open(summary['log'], 'a') as log, contextlib.redirect_stdout(log):
+        try:
+            import checkpoint
+            manifest = checkpoint.StageManifest(sample['output_dir'])
+            ran = merge_stage(sample, systemhc_libraries(sample, download), manifest, force)
+            summary['stages']['merge'] = 'done' if ran else 'skipped'
+            print(f"Libraries merged successfully: {summary['merged_library']}")
+            summary['status'] = 'merged'
+        except Exception as e:
+            summary['error'] = str(e)
+            print(f"Error: {str(e)}")
+    summary['merge_seconds'] = round(time.perf_counter() - t0, 1)
+    return summary
+
+
+def run_sample(sample, dry_run=False, download=True, force=False):
+    """
+    Run the pipeline for one sample: library merge, then DIA-NN through diann_runner.py
+
+    Both stages are checkpointed in the sample output directory (see
+    checkpoint.StageManifest): a stage whose inputs, parameters and outputs
+    are unchanged since it last completed is skipped, unless `force` is set.
+    The merge messages and the DIA-NN output go to dia_aspire.log in the
+    sample output directory.
+
+    Returns:
+    --------
+    dict
+        Summary with the sample name, status ('done', 'failed' or 'dry-run'),
+        merged library, DIA-NN command, stages done or skipped, log file,
+        error and times
+    """
+    t0 = time.perf_counter()
+    if dry_run:
+        summary = {'name': sample['name'], 'status': 'dry-run', 'output_dir': sample['output_dir'],
+                   'merged_library': merged_library_path(sample),
+                   'command': sample_command(sample, sample.get('threads')), 'error': None}
+        if sample.get('shard_size'):
+            import sharding
+            if sharding.is_sharded(sample):
+                summary['shard_commands'], summary['command'] = sharding.shard_commands(sample, sample.get('threads'))
+                for command in summary['shard_commands']:
+                    print(f"{sample['name']}: [shard command] {' '.join(command)}")
+        print(f"{sample['name']}: [run command] {' '.join(summary['command'])}")
+        return summary
+    summary = merge_step(sample, download, force)
+    if summary['status'] == 'merged':
+        with open(summary['log'], 'a') as log, contextlib.redirect_stdout(log):
+            try:
+                import checkpoint
+                summary['command'] = sample_command(sample, sample.get('threads'))
+                ran = diann_stage(sample, checkpoint.StageManifest(sample['output_dir']), log, force)
+                summary['stages']['diann'] = 'done' if ran else 'skipped'
+                summary['status'] = 'done'
+            except Exception as e:
+                summary['status'] = 'failed'
+                summary['error'] = str(e)
+                print(f"Error: {str(e)}")
+    summary['seconds'] = round(time.perf_counter() - t0, 1)
+    return summary
+
+
+def prepare_reference():
+    """Build the indexed SysteMHC iRT reference once, before samples share it"""
+    import irt_store
+    path = irt_store.find_reference()
+    if path is None:
+        print("Warning: irt_SYSTEMHC.csv not found in application directory")
+        return None
+    irt_ref = irt_store.open_store(path)
+    print(f"Using SysteMHC iRT reference: {irt_ref.path}")
+    return irt_ref.path
+
+
+def job_scheduler(cores=None, max_jobs=None, job_memory=None):
+    """JobScheduler of the DIA-NN searches, `job_memory` GB (default DEFAULT_JOB_MEMORY_GB) reserved per search"""
+    import scheduler
+    return scheduler.JobScheduler(cores=cores, max_jobs=max_jobs,
+                                  job_memory=int((job_memory or DEFAULT_JOB_MEMORY_GB) * scheduler.GiB))
+
+
+def _queue_diann(sample, summary, jobs, force=False):
+    """Queue the DIA-NN search of a merged sample on the JobScheduler `jobs`, unless it is up to date"""
+    import checkpoint
+    import scheduler
+    manifest = checkpoint.StageManifest(sample['output_dir'])
+    inputs, params, outputs = diann_checkpoint(sample)
+    key, current = checkpoint.check_stage(manifest, 'diann', inputs, params)
+    if current and not force:
+        summary['stages']['diann'] = 'skipped'
+        summary['status'] = 'done'
+        summary['seconds'] = summary['merge_seconds']
+        _report(summary)
+        return
+    # an interrupted search is not taken as complete by the next run
+    manifest.invalidate('diann')
+    log = open(summary['log'], 'a')
+
+    def command(threads):
+        summary['command'] = sample_command(sample, threads)
+        print(f"[run command] {' '.join(summary['command'])}", file=log)
+        return summary['command']
+
+    def finished(job):
+        summary['diann'] = job.summary()
+        try:
+            if job.returncode != 0:
+                raise Exception(f"DIA-NN exited with code {job.returncode}")
+            checkpoint.finish_stage(manifest, 'diann', key, outputs, seconds=job.seconds)
+            summary['stages']['diann'] = 'done'
+            summary['status'] = 'done'
+        except Exception as e:
+            summary['status'] = 'failed'
+            summary['error'] = str(e)
+            print(f"Error: {str(e)}", file=log)
+        log.close()
+        summary['seconds'] = round(summary['merge_seconds'] + job.seconds, 1)
+        _report(summary)
+
+    memory = int(sample['memory_gb'] * scheduler.GiB) if sample.get('memory_gb') else None
+    jobs.submit(scheduler.Job(sample['name'], command, threads=sample.get('threads'), memory=memory,
+                              cwd=sample['output_dir'], log=log, on_finish=finished))
+
+
+def run_batch(samples, parallel=1, threads=None, dry_run=False, download=True, force=False,
+              max_jobs=None, job_memory=None, cores=None, shard_size=None, retries=None):
+    """
+    Run the pipeline for many samples
+
+    The library merges run in `parallel` worker processes. As soon as the
+    library of a sample is merged, its DIA-NN search is queued on a local
+    JobScheduler, which runs as many searches at once as the machine's cores
+    and memory allow and gives each its share of the cores (unless the
+    sample or `threads` fixes the thread count). A sample with more DIA
+    files than its shard_size is searched in shards, which the scheduler and
+    the `shards` workers of other nodes run, then in a final cross-run pass
+    (see sharding.ShardedSearch). A failing sample does not stop the others.
+
+    Parameters:
+    -----------
+    samples : list
+        Samples as returned by load_manifest
+    parallel : int
+        Number of library merges run concurrently
+    threads : int, optional
+        DIA-NN threads per sample, overriding the manifest and the scheduler
+    dry_run : bool
+        Only print the DIA-NN commands
+    download : bool
+        Download missing allele libraries
+    force : bool
+        Rerun the stages that are up to date
+    max_jobs : int, optional
+        Upper limit of concurrent DIA-NN searches
+    job_memory : float, optional
+        GB reserved for a DIA-NN search without memory_gb in the manifest,
+        default DEFAULT_JOB_MEMORY_GB
+    cores : int, optional
+        Cores shared by the DIA-NN searches, default all available cores
+    shard_size : int, optional
+        DIA files per shard, overriding the manifest
+    retries : int, optional
+        Reruns of a failing shard, default sharding.DEFAULT_RETRIES
+
+    Returns:
+    --------
+    list
+        Sample summaries (see run_sample, plus the DIA-NN threads, wall time
+        and peak RSS and the shards), in manifest order
+    """
+    import scheduler
+    import sharding
+    if threads:
+        samples = [{**s, 'threads': threads} for s in samples]
+    if shard_size:
+        samples = [{**s, 'shard_size': shard_size} for s in samples]
+    if dry_run:
+        return [run_sample(s, dry_run=True) for s in samples]
+    prepare_reference()
+
+    jobs = job_scheduler(cores, max_jobs, job_memory)
+    parallel = max(1, min(parallel, len(samples)))
+    print(f"Processing {len(samples)} samples: {parallel} library merges and up to {jobs.slots} DIA-NN searches "
+          f"at a time ({jobs.cores} cores, "
+          f"{'unknown' if jobs.memory is None else f'{jobs.memory / scheduler.GiB:.1f} GB'} memory)")
+    results = {}
+    searches = []
+
+    def search_finished(search):
+        search.summary['seconds'] = round(search.summary['merge_seconds'] + time.perf_counter() - search.started, 1)
+        _report(search.summary)
+
+    ctx = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=parallel, mp_context=ctx) as pool:
+        pending = {pool.submit(merge_step, s, download, force): s for s in samples}
+        try:
+            while pending or jobs.busy() or not all(s.finished for s in searches):
+                for future in [f for f in pending if f.done()]:
+                    sample = pending.pop(future)
+                    try:
+                        summary = future.result()
+                    except Exception as e:
+                        summary = {'name': sample['name'], 'status': 'failed', 'error': str(e), 'stages': {}}
+                    results[sample['name']] = summary
+                    if summary['status'] != 'merged':
+                        _report(summary)
+                    elif sharding.is_sharded(sample):
+                        search = sharding.ShardedSearch(sample, summary, jobs, sharding.DEFAULT_RETRIES
+                                                        if retries is None else retries, force,
+                                                        on_finish=search_finished)
+                        searches.append(search)
+                    else:
+                        _queue_diann(sample, summary, jobs, force)
+                for search in searches:
+                    search.step()
+                jobs.step()
+                if pending or jobs.busy() or not all(s.finished for s in searches):
+                    time.sleep(scheduler.POLL_SECONDS)
+        except BaseException:
+            for search in searches:
+                search.stop()
+            jobs.stop()
+            raise
+    return [results[s['name']] for s in samples]
+
+
+def _report(summary):
+    message = f"{summary['name']}: {summary['status']}"
+    if summary.get('seconds') is not None:
+        message += f" in {summary['seconds']} s"
+    if summary.get('error'):
+        message += f" - {summary['error']}"
+    if summary.get('log'):
+        message += f" (log: {summary['log']})"
+    print(message)
+    sys.stdout.flush()
+
+
+def _profile_option(ctx, param, value):
+    if value:
+        import instrument
+        try:
+            instrument.set_profile(value)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+    return value
+
+
+profile_option = click.option(
+    '--profile', default=None, expose_value=False, callback=_profile_option, metavar='STAGE[:py-spy]',
+    help='Profile one stage (e.g. lowess_fit) with cProfile, or py-spy, into the output directory.')
+
+
+@click.group()
+def cli():
+    """DIA-Aspire pipeline without the GUI"""
+
+
+@cli.command('run')
+@click.argument('manifest', type=click.Path(exists=True))
+@click.option('--parallel', default=1, show_default=True, type=int, help='Library merges run concurrently.')
+@click.option('--threads', default=None, type=int, help='DIA-NN threads per sample, default a share of the cores.')
+@click.option('--cores', default=None, type=int, help='Cores shared by the DIA-NN searches, default all available cores.')
+@click.option('--max-jobs', default=None, type=int, help='Most DIA-NN searches run at once, default as many as cores and memory allow.')
+@click.option('--job-memory', default=None, type=float, help=f'GB reserved per DIA-NN search without memory_gb, default {DEFAULT_JOB_MEMORY_GB}.')
+@click.option('--shard-size', default=None, type=int, help='DIA files per shard, overriding the manifest; more files are searched in shards.')
+@click.option('--retries', default=None, type=int, help='Reruns of a failing shard, default 2.')
+@click.option('--summary', 'summary_path', default=None, help=f'Batch summary (JSON), default {SUMMARY_FILE} next to the manifest.')
+@click.option('--dry-run', is_flag=True, help='Only print the DIA-NN command of every sample.')
+@click.option('--no-download', is_flag=True, help='Fail instead of downloading missing allele libraries.')
+@click.option('--force', is_flag=True, help='Rerun stages that are up to date.')
+@profile_option
+def main(manifest, parallel, threads, cores, max_jobs, job_memory, shard_size, retries, summary_path, dry_run,
+         no_download, force):
+    """Run the DIA-Aspire pipeline for every sample of MANIFEST"""
+    samples = load_manifest(manifest)
+    summaries = run_batch(samples, parallel, threads, dry_run, not no_download, force, max_jobs, job_memory,
+                          cores, shard_size, retries)
+    summary_path = summary_path or os.path.join(os.path.dirname(os.path.abspath(manifest)), SUMMARY_FILE)
+    with open(summary_path, 'w') as f:
+        json.dump(summaries, f, indent=2)
+    n_failed = sum(s['status'] == 'failed' for s in summaries)
+    print(f"{len(summaries) - n_failed} of {len(summaries)} samples succeeded, summary in {summary_path}")
+    sys.exit(1 if n_failed else 0)
+
+
+@cli.command('shards')
+@click.argument('manifest', type=click.Path(exists=True))
+@click.option('--threads', default=None, type=int, help='DIA-NN threads per shard, default a share of the cores.')
+@click.option('--cores', default=None, type=int, help='Cores shared by the shard searches, default all available cores.')
+@click.option('--max-jobs', default=None, type=int, help='Most shard searches run at once, default as many as cores and memory allow.')
+@click.option('--job-memory', default=None, type=float, help=f'GB reserved per shard search without memory_gb, default {DEFAULT_JOB_MEMORY_GB}.')
+@click.option('--shard-size', default=None, type=int, help='DIA files per shard, overriding the manifest (must match the run command).')
+@click.option('--retries', default=None, type=int, help='Reruns of a failing shard, default 2.')
+@click.option('--wait', default=3600, show_default=True, type=int, help='Seconds to wait for the library merge of a sample.')
+@profile_option
+def shards_main(manifest, threads, cores, max_jobs, job_memory, shard_size, retries, wait):
+    """Run shards of the sharded samples of MANIFEST for a `run` of the same manifest on another node"""
+    import sharding
+    samples = load_manifest(manifest)
+    if threads:
+        samples = [{**s, 'threads': threads} for s in samples]
+    if shard_size:
+        samples = [{**s, 'shard_size': shard_size} for s in samples]
+    jobs = job_scheduler(cores, max_jobs, job_memory)
+    print(f"Running shards: up to {jobs.slots} DIA-NN searches at a time ({jobs.cores} cores)")
+    summaries = sharding.work_shards(samples, jobs, sharding.DEFAULT_RETRIES if retries is None else retries, wait)
+    n_failed = sum(s['status'] == 'failed' for s in summaries)
+    print(f"Shards of {len(summaries) - n_failed} of {len(summaries)} samples completed")
+    sys.exit(1 if n_failed else 0)
+
+
+@cli.command('merge')
+@click.argument('sample_library', type=click.Path(exists=True))
+@click.argument('output_dir')
+@click.argument('systemhc_libraries', nargs=-1, required=True)
+@click.option('--pipeline', 'pipeline_name', default='FragPipe', show_default=True, type=click.Choice(PIPELINES), help='Pipeline of the sample library.')
+@click.option('--force', is_flag=True, help='Merge even when the merged library is up to date.')
+@profile_option
+def merge_main(sample_library, output_dir, systemhc_libraries, pipeline_name, force):
+    """Merge SAMPLE_LIBRARY with SYSTEMHC_LIBRARIES into OUTPUT_DIR, skipped when up to date"""
+    import checkpoint
+    sample = {'pipeline': pipeline_name, 'sample_library': os.path.abspath(sample_library),
+              'output_dir': os.path.abspath(output_dir), 'merge': {}}
+    os.makedirs(sample['output_dir'], exist_ok=True)
+    merge_stage(sample, [os.path.abspath(p) for p in systemhc_libraries],
+                checkpoint.StageManifest(sample['output_dir']), force)
+    print(f"Merged library: {merged_library_path(sample)}")
+
+
+@cli.command('diann')
+@click.argument('output_dir', type=click.Path(exists=True, file_okay=False))
+@click.option('--pipeline', 'pipeline_name', default='FragPipe', show_default=True, type=click.Choice(PIPELINES), help='Pipeline of the merged library.')
+@click.option('--diann-path', default=DEFAULT_DIANN_PATH, show_default=True, help='DIA-NN executable.')
+@click.option('--dir', 'dia_dir', default=None, help='Folder of DIA files.')
+@click.option('--f', 'dia_files', multiple=True, help='DIA file, repeated for several.')
+@click.option('--param', 'params', multiple=True, metavar='NAME=VALUE', help='DIA-NN parameter, repeated for several; default the pipeline defaults.')
+@click.option('--force', is_flag=True, help='Search even when the DIA-NN results are up to date.')
+def diann_main(output_dir, pipeline_name, diann_path, dia_dir, dia_files, params, force):
+    """Search the DIA files with the merged library of OUTPUT_DIR, skipped when up to date"""
+    import checkpoint
+    if not dia_dir and not dia_files:
+        raise click.UsageError('Give a folder (--dir) or files (--f) of DIA runs.')
+    diann_params = dict(p.partition('=')[::2] for p in params) if params else dict(DEFAULT_DIANN_PARAMS)
+    sample = {'pipeline': pipeline_name, 'output_dir': os.path.abspath(output_dir), 'diann_path': diann_path,
+              'dia_dir': os.path.abspath(dia_dir) if dia_dir else None,
+              'dia_files': [os.path.abspath(f) for f in dia_files], 'diann_params': diann_params}
+    # a terminated search exits through diann_stage, which stops the runner and DIA-NN with it
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    try:
+        diann_stage(sample, checkpoint.StageManifest(sample['output_dir']), force=force)
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
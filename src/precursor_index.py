@@ -0,0 +1,141 @@
+# precursor_index.py - Dense integer ids for (modified sequence, charge) precursors
+
+import numpy as np
+import pandas as pd
+
+# charges are packed into the low bits of the internal key
+_CHARGE_BITS = 8
+
+
+class PrecursorIndex:
+    """
+    Map (modified sequence, charge) pairs to dense integer ids
+
+    One index is shared by all libraries of a merge, so the same precursor
+    gets the same id everywhere and deduplication, joins and grouping work on
+    int64 arrays instead of per-row 'sequence + charge' strings. Sequences are
+    hashed once per distinct value (or once per category for categorical
+    columns).
+    """
+
+    def __init__(self):
+        self._peptides = pd.Index([], dtype=object)
+        self._keys = pd.Index([], dtype=np.int64)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _encode_unique(self, index, values, add):
+        codes = index.get_indexer(values)
+        missing = codes < 0
+        if add and missing.any():
+            new = pd.Index(pd.unique(np.asarray(values)[missing]))
+            index = index.append(new)
+            codes[missing] = index.get_indexer(np.asarray(values)[missing])
+        return index, codes
+
+    def _peptide_codes(self, peptides, add):
+        peptides = pd.Series(peptides)
+        if isinstance(peptides.dtype, pd.CategoricalDtype):
+            uniques = peptides.cat.categories
+            local = peptides.cat.codes.to_numpy()
+        else:
+            local, uniques = pd.factorize(peptides)
+        self._peptides, codes = self._encode_unique(self._peptides, uniques.astype(object), add)
+        # trailing -1 is picked up by the -1 code of missing peptides
+        return np.append(codes, -1).take(local)
+
+    def encode(self, peptides, charges, add=True):
+        """
+        Precursor ids of paired sequence and charge arrays
+
+        Parameters:
+        -----------
+        peptides : array-like
+            Modified sequences
+        charges : array-like
+            Precursor charges
+        add : bool
+            Give new ids to unseen precursors; with False they get -1
+
+        Returns:
+        --------
+        numpy.ndarray
+            int64 precursor ids, -1 for missing or unknown precursors
+        """
+        pep = self._peptide_codes(peptides, add)
+        charge = pd.to_numeric(pd.Series(charges), errors='coerce').to_numpy(dtype=float)
+        valid = (pep >= 0) & (charge >= 0) & (charge < 2 ** _CHARGE_BITS)
+        keys = np.where(valid, (pep << _CHARGE_BITS) | np.where(valid, charge, 0).astype(np.int64), -1)
+        if add:
+            uniques = pd.unique(keys[valid])
+            new = uniques[self._keys.get_indexer(uniques) < 0]
+            if len(new):
+                self._keys = self._keys.append(pd.Index(new, dtype=np.int64))
+        ids = self._keys.get_indexer(keys)
+        ids[~valid] = -1
+        return ids.astype(np.int64)
+
+    def encode_frame(self, da, peptide_col, charge_col='PrecursorCharge', add=True):
+        return self.encode(da[peptide_col], da[charge_col], add=add)
+
+    @property
+    def peptides(self):
+        """Modified sequence of every id"""
+        return self._peptides.to_numpy().take(self._keys.to_numpy() >> _CHARGE_BITS)
+
+    @property
+    def charges(self):
+        """Charge of every id"""
+        return (self._keys.to_numpy() & (2 ** _CHARGE_BITS - 1)).astype(np.int8)
+
+    def labels(self, ids=None):
+        """'sequence + charge' label of every id (or of `ids`, NaN for -1), e.g. 'PEPTIDEK2'"""
+        ids = np.arange(len(self)) if ids is None else np.asarray(ids, dtype=np.int64)
+        valid = ids >= 0
+        # only the labels asked for are built, streamed chunks use a small part of a large index
+        keys = self._keys.to_numpy().take(ids[valid])
+        labels = np.full(len(ids), np.nan, dtype=object)
+        labels[valid] = (pd.Series(self._peptides.to_numpy().take(keys >> _CHARGE_BITS), dtype=object)
+                         + pd.Series((keys & (2 ** _CHARGE_BITS - 1)).astype(np.int8)).astype(str)).to_numpy()
+        return labels
+
+    def sort_rank(self, by='key'):
+        """
+        Rank of every id in sorted precursor order
+
+        by='key' orders by sequence, then charge (DataFrame.merge/groupby
+        order on the two columns); by='label' orders by the concatenated label.
+        """
+        if by == 'label':
+            order = np.argsort(self.labels(), kind='stable')
+        else:
+            pep_rank = np.empty(len(self._peptides), dtype=np.int64)
+            pep_rank[np.argsort(self._peptides.to_numpy(), kind='stable')] = np.arange(len(self._peptides))
+            order = np.lexsort((self.charges, pep_rank.take(self._keys.to_numpy() >> _CHARGE_BITS)))
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        return rank
+
+    def map_values(self, ids, src_ids, values, fill=np.nan):
+        """Look up `values` given for `src_ids` at `ids` (integer join); unmatched ids get `fill`"""
+        table = np.full(len(self) + 1, fill, dtype=np.result_type(np.asarray(values).dtype, np.asarray(fill).dtype))
+        src_ids = np.asarray(src_ids)
+        ok = src_ids >= 0
+        table[src_ids[ok]] = np.asarray(values)[ok]
+        # the extra last slot answers the -1 ids
+        return table.take(ids)
+
+    def isin(self, ids, other_ids):
+        """Element-wise membership of `ids` in `other_ids`; -1 is never a member"""
+        return np.append(self.mask(other_ids), False).take(ids)
+
+    def mask(self, ids):
+        """Boolean membership table over all ids, True for the given ids"""
+        out = np.zeros(len(self), dtype=bool)
+        ids = np.asarray(ids)
+        out[ids[ids >= 0]] = True
+        return out
+
+    def __repr__(self):
+        return f'PrecursorIndex({len(self)} precursors)'
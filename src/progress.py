@@ -0,0 +1,34 @@
+# progress.py - Progress lines of the merges and of DIA-NN, read back by the GUI
+
+import re
+
+STAGE_RE = re.compile(r'^Stage (\d+)/(\d+): (.*)$')
+# DIA-NN starting a file, e.g. "[2:15] File #3/40" or "[40:02] Second pass: file #3/40"
+DIANN_FILE_RE = re.compile(r'^\[\d+(?::\d+)+\] (.*?)file #(\d+)/(\d+)\s*$', re.IGNORECASE)
+
+
+def print_stage(step, total, stage):
+    """Report the start of stage `step` of `total` as a 'Stage i/n: name' line"""
+    print(f"Stage {step}/{total}: {stage}", flush=True)
+
+
+def parse_stage(line):
+    """(step, total, stage) of a stage progress line, None for any other line"""
+    m = STAGE_RE.match(line.strip())
+    if m is None:
+        return None
+    return int(m.group(1)), int(m.group(2)), m.group(3)
+
+
+def parse_diann(line):
+    """(step, total, stage) of a DIA-NN line starting a file, None for any other line"""
+    m = DIANN_FILE_RE.match(line.strip())
+    if m is None:
+        return None
+    stage = f"{m.group(1)}file".strip()
+    return int(m.group(2)), int(m.group(3)), stage[0].upper() + stage[1:]
+
+
+def parse_progress(line):
+    """(step, total, stage) of a merge stage line or a DIA-NN file line, None for any other line"""
+    return parse_stage(line) or parse_diann(line)
@@ -0,0 +1,178 @@
+# rt_model.py - Fitted RT alignment models, saved and reused across merges
+
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+import library_cache
+
+# bump whenever fitting or the saved layout changes, it keys the saved models
+MODEL_VERSION = '1'
+
+MODEL_DIR = 'rt_models'
+
+
+class MonotoneCurve:
+    """Piecewise linear RT mapping through increasing knots, linearly extrapolated at both ends"""
+    def __init__(self, x, y):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        if len(self.x) < 2:
+            raise ValueError("x and y arrays must have at least 2 entries")
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=float)
+        # same arithmetic as interp1d(..., fill_value="extrapolate"), on whole arrays
+        hi = np.clip(np.searchsorted(self.x, x), 1, len(self.x) - 1)
+        lo = hi - 1
+        slope = (self.y[hi] - self.y[lo]) / (self.x[hi] - self.x[lo])
+        return slope * (x - self.x[lo]) + self.y[lo]
+
+    def __repr__(self):
+        return f'MonotoneCurve({len(self.x)} knots)'
+
+
+def alignment_stats(predicted, observed):
+    """Residual statistics of an alignment on the precursors it was fitted on"""
+    resid = np.asarray(predicted, dtype=float) - np.asarray(observed, dtype=float)
+    resid = resid[np.isfinite(resid)]
+    if not len(resid):
+        return {'n': 0}
+    abs_resid = np.abs(resid)
+    observed = np.asarray(observed, dtype=float)
+    ss_tot = float(np.sum((observed - np.nanmean(observed)) ** 2))
+    return {'n': int(len(resid)),
+            'rmse': float(np.sqrt(np.mean(resid ** 2))),
+            'mae': float(np.mean(abs_resid)),
+            'median_abs_error': float(np.median(abs_resid)),
+            'p95_abs_error': float(np.percentile(abs_resid, 95)),
+            'r2': float(1 - np.sum(resid ** 2) / ss_tot) if ss_tot > 0 else None}
+
+
+class AlignmentModel:
+    """
+    Fitted mapping of run RTs onto the reference RT scale
+
+    A 'lowess' model keeps the knots of its monotone curve, a 'linear' model
+    (used for small overlaps) its slope and intercept. `stats` holds the
+    residuals on the fitted precursors (see alignment_stats) and `meta` the
+    fit settings, so a saved model can be judged before it is reused.
+    """
+
+    def __init__(self, kind, params, stats=None, meta=None):
+        self.kind = kind
+        self.params = params
+        self.stats = stats or {}
+        self.meta = meta or {}
+        if kind == 'lowess':
+            self._curve = MonotoneCurve(params['x'], params['y'])
+        elif kind != 'linear':
+            raise ValueError(f"Unknown alignment model kind: {kind}")
+
+    @classmethod
+    def from_curve(cls, curve, **meta):
+        return cls('lowess', {'x': curve.x.tolist(), 'y': curve.y.tolist()}, meta=meta)
+
+    @classmethod
+    def linear(cls, slope, intercept, **meta):
+        return cls('linear', {'slope': float(slope), 'intercept': float(intercept)}, meta=meta)
+
+    def predict(self, x):
+        """Reference-scale RTs of the run RTs `x`"""
+        x = np.asarray(x, dtype=float)
+        if self.kind == 'linear':
+            return x * self.params['slope'] + self.params['intercept']
+        return self._curve(x)
+
+    def to_dict(self):
+        return {'version': MODEL_VERSION, 'kind': self.kind, 'params': self.params,
+                'stats': self.stats, 'meta': self.meta}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['kind'], d['params'], d.get('stats'), d.get('meta'))
+
+    def save(self, path):
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp, path)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls.from_dict(json.load(f))
+
+    def describe(self):
+        s = self.stats
+        if not s.get('n'):
+            return f'{self.kind} model'
+        return (f"{self.kind} model on {s['n']} precursors, RMSE {s['rmse']:.3f}, "
+                f"median |error| {s['median_abs_error']:.3f}, R2 {s['r2'] if s['r2'] is None else round(s['r2'], 4)}")
+
+    def __repr__(self):
+        return f'AlignmentModel({self.describe()})'
+
+
+def model_dir(cache=None):
+    """Directory of saved models for a library cache argument (None, False or a LibraryCache)"""
+    if cache is False:
+        return None
+    cache_dir = cache.cache_dir if cache is not None else library_cache.DEFAULT_CACHE_DIR
+    return os.path.join(cache_dir, MODEL_DIR)
+
+
+def model_key(sample_hash, reference_hash, **params):
+    """Key of the model aligning a reference onto a sample library with the given fit parameters"""
+    h = hashlib.blake2b(digest_size=20)
+    h.update(json.dumps([MODEL_VERSION, sample_hash, reference_hash, sorted(params.items())], default=str).encode())
+    return f'rt-{h.hexdigest()}'
+
+
+def cached_model(fit, sample_path, reference_hash, cache=None, **params):
+    """
+    Return the saved alignment model of these inputs, or fit() and save it
+
+    Parameters:
+    -----------
+    fit : callable
+        Fits and returns the AlignmentModel when no saved one exists
+    sample_path : str
+        Sample library the reference is aligned to
+    reference_hash : str
+        Content hash of the RT reference
+    cache : LibraryCache or bool, optional
+        Cache whose directory holds the models; None uses the default cache
+        directory, False always fits
+    params :
+        Fit parameters, part of the key
+
+    Returns:
+    --------
+    AlignmentModel
+    """
+    mdir = model_dir(cache)
+    if mdir is None or reference_hash is None:
+        return fit()
+    try:
+        lib_cache = cache if cache is not None else library_cache.LibraryCache()
+        key = model_key(lib_cache.content_hash(sample_path), reference_hash, **params)
+        path = os.path.join(mdir, f'{key}.json')
+        if os.path.exists(path):
+            model = AlignmentModel.load(path)
+            print(f"Loaded RT alignment model {path}")
+            return model
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Warning: RT alignment model unavailable - {str(e)}")
+        return fit()
+    model = fit()
+    model.meta.setdefault('created', time.strftime('%Y-%m-%d %H:%M:%S'))
+    try:
+        os.makedirs(mdir, exist_ok=True)
+        model.save(path)
+    except OSError as e:
+        print(f"Warning: Failed to save RT alignment model - {str(e)}")
+    return model
@@ -0,0 +1,220 @@
+# scheduler.py - Run several DIA-NN searches at once within the machine's cores and memory
+
+import os
+import signal
+import subprocess
+import time
+
+GiB = 1024 ** 3
+# fewest DIA-NN threads given to a job, fewer cores mean fewer concurrent jobs
+MIN_JOB_THREADS = 4
+# memory reserved for a job without its own estimate
+DEFAULT_JOB_MEMORY = 8 * GiB
+# share of the available memory the jobs may reserve together
+MEMORY_FRACTION = 0.9
+POLL_SECONDS = 0.5
+# seconds stopped jobs get to clean up after SIGTERM before they are killed
+STOP_GRACE = 15
+
+
+def available_cores():
+    """CPU cores this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory():
+    """Memory available for new processes in bytes (MemAvailable on Linux, free physical memory elsewhere)"""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class Job:
+    """
+    One external command run by the JobScheduler
+
+    Parameters:
+    -----------
+    name : str
+        Job name, used in messages and summaries
+    command : callable
+        Returns the command line (list) for the number of threads it is given
+    threads : int, optional
+        Threads the job uses; None lets the scheduler assign its share of the cores
+    memory : int, optional
+        Bytes reserved for the job; None reserves the scheduler's job_memory
+    cwd : str, optional
+        Working directory
+    log : file, optional
+        Open file receiving the job's stdout and stderr
+    on_finish : callable, optional
+        Called with the job once it has finished
+    """
+
+    def __init__(self, name, command, threads=None, memory=None, cwd=None, log=None, on_finish=None):
+        self.name = name
+        self.command = command
+        self.threads = threads
+        self.memory = memory
+        self.cwd = cwd
+        self.log = log
+        self.on_finish = on_finish
+        self.proc = None
+        self.started = None
+        self.returncode = None
+        self.seconds = None
+        self.peak_rss = None
+
+    def summary(self):
+        return {'name': self.name, 'threads': self.threads, 'returncode': self.returncode,
+                'seconds': None if self.seconds is None else round(self.seconds, 1),
+                'peak_rss_mb': None if self.peak_rss is None else round(self.peak_rss / 1024 ** 2, 1)}
+
+
+class JobScheduler:
+    """
+    Local scheduler running queued jobs concurrently within a core and memory budget
+
+    The number of concurrent jobs is the smallest of `max_jobs`, the cores
+    divided by MIN_JOB_THREADS and the memory budget divided by the memory of
+    a job. Jobs without a thread count get an equal share of the cores.
+    A job is started once its threads and memory fit in what the running jobs
+    leave free; the others wait in submission order. Wall time and peak RSS
+    (the largest resident set of the job's process and its descendants, from
+    wait4) are recorded for every job.
+
+    Parameters:
+    -----------
+    cores : int, optional
+        Cores shared by the jobs, default all available cores
+    memory : int, optional
+        Bytes shared by the jobs, default MEMORY_FRACTION of the available memory
+    max_jobs : int, optional
+        Upper limit of concurrent jobs
+    job_memory : int
+        Bytes reserved for a job without its own estimate
+    """
+
+    def __init__(self, cores=None, memory=None, max_jobs=None, job_memory=DEFAULT_JOB_MEMORY):
+        self.cores = cores or available_cores()
+        if memory is None:
+            avail = available_memory()
+            memory = int(avail * MEMORY_FRACTION) if avail else None
+        self.memory = memory
+        self.job_memory = job_memory
+        slots = max(1, self.cores // MIN_JOB_THREADS)
+        if self.memory is not None:
+            slots = min(slots, max(1, self.memory // job_memory))
+        self.slots = min(slots, max_jobs) if max_jobs else slots
+        self.queue = []
+        self.running = []
+        self.finished = []
+
+    @property
+    def job_threads(self):
+        """Threads of a job without its own thread count"""
+        return max(1, self.cores // self.slots)
+
+    def submit(self, job):
+        self.queue.append(job)
+
+    def busy(self):
+        return bool(self.queue or self.running)
+
+    def has_room(self):
+        """Whether another job would start now by the job count (it may still wait for cores or memory)"""
+        return len(self.running) + len(self.queue) < self.slots
+
+    def _free(self):
+        cores = self.cores - sum(j.threads for j in self.running)
+        memory = None if self.memory is None else self.memory - sum(j.memory for j in self.running)
+        return cores, memory
+
+    def _start(self, job):
+        command = job.command(job.threads)
+        job.started = time.perf_counter()
+        if job.log is not None:
+            job.log.flush()
+        # own process group, so stop() also reaches the processes the job starts
+        job.proc = subprocess.Popen(command, cwd=job.cwd, stdout=job.log,
+                                    stderr=subprocess.STDOUT if job.log is not None else None,
+                                    start_new_session=True)
+        print(f"{job.name}: started with {job.threads} threads")
+        self.running.append(job)
+
+    def _launch(self):
+        while self.queue and len(self.running) < self.slots:
+            job = self.queue[0]
+            if job.threads is None:
+                job.threads = self.job_threads
+            if job.memory is None:
+                job.memory = self.job_memory
+            cores, memory = self._free()
+            # an oversized job still runs, alone, rather than never
+            fits = job.threads <= cores and (memory is None or job.memory <= memory)
+            if not fits and self.running:
+                break
+            self._start(self.queue.pop(0))
+
+    def _reap(self):
+        for job in list(self.running):
+            pid, status, rusage = os.wait4(job.proc.pid, os.WNOHANG)
+            if pid == 0:
+                continue
+            job.seconds = time.perf_counter() - job.started
+            job.returncode = os.waitstatus_to_exitcode(status)
+            job.proc.returncode = job.returncode
+            # ru_maxrss is in kilobytes on Linux
+            job.peak_rss = rusage.ru_maxrss * 1024
+            self.running.remove(job)
+            self.finished.append(job)
+            print(f"{job.name}: finished with code {job.returncode} in {job.seconds:.1f} s, "
+                  f"peak RSS {job.peak_rss / 1024 ** 2:.0f} MB")
+            if job.on_finish is not None:
+                job.on_finish(job)
+
+    def step(self):
+        """Reap finished jobs and start queued ones that fit; returns whether jobs remain"""
+        self._reap()
+        self._launch()
+        return self.busy()
+
+    def run(self, jobs=()):
+        """Run the given and already submitted jobs to completion; returns the finished jobs"""
+        for job in jobs:
+            self.submit(job)
+        while self.step():
+            time.sleep(POLL_SECONDS)
+        return self.finished
+
+    @staticmethod
+    def _signal(job, sig):
+        try:
+            os.killpg(job.proc.pid, sig)
+        except OSError:
+            job.proc.send_signal(sig)
+
+    def stop(self, grace=STOP_GRACE):
+        """Terminate the running jobs, killing those still running after `grace` seconds, and drop the queued ones"""
+        self.queue.clear()
+        for job in self.running:
+            self._signal(job, signal.SIGTERM)
+        deadline = time.perf_counter() + grace
+        while self.running:
+            self._reap()
+            if deadline is not None and time.perf_counter() > deadline:
+                for job in self.running:
+                    self._signal(job, signal.SIGKILL)
+                deadline = None
+            time.sleep(0.05)
@@ -0,0 +1,440 @@
+# sharding.py - DIA-NN search of a large cohort split into shards, followed by one cross-run pass
+#
+# Every shard of DIA files gets a first-pass DIA-NN search of its own, which saves
+# the per-run quantification (.quant files) in the shared quant folder of the
+# sample. Once all shards are complete, a final DIA-NN search over all files reuses
+# those .quant files (--use-quant) for the cross-run steps (match between runs,
+# matrices). Shards run locally on the JobScheduler and, through claim files in the
+# shared output directory, on other nodes running `pipeline.py shards` on the same
+# manifest. A failed shard is retried on its own.
+
+import os
+import socket
+import time
+
+import checkpoint
+import pipeline
+import scheduler
+
+SHARD_DIR = 'shards'
+QUANT_DIR = 'quant'
+CLAIM_FILE = 'claim'
+# a claim not refreshed for this long belongs to a worker that is gone
+CLAIM_TIMEOUT = 600
+CLAIM_HEARTBEAT = 60
+# seconds between looks at shards run by other workers
+REMOTE_POLL = 5
+DEFAULT_RETRIES = 2
+# cross-run options, they only act in the final pass
+FINAL_ONLY_PARAMS = ['reanalyse', 'matrices', 'matrix-qvalue']
+
+
+def is_sharded(sample):
+    """Whether the sample has more DIA runs than its shard_size"""
+    return bool(sample.get('shard_size')) and len(pipeline.dia_runs(sample)) > sample['shard_size']
+
+
+def quant_dir(sample):
+    return os.path.join(sample['output_dir'], QUANT_DIR)
+
+
+def quant_files(sample, runs=None):
+    """.quant files of the given runs (default all) in the quant folder of the sample"""
+    folder = quant_dir(sample)
+    if not os.path.isdir(folder):
+        return []
+    names = [f for f in sorted(os.listdir(folder)) if f.endswith('.quant')]
+    if runs is not None:
+        ends = tuple(f'{os.path.basename(r.rstrip(os.sep))}.quant' for r in runs)
+        names = [f for f in names if f.endswith(ends)]
+    return [os.path.join(folder, f) for f in names]
+
+
+def shard_params(sample):
+    """DIA-NN parameters of a first-pass shard search"""
+    params = {k: v for k, v in sample['diann_params'].items() if k not in FINAL_ONLY_PARAMS}
+    params['temp'] = quant_dir(sample)
+    return params
+
+
+def final_params(sample):
+    """DIA-NN parameters of the final cross-run search reusing the .quant files"""
+    return {**sample['diann_params'], 'temp': quant_dir(sample), 'use-quant': 'true'}
+
+
+class Shard:
+    """DIA runs searched together in the first pass, with their own folder, log and checkpoint"""
+
+    def __init__(self, name, folder, runs):
+        self.name = name
+        self.dir = folder
+        self.runs = runs
+        self.status = 'pending'
+        self.key = None
+        self.forced = False
+        self.manifest = None
+        self.attempts = 0
+        self.checked = 0.0
+        self.beat = 0.0
+        self.error = None
+        self.jobs = []
+
+    def summary(self):
+        return {'name': self.name, 'runs': len(self.runs), 'status': self.status, 'attempts': self.attempts,
+                'error': self.error, 'jobs': self.jobs}
+
+
+def plan_shards(sample):
+    """Shards of `shard_size` runs of a sample, in run order"""
+    runs = pipeline.dia_runs(sample)
+    size = sample['shard_size']
+    root = os.path.join(sample['output_dir'], SHARD_DIR)
+    return [Shard(f'shard_{i // size + 1:03d}', os.path.join(root, f'shard_{i // size + 1:03d}'), runs[i:i + size])
+            for i in range(0, len(runs), size)]
+
+
+def shard_commands(sample, threads=None):
+    """diann_runner.py command lines of the shard searches and of the final search of a sample"""
+    extra = {} if threads is None else {'threads': str(threads)}
+    library = pipeline.merged_library_path(sample)
+    commands = [pipeline.rundiann_command(library, shard.dir, sample['diann_path'], dia_files=shard.runs,
+                                          params={**shard_params(sample), **extra}, **pipeline.runner_limits(sample))
+                for shard in plan_shards(sample)]
+    final = pipeline.rundiann_command(library, sample['output_dir'], sample['diann_path'],
+                                      dia_files=pipeline.dia_runs(sample), params={**final_params(sample), **extra},
+                                      **pipeline.runner_limits(sample))
+    return commands, final
+
+
+def _owner():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _stale(path):
+    try:
+        mtime = os.stat(path).st_mtime
+        with open(path, 'r') as f:
+            host, _, pid = f.read().strip().rpartition(':')
+    except OSError:
+        return True
+    if host == socket.gethostname() and pid.isdigit():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+    return time.time() - mtime > CLAIM_TIMEOUT
+
+
+def claim(folder):
+    """
+    Claim the shard in `folder` for this process
+
+    Returns False while another worker holds the claim. A claim is stale once
+    its worker has not refreshed it for CLAIM_TIMEOUT seconds, or at once when
+    the worker was on this host and has exited; a stale claim is taken over.
+    """
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, CLAIM_FILE)
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not _stale(path):
+                return False
+            # only one of the workers finding a stale claim can move it away
+            stale = f'{path}.{os.getpid()}.stale'
+            try:
+                os.rename(path, stale)
+            except FileNotFoundError:
+                continue
+            os.remove(stale)
+            continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(_owner())
+        return True
+    return False
+
+
+def held(folder):
+    """Whether a live worker holds the claim of the shard in `folder`"""
+    path = os.path.join(folder, CLAIM_FILE)
+    return os.path.exists(path) and not _stale(path)
+
+
+def heartbeat(folder):
+    try:
+        os.utime(os.path.join(folder, CLAIM_FILE))
+    except OSError:
+        pass
+
+
+def release(folder):
+    """Give up the claim of the shard in `folder` if this process holds it"""
+    path = os.path.join(folder, CLAIM_FILE)
+    try:
+        with open(path, 'r') as f:
+            if f.read().strip() == _owner():
+                os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class ShardedSearch:
+    """
+    Sharded DIA-NN search of one sample on a JobScheduler
+
+    step() is called regularly: when the scheduler has room, it claims and
+    queues a shard that is neither up to date nor held by another worker,
+    keeps its claims alive
+    and, with `final`, queues the final search once all shards are complete.
+    Every shard is checkpointed in its own folder, so a rerun or another node
+    skips the shards that are done. A failing shard is rerun up to `retries`
+    times; the sample fails when a shard still fails, after the other shards.
+
+    Parameters:
+    -----------
+    sample : dict
+        Sample from pipeline.load_manifest, with its library merged and a shard_size
+    summary : dict
+        Sample summary, updated with the status of the shards and the final search
+    jobs : scheduler.JobScheduler
+        Scheduler running the searches
+    retries : int
+        Reruns of a failing shard
+    force : bool
+        Rerun shards and final search that are up to date
+    final : bool
+        Run the final search; workers of other nodes only run shards
+    on_finish : callable, optional
+        Called with the search once it is finished
+    """
+
+    def __init__(self, sample, summary, jobs, retries=DEFAULT_RETRIES, force=False, final=True, on_finish=None):
+        self.sample = sample
+        self.summary = summary
+        self.jobs = jobs
+        self.retries = retries
+        self.force = force
+        self.final = final
+        self.on_finish = on_finish
+        self.shards = plan_shards(sample)
+        self.final_status = None
+        self.finished = False
+        self.stopped = False
+        self.started = time.perf_counter()
+        self.memory = int(sample['memory_gb'] * scheduler.GiB) if sample.get('memory_gb') else None
+        summary['shards'] = [s.summary() for s in self.shards]
+
+    def _checkpoint(self, shard):
+        inputs = [pipeline.merged_library_path(self.sample)] + checkpoint.expand_inputs(shard.runs,
+                                                                                        pipeline.DIA_EXTENSIONS)
+        return inputs, pipeline.diann_stage_params(self.sample, shard_params(self.sample))
+
+    def _poll(self, shard):
+        """Take a shard that is up to date, else leave it waiting for a free slot or for the worker holding it"""
+        shard.checked = time.time()
+        shard.manifest = checkpoint.StageManifest(shard.dir)
+        if shard.key is None:
+            inputs, params = self._checkpoint(shard)
+            shard.key, current = checkpoint.check_stage(shard.manifest, 'shard', inputs, params)
+            shard.forced = current and self.force
+        else:
+            current = shard.manifest.is_current('shard', shard.key)
+        if current and not shard.forced:
+            shard.status = 'skipped' if shard.status == 'pending' else 'done'
+        elif held(shard.dir):
+            if shard.status != 'remote':
+                print(f"{self.sample['name']} {shard.name}: held by another worker")
+            shard.status = 'remote'
+        else:
+            shard.status = 'waiting'
+
+    def _start(self, shard):
+        """Claim a waiting shard and queue its search"""
+        if not claim(shard.dir):
+            shard.status = 'remote'
+            return
+        # another worker may have completed the shard since it was polled
+        shard.manifest = checkpoint.StageManifest(shard.dir)
+        if shard.manifest.is_current('shard', shard.key) and not shard.forced:
+            release(shard.dir)
+            shard.status = 'done'
+            return
+        shard.manifest.invalidate('shard')
+        shard.beat = time.time()
+        self._submit(shard)
+
+    def _submit(self, shard):
+        shard.status = 'running'
+        shard.attempts += 1
+        log = open(os.path.join(shard.dir, pipeline.LOG_FILE), 'a')
+
+        def command(threads):
+            params = {**shard_params(self.sample), 'threads': str(threads)}
+            cmd = pipeline.rundiann_command(pipeline.merged_library_path(self.sample), shard.dir,
+                                            self.sample['diann_path'], dia_files=shard.runs, params=params,
+                                            **pipeline.runner_limits(self.sample))
+            print(f"[run command] {' '.join(cmd)}", file=log)
+            return cmd
+
+        def finished(job):
+            shard.jobs.append(job.summary())
+            try:
+                if job.returncode != 0:
+                    raise Exception(f"DIA-NN exited with code {job.returncode}")
+                checkpoint.finish_stage(shard.manifest, 'shard', shard.key, self._shard_outputs(shard),
+                                        quant_files(self.sample, shard.runs), job.seconds)
+                shard.status = 'done'
+                shard.error = None
+            except Exception as e:
+                shard.error = str(e)
+                print(f"Error: {str(e)}", file=log)
+                if shard.attempts <= self.retries and not self.stopped:
+                    print(f"{self.sample['name']} {shard.name}: {shard.error}, retry {shard.attempts} of {self.retries}")
+                    log.close()
+                    self._submit(shard)
+                    return
+                shard.status = 'failed'
+            log.close()
+            release(shard.dir)
+
+        os.makedirs(quant_dir(self.sample), exist_ok=True)
+        self.jobs.submit(scheduler.Job(f"{self.sample['name']} {shard.name}", command, threads=self.sample.get('threads'),
+                                       memory=self.memory, cwd=shard.dir, log=log, on_finish=finished))
+
+    @staticmethod
+    def _shard_outputs(shard):
+        return sorted(os.path.join(shard.dir, f) for f in os.listdir(shard.dir) if f.startswith(pipeline.DIANN_OUT))
+
+    def _start_final(self):
+        """Queue the final search over all runs, unless it is up to date"""
+        manifest = checkpoint.StageManifest(self.sample['output_dir'])
+        inputs, _, outputs = pipeline.diann_checkpoint(self.sample)
+        params = pipeline.diann_stage_params(self.sample, final_params(self.sample))
+        params['shards'] = [[s.name, s.runs] for s in self.shards]
+        key, current = checkpoint.check_stage(manifest, 'diann', inputs + quant_files(self.sample), params)
+        if current and not self.force:
+            self._finish('skipped')
+            return
+        manifest.invalidate('diann')
+        self.final_status = 'running'
+        log = open(self.summary['log'], 'a')
+
+        def command(threads):
+            params = {**final_params(self.sample), 'threads': str(threads)}
+            self.summary['command'] = pipeline.rundiann_command(
+                pipeline.merged_library_path(self.sample), self.sample['output_dir'], self.sample['diann_path'],
+                dia_files=pipeline.dia_runs(self.sample), params=params, **pipeline.runner_limits(self.sample))
+            print(f"[run command] {' '.join(self.summary['command'])}", file=log)
+            return self.summary['command']
+
+        def finished(job):
+            self.summary['diann'] = job.summary()
+            status = 'done'
+            try:
+                if job.returncode != 0:
+                    raise Exception(f"DIA-NN exited with code {job.returncode}")
+                checkpoint.finish_stage(manifest, 'diann', key, outputs, seconds=job.seconds)
+            except Exception as e:
+                status = 'failed'
+                self.summary['error'] = str(e)
+                print(f"Error: {str(e)}", file=log)
+            log.close()
+            self._finish(status)
+
+        self.jobs.submit(scheduler.Job(f"{self.sample['name']} final", command, threads=self.sample.get('threads'),
+                                       memory=self.memory, cwd=self.sample['output_dir'], log=log,
+                                       on_finish=finished))
+
+    def _finish(self, status):
+        self.final_status = status
+        self.finished = True
+        self.summary['shards'] = [s.summary() for s in self.shards]
+        failed = [s.name for s in self.shards if s.status == 'failed']
+        if failed:
+            self.summary['status'] = 'failed'
+            self.summary['error'] = f"{len(failed)} of {len(self.shards)} shards failed: {', '.join(failed)}"
+        elif status == 'failed':
+            self.summary['status'] = 'failed'
+        else:
+            self.summary['status'] = 'done'
+            self.summary['stages']['shards'] = 'skipped' if all(s.status == 'skipped' for s in self.shards) else 'done'
+            if self.final:
+                self.summary['stages']['diann'] = status
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+    def step(self):
+        """Advance the search; returns whether it is finished"""
+        if self.finished:
+            return True
+        now = time.time()
+        for shard in self.shards:
+            if shard.status == 'pending' or (shard.status in ('waiting', 'remote')
+                                             and now - shard.checked >= REMOTE_POLL):
+                self._poll(shard)
+            elif shard.status == 'running' and now - shard.beat >= CLAIM_HEARTBEAT:
+                heartbeat(shard.dir)
+                shard.beat = now
+            # claimed only when it can start, so that idle workers elsewhere can take the rest
+            if shard.status == 'waiting' and self.jobs.has_room():
+                self._start(shard)
+        if self.final_status is None and not any(s.status in ('pending', 'waiting', 'remote', 'running')
+                                                 for s in self.shards):
+            if self.final and not any(s.status == 'failed' for s in self.shards):
+                self._start_final()
+            else:
+                self._finish('skipped' if self.final else None)
+        return self.finished
+
+    def stop(self):
+        """Stop retrying shards and give up the claims of the shards queued or running here"""
+        self.stopped = True
+        for shard in self.shards:
+            if shard.status == 'running':
+                release(shard.dir)
+
+
+def work_shards(samples, jobs, retries=DEFAULT_RETRIES, wait=3600):
+    """
+    Run shards of the sharded samples for a coordinator on another node
+
+    A sample's shards are taken up once the coordinator (`pipeline.py run`
+    on the same manifest) has merged its library; samples not merged within
+    `wait` seconds are given up.
+
+    Returns:
+    --------
+    list
+        Summaries of the samples with the status of their shards
+    """
+    waiting = [s for s in samples if is_sharded(s)]
+    searches = []
+    given_up = []
+    deadline = time.time() + wait
+    try:
+        while waiting or not all(s.finished for s in searches) or jobs.busy():
+            for sample in list(waiting):
+                manifest = checkpoint.StageManifest(sample['output_dir'])
+                if 'merge' in manifest.stages and os.path.exists(pipeline.merged_library_path(sample)):
+                    waiting.remove(sample)
+                    summary = {'name': sample['name'], 'status': 'running', 'error': None, 'stages': {}}
+                    searches.append(ShardedSearch(sample, summary, jobs, retries, final=False,
+                                                  on_finish=lambda search: pipeline._report(search.summary)))
+                elif time.time() > deadline:
+                    waiting.remove(sample)
+                    given_up.append({'name': sample['name'], 'status': 'failed', 'stages': {},
+                                     'error': f"library not merged after {wait} s"})
+                    pipeline._report(given_up[-1])
+            for search in searches:
+                search.step()
+            jobs.step()
+            time.sleep(scheduler.POLL_SECONDS)
+    except BaseException:
+        for search in searches:
+            search.stop()
+        jobs.stop()
+        raise
+    return [s.summary for s in searches] + given_up
@@ -1,8 +1,16 @@
-import csv
-import os,sys
+import io
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
+import instrument
+import top_fragments
+import modifications
+import precursor_index
+
+# bump whenever the converted library changes, it keys the library cache
+CONVERTER_VERSION = '3'
 
 #print("please input 'argv1: inputname of sptxt','argv2: number of top fragments' ")
 
@@ -10,15 +18,7 @@ def remove_parent1(text):
     return re.sub('\[.*?\]', '', text)
 
 def submod(text):
-    t1 = re.sub('M\[147\]', 'M(UniMod:35)', text)
-    t2 = re.sub('S\[167\]', 'S(UniMod:21)', t1)
-    t3 = re.sub('T\[181\]', 'T(UniMod:21)', t2)
-    t4 = re.sub('Y\[243\]', 'Y(UniMod:21)', t3)
-    t5 = re.sub('N\[115\]', 'N(UniMod:7)', t4)
-    t6 = re.sub('Q\[129\]', 'Q(UniMod:7)', t5)
-    t7 = re.sub('S\[129\]', 'Q(UniMod:1)', t6)
-    t8 = re.sub('n\[43\]', '(UniMod:1)', t7)
-    return t8 
+    return modifications.translate(text)
 
 def extract(text):
     pattern = r'\((.*?)\)'  # 匹配()之间的内容
@@ -52,7 +52,11 @@ def getdata(da,flg):
     return da4
 
 def get_final(da,n):
-    dax = pd.concat([group.head(n) for _, group in da.groupby(da['ions'])])
+    keys = precursor_index.PrecursorIndex()
+    ids = keys.encode_frame(da, 'ModifiedPeptide')
+    # visit precursors in 'sequence + charge' label order, as the former groupby on 'ions'
+    codes = np.where(ids >= 0, keys.sort_rank(by='label').take(ids), -1)
+    dax = top_fragments.select_top_fragments(da, n, intensity_col='RelativeIntensity', codes=codes)
     
     col2 = ['PrecursorMZ','FragmentMZ','RelativeIntensity','iRT','Protein_name','ModifiedPeptide',\
            'StrippedPeptide','FragmentType','FragmentNumber','PrecursorCharge','FragmentCharge',\
@@ -77,117 +81,353 @@ def get_final2(da):
     return dax2
 
 
-#inp = sys.argv[1] 
-def convert_sptxt2tsv(inp):
-    num1 = 12
-
-    f = open(inp,'r')
-    spts = f.readlines()
-    f.close()
-
-    ionsname=[]
-    preMZ = []
-    bys = []
-    retime = []
-    npeaks = []
-    prot = []
-
-    for spt in spts:
-        if re.match('^Name',spt):
-            ion = re.sub('Name: ','',spt)
-            ionsname.append(ion[0:-1])
-        elif re.match('^PrecursorMZ',spt):
-            pmz = re.sub('PrecursorMZ: ','',spt)
-            preMZ.append(pmz[0:-1])
-        elif re.match('^Comment',spt):
-            regx = '(?<=RetentionTime=).[0-9|,|.]*'
-            a = re.findall(regx,spt)
-            retime.append(a)
-            
-            match = re.search(r'Protein=(.*?)\s', spt)
-            prot.append(match.group(1))
-            
-        elif re.match('^NumPeaks',spt):
-            npk = re.sub('NumPeaks: ','',spt)
-            npeaks.append(npk[0:-1])
-        elif re.match('^\d',spt):
-            bys.append(spt[0:-1])
-
-    peaks = pd.DataFrame(npeaks)
-
-    RT = pd.DataFrame(retime)
-
-    df0 = pd.DataFrame({'peptide':ionsname,'PrecursorMZ':preMZ,'Protein_name':prot})
-
-    byx = pd.DataFrame(bys)
-    byions = byx.iloc[:,0].str.split('\t',expand=True)
-    byions1 = byions.iloc[:,[0,1,2]]
-    byions1.columns = ['FragmentMZ','RelativeIntensity','Fragment']
-    byions2 = byions1['Fragment'].str.split(',',expand=True)
-
-    RT.columns = ['rt']
-    RT1 = RT['rt'].str.split(',',expand=True)
-
-    for col in RT1.columns:
-        RT1[col] = RT1[col].astype(float)  
-
-    df = df0.copy()
-    df['iRT'] = RT1.median(axis=1)
-
-    nump = peaks.iloc[:,0].tolist()
-    df_r = df.reindex(df.index.repeat(nump)).reset_index(drop=True)
-
-    da0 = pd.concat([byions1,df_r],axis=1)
-
-    da = da0.copy()
-    da['Fragment'] = byions2.iloc[:,0]
-    da['Fragment'] = da['Fragment'].apply(remove_parent1)
-    da['modpep'] = da['peptide'].apply(submod) #更改mod格式
-    da = da[da['Fragment'].str.contains('[i|p|\+]')==False]
-
-    byions3 = da['Fragment'].str.split('/',expand=True)
-    byions3.columns = ['ion','error']
-    byions3['FragmentType'] = byions3['ion'].str[0]
-
-    byions4 = byions3['ion'].str.split('^',expand=True)
-    byions4.columns = ['ion1','charge']
-    byions4['FragmentCharge'] = byions4['charge']
-    byions4['FragmentType'] = byions4['ion1']
-    byions4['FragmentCharge'].fillna(1,inplace=True)
-
-    byions5 = byions4['ion1'].str.split('-',expand=True)
-    byions5.columns = ['ion2','loss']
-    byions5['FragmentNumber'] = byions5['ion2'].str[1:]
-    byions5.loc[byions5['ion2'].str.contains('[I|m|\?]')==True,'FragmentNumber'] = np.nan
-
-    da1 = da.copy()
-    da1['ModifiedPeptide'] = da1['modpep'].str[0:-2]
-
-    da1['PrecursorCharge'] = da1['peptide'].str[-1]
-    #da1['LabeledPeptide'] = da1['ModifiedPeptide'] 
-    da1['StrippedPeptide'] = da1['peptide'].str[0:-2].apply(remove_parent1)
+_RT_REGEX = re.compile('(?<=RetentionTime=).[0-9|,|.]*')
+_PROTEIN_REGEX = re.compile(r'Protein=(.*?)\s')
 
-    da1['FragmentNumber'] = byions5['FragmentNumber']
-    da1['FragmentType'] =  byions4['FragmentType']
-    da1['FragmentCharge'] = byions4['FragmentCharge']
+SPTXT_BATCH_COLUMNS = ['FragmentMZ','RelativeIntensity','Fragment','peptide','PrecursorMZ','Protein_name','iRT']
 
-    da2 = da1.drop('Fragment',axis=1)
-    da2 = da2.drop('peptide',axis=1)
-    da2 = da2.drop('modpep',axis=1)
 
-    da2x = da2.copy()
-    da2x = da2x[da2x['Protein_name'].str.contains('^\d\/DECOY')==False]
-    da2x = da2x[da2x['Protein_name'].str.contains('^\d\/rev')==False]
+def _parse_comment(comment):
+    """Return (iRT, Protein_name) from a SpectraST Comment line"""
+    a = _RT_REGEX.findall(comment)
+    if a:
+        rts = sorted(float(x) for x in a[0].split(','))
+        mid = len(rts) // 2
+        irt = rts[mid] if len(rts) % 2 else (rts[mid - 1] + rts[mid]) / 2
+    else:
+        irt = np.nan
+    match = _PROTEIN_REGEX.search(comment)
+    prot = match.group(1) if match else None
+    return irt, prot
+
+
+def _iter_records(lines):
+    record = None
+    for line in lines:
+        if line[:1].isdigit():
+            if record is not None:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) >= 3:
+                    record['peaks'].append((float(fields[0]), float(fields[1]), fields[2].split(',')[0]))
+        elif line.startswith('Name'):
+            if record is not None:
+                yield record
+            record = {'peptide': line.rstrip('\n').replace('Name: ', '', 1),
+                      'PrecursorMZ': np.nan, 'Protein_name': None, 'iRT': np.nan, 'peaks': []}
+        elif record is None:
+            continue
+        elif line.startswith('PrecursorMZ'):
+            record['PrecursorMZ'] = float(line.rstrip('\n').replace('PrecursorMZ: ', '', 1))
+        elif line.startswith('Comment'):
+            record['iRT'], record['Protein_name'] = _parse_comment(line)
+    if record is not None:
+        yield record
+
+
+def iter_sptxt(inp, start=0, end=None):
+    """
+    Stream an SPTXT file and yield one spectrum record at a time
+
+    Header fields and peak lines are parsed in a single pass, so only the
+    current spectrum is held in memory.
+
+    Parameters:
+    -----------
+    inp : str
+        Path to the SPTXT file
+    start, end : int, optional
+        Byte range to parse, as returned by sptxt_chunk_offsets. The range is
+        read in one block; by default the whole file is streamed line by line.
+
+    Yields:
+    -------
+    dict
+        Keys 'peptide', 'PrecursorMZ', 'Protein_name', 'iRT' and 'peaks', where
+        'peaks' is a list of (FragmentMZ, RelativeIntensity, Fragment) tuples and
+        Fragment is the first annotation of the peak
+    """
+    if start == 0 and end is None:
+        with open(inp, 'r') as f:
+            yield from _iter_records(f)
+        return
+    with open(inp, 'rb') as f:
+        f.seek(start)
+        data = f.read(-1 if end is None else end - start)
+    # decoded like the text-mode file of the serial path: same encoding, CRLF read as '\n'
+    yield from _iter_records(io.TextIOWrapper(io.BytesIO(data), newline=None))
+
+
+def sptxt_chunk_offsets(inp, n_chunks):
+    """
+    Split an SPTXT file into byte ranges that start on a 'Name:' line
+
+    Returns:
+    --------
+    list
+        (start, end) byte offsets covering the whole file, in file order
+    """
+    size = os.path.getsize(inp)
+    starts = [0]
+    with open(inp, 'rb') as f:
+        for k in range(1, n_chunks):
+            f.seek(max(size * k // n_chunks, starts[-1]))
+            f.readline()  # skip the (possibly partial) current line
+            pos = f.tell()
+            line = f.readline()
+            while line and not line.startswith(b'Name'):
+                pos = f.tell()
+                line = f.readline()
+            if not line:
+                break
+            if pos > starts[-1]:
+                starts.append(pos)
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def iter_sptxt_batches(inp, batch_size=5000, start=0, end=None):
+    """
+    Stream an SPTXT file as fixed-size batches of spectra in column form
+
+    Parameters:
+    -----------
+    inp : str
+        Path to the SPTXT file
+    batch_size : int
+        Number of spectra per batch
+    start, end : int, optional
+        Byte range to parse, see iter_sptxt
+
+    Yields:
+    -------
+    dict
+        One numpy array per column of SPTXT_BATCH_COLUMNS, with one entry per peak
+    """
+    cols = {c: [] for c in SPTXT_BATCH_COLUMNS}
+    nspec = 0
+    for record in iter_sptxt(inp, start, end):
+        npk = len(record['peaks'])
+        if npk:
+            mz, inten, frag = zip(*record['peaks'])
+            cols['FragmentMZ'].extend(mz)
+            cols['RelativeIntensity'].extend(inten)
+            cols['Fragment'].extend(frag)
+            for c in ['peptide','PrecursorMZ','Protein_name','iRT']:
+                cols[c].extend([record[c]] * npk)
+        nspec += 1
+        if nspec >= batch_size:
+            yield _batch_arrays(cols)
+            cols = {c: [] for c in SPTXT_BATCH_COLUMNS}
+            nspec = 0
+    if nspec:
+        yield _batch_arrays(cols)
+
+
+def _batch_arrays(cols):
+    out = {}
+    for c, values in cols.items():
+        if c in ('FragmentMZ','RelativeIntensity','PrecursorMZ','iRT'):
+            out[c] = np.asarray(values, dtype=float)
+        else:
+            out[c] = np.asarray(values, dtype=object)
+    return out
+
+
+_FRAGMENT_REGEX = re.compile(r'(?P<ion2>[^/^\-]*)(?P<loss>-[^/^]*)?(?:\^(?P<charge>[^/]*))?(?:/(?P<error>.*))?')
+_BRACKET_REGEX = re.compile(r'\[.*?\]')
+
+FRAGMENT_COLUMNS = ['FragmentType','FragmentNumber','FragmentCharge','loss','error','keep']
+
+
+def _to_float(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _decode_fragment(text):
+    text = _BRACKET_REGEX.sub('', text)
+    m = _FRAGMENT_REGEX.fullmatch(text)
+    ion2, loss, charge, error = m.group('ion2', 'loss', 'charge', 'error')
+    ftype = ion2 + loss if loss is not None else ion2
+    keep = (not any(c in text for c in 'i|p+')) and '?' not in ftype and any(c in ftype for c in 'y|b-am')
+    if any(c in ion2 for c in 'I|m?'):
+        fnum = np.nan
+    else:
+        fnum = int(ion2[1:]) if ion2[1:].isdigit() else np.nan
+    if charge is None:
+        fcharge = 1
+    elif charge.isdigit():
+        fcharge = int(charge)
+    else:
+        fcharge, keep = 0, False
+    return ftype, fnum, fcharge, _to_float(loss[1:]) if loss else np.nan, _to_float(error), keep
+
+
+def decode_fragments(fragment):
+    """
+    Decode SpectraST peak annotations into typed fragment columns in one pass
+
+    Each distinct annotation (e.g. 'y7-18^2/0.05') is matched once against a
+    single compiled pattern and the result is broadcast back to every peak.
+
+    Parameters:
+    -----------
+    fragment : pandas.Series
+        First annotation of each peak
+
+    Returns:
+    --------
+    pandas.DataFrame
+        Columns FRAGMENT_COLUMNS, indexed like `fragment`. FragmentType is the ion
+        label without charge and mass error ('y7-18'), FragmentNumber is NA for
+        immonium, internal and unknown ions, and keep marks the peaks that pass
+        the library filters (no isotope, precursor or '+' peaks; b/y/a,
+        neutral-loss or internal ions only).
+    """
+    codes, uniques = pd.factorize(fragment)
+    decoded = [_decode_fragment(text) for text in uniques]
+    if decoded:
+        ftype, fnum, fcharge, loss, error, keep = (np.asarray(v) for v in zip(*decoded))
+    else:
+        ftype, fnum, fcharge, loss, error, keep = ([] for _ in FRAGMENT_COLUMNS)
+    return pd.DataFrame({
+        'FragmentType': np.asarray(ftype, dtype=object).take(codes),
+        'FragmentNumber': pd.array(np.asarray(fnum, dtype=float).take(codes), dtype='Int64'),
+        'FragmentCharge': np.asarray(fcharge, dtype=np.int8).take(codes),
+        'loss': np.asarray(loss, dtype=np.float32).take(codes),
+        'error': np.asarray(error, dtype=np.float32).take(codes),
+        'keep': np.asarray(keep, dtype=bool).take(codes),
+    }, index=fragment.index)
+
+
+def annotate_fragments(da):
+    """Decode peak annotations of a batch frame and apply the library filters"""
+    frag = decode_fragments(da['Fragment'])
+    da1 = da.loc[frag['keep'].to_numpy(), ['FragmentMZ','RelativeIntensity','PrecursorMZ','Protein_name','iRT']].copy()
+    peptide = da.loc[frag['keep'].to_numpy(), 'peptide']
+
+    codes, uniques = pd.factorize(peptide)
+    uniques = pd.Series(uniques, dtype=object)
+    da1['ModifiedPeptide'] = modifications.translate_series(uniques).str[0:-2].to_numpy().take(codes) #更改mod格式
+    da1['PrecursorCharge'] = uniques.str[-1].astype(int).to_numpy().take(codes)
+    #da1['LabeledPeptide'] = da1['ModifiedPeptide'] 
+    da1['StrippedPeptide'] = uniques.str[0:-2].apply(remove_parent1).to_numpy().take(codes)
+    da1[['FragmentNumber','FragmentType','FragmentCharge']] = frag[['FragmentNumber','FragmentType','FragmentCharge']]
+
+    da2x = da1[(da1['Protein_name'].str.contains('^\d\/DECOY')==False) & (da1['Protein_name'].str.contains('^\d\/rev')==False)].copy()
     da2x['shared'] = 'TRUE'
     da2x['decoy']='FALSE'
     da2x.loc[da2x['Protein_name'].str.contains('^1/')==True,'shared'] = 'FALSE'
     da2x['uniprot_id'] = da2x['Protein_name']
     da2x['Tr_recalibrated'] = da2x['iRT']
 
-    da5 = getdata(da2x,1)
+    da3 = da2x[da2x['ModifiedPeptide'].str.contains('\[')==False].copy()
+    da3['IonMobility'] = 0
+    return da3
+
+
+def _convert_range(inp, num1, batch_size, start=0, end=None):
+    """
+    Top `num1` fragments of every precursor in a byte range; index is the peak position in the range
+
+    Also returns the stage records of the conversion, for the process that
+    reports them (the range may be converted in a worker process).
+    """
+    parts = []
+    offset = 0
+    with instrument.capture() as recorder:
+        batches = iter_sptxt_batches(inp, batch_size, start, end)
+        while True:
+            with instrument.stage('sptxt_parse') as s:
+                batch = next(batches, None)
+                s['rows'] = 0 if batch is None else len(batch['FragmentMZ'])
+            if batch is None:
+                break
+            n = len(batch['FragmentMZ'])
+            da0 = pd.DataFrame({'FragmentMZ': batch['FragmentMZ'], 'RelativeIntensity': batch['RelativeIntensity'],
+                                'Fragment': batch['Fragment'], 'peptide': batch['peptide'],
+                                'PrecursorMZ': batch['PrecursorMZ'], 'Protein_name': batch['Protein_name'],
+                                'iRT': batch['iRT']}, index=pd.RangeIndex(offset, offset + n))
+            offset += n
+            if n == 0:
+                continue
+            with instrument.stage('fragment_decode') as s:
+                daout5x = annotate_fragments(da0)
+                s['rows'] = len(daout5x)
+            with instrument.stage('top_n') as s:
+                ids = precursor_index.PrecursorIndex().encode_frame(daout5x, 'ModifiedPeptide')
+                parts.append(top_fragments.select_top_fragments(daout5x, num1, intensity_col='RelativeIntensity',
+                                                                codes=ids))
+                s['rows'] = len(parts[-1])
+    return (pd.concat(parts) if parts else None), offset, recorder.records()
+
+
+def _convert_chunk(args):
+    return _convert_range(*args)
+
 
-    daout5x = da5[da5['FragmentType'].str.contains('[y|b|\-|a|m]')]
-    daout5 = get_final(daout5x,num1)
+#inp = sys.argv[1] 
+def convert_sptxt2tsv(inp, num1=12, batch_size=5000, workers=1):
+    """
+    Convert an SPTXT library into the top-N fragment TSV layout
+
+    The file is streamed in batches of spectra; each batch is decoded, filtered
+    and reduced to its top `num1` fragments per precursor before the next one is
+    read, so memory stays bounded by the batch size and the selected fragments.
+
+    With `workers` > 1 the file is cut at spectrum boundaries into byte ranges
+    that are converted in a process pool. Chunk results are put back in file
+    order before the final selection, so the output is identical to the serial
+    path.
+
+    Parameters:
+    -----------
+    inp : str
+        Path to the SPTXT file
+    num1 : int
+        Number of most intense fragments kept per precursor
+    batch_size : int
+        Number of spectra parsed per batch
+    workers : int
+        Number of worker processes; None uses all CPU cores
+
+    Returns:
+    --------
+    pandas.DataFrame
+        The converted library
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers > 1:
+        # several chunks per worker keep the pool busy when spectra sizes vary
+        n_chunks = max(workers * 4, os.path.getsize(inp) // (64 * 1024 * 1024) + 1)
+        tasks = [(inp, num1, batch_size, start, end) for start, end in sptxt_chunk_offsets(inp, n_chunks)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_convert_chunk, tasks))
+    else:
+        results = [_convert_range(inp, num1, batch_size)]
+
+    parts = []
+    offset = 0
+    for part, npeaks, records in results:
+        instrument.add(records)
+        if part is not None:
+            part.index = part.index + offset
+            parts.append(part)
+        offset += npeaks
+
+    if not parts:
+        return get_final2(pd.DataFrame(columns=['PrecursorMZ','FragmentMZ','RelativeIntensity','iRT','Protein_name',
+                                                'ModifiedPeptide','StrippedPeptide','FragmentType','FragmentNumber',
+                                                'PrecursorCharge','FragmentCharge','uniprot_id','Tr_recalibrated',
+                                                'shared','decoy']))
+
+    da5 = pd.concat(parts).sort_index()
+    with instrument.stage('top_n') as s:
+        daout5 = get_final(da5,num1)
+        s['rows'] = len(daout5)
 
     # outname5 = 'top12_bynam_library.tsv'
     return daout5
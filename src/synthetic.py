@@ -0,0 +1,236 @@
+# synthetic.py - Synthetic SPTXT, FragPipe and SysteMHC libraries and iRT tables of a chosen size, for benchmarks
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import modifications
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+# monoisotopic residue masses
+RESIDUE_MASS = {
+    'A': 71.03711, 'C': 103.00919, 'D': 115.02694, 'E': 129.04259, 'F': 147.06841, 'G': 57.02146,
+    'H': 137.05891, 'I': 113.08406, 'K': 128.09496, 'L': 113.08406, 'M': 131.04049, 'N': 114.04293,
+    'P': 97.05276, 'Q': 128.05858, 'R': 156.10111, 'S': 87.03203, 'T': 101.04768, 'V': 99.06841,
+    'W': 186.07931, 'Y': 163.06333}
+WATER = 18.01056
+PROTON = 1.00728
+# SpectraST tags of the modified residues (see modifications.MOD_TABLE) and their mass shift
+MOD_TAGS = {'M': ('M[147]', 15.99491), 'S': ('S[167]', 79.96633), 'T': ('T[181]', 79.96633),
+            'Y': ('Y[243]', 79.96633), 'N': ('N[115]', 0.98402), 'Q': ('Q[129]', 0.98402)}
+N_TERM_TAG = ('n[43]', 42.01057)
+MOD_RATE = 0.1
+N_TERM_RATE = 0.05
+# MHC ligands: 8 to 12 residues, mostly singly and doubly charged
+PEPTIDE_LENGTHS = (8, 12)
+CHARGE_P = [0.35, 0.5, 0.15]
+PROTEINS = ['1/sp|P{}|PROT{}_HUMAN', '2/sp|P{}|PROT{}_HUMAN/sp|Q{}|OTHER_HUMAN']
+DECOY_RATE = 0.05
+# fragments per precursor: SysteMHC and FragPipe libraries keep the top 12, SPTXT spectra have more peaks
+LIBRARY_FRAGMENTS = (6, 12)
+SPTXT_PEAKS = (5, 35)
+# SpectraST peak annotations by kind, with their share of the peaks
+ANNOTATIONS = [
+    ('{ion}{n}/{err}', 0.52), ('{ion}{n}^2/{err}', 0.1), ('{ion}{n}-18/{err}', 0.08),
+    ('{ion}{n}-18^2/{err},{ion}{n1}/0.10', 0.04), ('{ion}{n}i/{err}', 0.04), ('[{ion}{n}]/{err}', 0.03),
+    ('{ion}{n}+1/{err}', 0.03), ('IY/{err}', 0.03), ('p-18/{err}', 0.03), ('m2:{n1}/{err}', 0.03),
+    ('?', 0.07)]
+# RT of the SysteMHC iRT reference as a smooth, non-linear function of the library iRT
+IRT_COVERAGE = 0.8
+IRT_NOISE = 1.5
+
+FRAGPIPE_COLUMNS = ['PrecursorMz', 'ProductMz', 'Annotation', 'ProteinId', 'GeneName', 'PeptideSequence',
+                    'ModifiedPeptideSequence', 'PrecursorCharge', 'LibraryIntensity', 'NormalizedRetentionTime',
+                    'PrecursorIonMobility', 'FragmentType', 'FragmentCharge', 'FragmentSeriesNumber']
+SYSTEMHC_COLUMNS = ['PrecursorMz', 'ProductMz', 'LibraryIntensity', 'iRT', 'Protein_name', 'ModifiedPeptide',
+                    'StrippedPeptide', 'FragmentType', 'FragmentNumber', 'PrecursorCharge', 'FragmentCharge',
+                    'uniprot_id', 'Tr_recalibrated', 'shared', 'decoy']
+
+
+def precursor_pool(n, seed=0):
+    """
+    `n` random MHC peptide precursors shared by the synthetic libraries
+
+    Returns:
+    --------
+    pandas.DataFrame
+        One row per precursor: the SpectraST peptide (mass tags), the
+        ModifiedPeptide (UniMod notation, as converted by sptxt2tsv), the
+        StrippedPeptide, PrecursorCharge, PrecursorMz, Protein_name and the
+        library iRT (0 to 100)
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(PEPTIDE_LENGTHS[0], PEPTIDE_LENGTHS[1] + 1, n)
+    residues = rng.integers(0, len(AMINO_ACIDS), (n, PEPTIDE_LENGTHS[1]))
+    modified = rng.random((n, PEPTIDE_LENGTHS[1])) < MOD_RATE
+    n_term = rng.random(n) < N_TERM_RATE
+    tagged, stripped, masses = [], [], []
+    for i in range(n):
+        parts = [N_TERM_TAG[0]] if n_term[i] else []
+        mass = WATER + (N_TERM_TAG[1] if n_term[i] else 0)
+        letters = ''
+        for j in range(lengths[i]):
+            aa = AMINO_ACIDS[residues[i, j]]
+            letters += aa
+            mass += RESIDUE_MASS[aa]
+            if modified[i, j] and aa in MOD_TAGS:
+                parts.append(MOD_TAGS[aa][0])
+                mass += MOD_TAGS[aa][1]
+            else:
+                parts.append(aa)
+        tagged.append(''.join(parts))
+        stripped.append(('n' if n_term[i] else '') + letters)
+        masses.append(mass)
+    charge = rng.choice([1, 2, 3], n, p=CHARGE_P)
+    proteins = rng.integers(1, 5000, n)
+    protein = [PROTEINS[p % 2].format(p, p, p) for p in proteins]
+    decoy = rng.random(n) < DECOY_RATE
+    protein = np.where(decoy, [f'1/DECOY_{p}' for p in protein], protein)
+    pool = pd.DataFrame({
+        'spectrast': tagged, 'ModifiedPeptide': [modifications.translate(p) for p in tagged],
+        'StrippedPeptide': stripped, 'PrecursorCharge': charge,
+        'PrecursorMz': np.round((np.asarray(masses) + charge * PROTON) / charge, 4),
+        'Protein_name': protein, 'iRT': np.round(100 * rng.beta(1.5, 1.5, n), 3)})
+    return pool.drop_duplicates(['ModifiedPeptide', 'PrecursorCharge']).reset_index(drop=True)
+
+
+def _pick(pool, rows, per_precursor, rng):
+    """Random precursors of the pool and their fragment counts, adding up to about `rows` fragments"""
+    counts = rng.integers(per_precursor[0], per_precursor[1] + 1, len(pool))
+    order = rng.permutation(len(pool))
+    n = int(np.searchsorted(np.cumsum(counts[order]), rows, side='right'))
+    if n == len(pool) and counts.sum() < rows:
+        raise ValueError(f"precursor pool of {len(pool)} too small for {rows} fragment rows")
+    return np.sort(order[:n]), counts[order[:n]][np.argsort(order[:n])]
+
+
+def _fragments(pool, picked, counts, rng):
+    """One row per fragment of the picked precursors: precursor row, ion type, series number, charge, m/z, intensity"""
+    prec = np.repeat(picked, counts)
+    total = len(prec)
+    length = pool['StrippedPeptide'].str.len().to_numpy()[prec]
+    charge = pool['PrecursorCharge'].to_numpy()[prec]
+    return pd.DataFrame({
+        'precursor': prec,
+        'ion': rng.choice(['b', 'y'], total, p=[0.3, 0.7]),
+        'number': 1 + (rng.random(total) * (length - 2)).astype(int),
+        'charge': np.where((charge > 1) & (rng.random(total) < 0.2), 2, 1),
+        'mz': np.round(rng.uniform(150, 1500, total), 4),
+        'intensity': np.round(rng.lognormal(7.5, 1.0, total), 1)})
+
+
+def write_sptxt(path, pool, rows, seed=0):
+    """SPTXT library of the pool with about `rows` peaks, in the SpectraST layout; returns the peaks written"""
+    rng = np.random.default_rng(seed)
+    picked, counts = _pick(pool, rows, SPTXT_PEAKS, rng)
+    frag = _fragments(pool, picked, counts, rng)
+    templates, p = zip(*ANNOTATIONS)
+    kind = rng.choice(len(templates), len(frag), p=np.asarray(p) / sum(p))
+    errors = np.char.mod('%.2f', rng.normal(0, 0.02, len(frag)))
+    annotation = [templates[k].format(ion=ion, n=n, n1=n + 1, err=e)
+                  for k, ion, n, e in zip(kind, frag['ion'], frag['number'], errors)]
+    lines = pd.Series(np.char.mod('%.4f', frag['mz'].to_numpy())) + '\t' + \
+        pd.Series(np.char.mod('%.1f', frag['intensity'].to_numpy())) + '\t' + annotation + '\t3/3 0.1|0.2\n'
+    lines = lines.to_numpy()
+    ends = np.cumsum(counts)
+    peptide, charge, mz, protein, irt = (pool[c].to_numpy()[picked] for c in
+                                         ['spectrast', 'PrecursorCharge', 'PrecursorMz', 'Protein_name', 'iRT'])
+    # replicate RTs in seconds, the converter keeps their median (and reads positive RTs only)
+    rts = np.clip(irt[:, None] * 60 + rng.normal(0, 20, (len(picked), 3)), 0.01, None)
+    with open(path, 'w') as f:
+        f.write('### SpectraST\n### header\n')
+        for i in range(len(picked)):
+            f.write(f"Name: {peptide[i]}/{charge[i]}\nLibID: {i}\nMW: {mz[i] * charge[i]:.4f}\n"
+                    f"PrecursorMZ: {mz[i]:.4f}\nStatus: Normal\nFullName: X.{peptide[i]}.X/{charge[i]} (HCD)\n"
+                    f"Comment: AvePrecursorMz={mz[i]:.4f} BinaryFileOffset={i} Protein={protein[i]} "
+                    f"RetentionTime={rts[i, 0]:.2f},{rts[i, 1]:.2f},{rts[i, 2]:.2f} Spec=Consensus\n"
+                    f"NumPeaks: {counts[i]}\n")
+            f.write(''.join(lines[ends[i] - counts[i]:ends[i]]))
+            f.write('\n')
+    return len(frag)
+
+
+def _annotation(frag):
+    """FragPipe fragment annotation, e.g. 'y7' or 'b3^2'"""
+    return frag['ion'] + frag['number'].astype(str) + np.where(frag['charge'] > 1, '^' + frag['charge'].astype(str), '')
+
+
+def write_fragpipe_library(path, pool, rows, seed=0):
+    """FragPipe (EasyPQP) library TSV of the pool with about `rows` fragments; returns the rows written"""
+    rng = np.random.default_rng(seed)
+    picked, counts = _pick(pool, rows, LIBRARY_FRAGMENTS, rng)
+    frag = _fragments(pool, picked, counts, rng)
+    prec = pool.iloc[frag['precursor'].to_numpy()].reset_index(drop=True)
+    # the sample run measures the library iRT with some scatter
+    scatter = rng.normal(0, 0.5, len(pool))[frag['precursor'].to_numpy()]
+    pd.DataFrame({
+        'PrecursorMz': prec['PrecursorMz'], 'ProductMz': frag['mz'], 'Annotation': _annotation(frag),
+        'ProteinId': prec['Protein_name'], 'GeneName': '', 'PeptideSequence': prec['StrippedPeptide'],
+        'ModifiedPeptideSequence': prec['ModifiedPeptide'], 'PrecursorCharge': prec['PrecursorCharge'],
+        'LibraryIntensity': frag['intensity'], 'NormalizedRetentionTime': np.round(prec['iRT'] + scatter, 4),
+        'PrecursorIonMobility': '', 'FragmentType': frag['ion'], 'FragmentCharge': frag['charge'],
+        'FragmentSeriesNumber': frag['number']}, columns=FRAGPIPE_COLUMNS).to_csv(path, sep='\t', index=False)
+    return len(frag)
+
+
+def write_systemhc_library(path, pool, rows, seed=0):
+    """SysteMHC allele library TSV (top-12 layout of the SysteMHC Atlas) of the pool with about `rows` fragments"""
+    rng = np.random.default_rng(seed)
+    picked, counts = _pick(pool, rows, LIBRARY_FRAGMENTS, rng)
+    frag = _fragments(pool, picked, counts, rng)
+    prec = pool.iloc[frag['precursor'].to_numpy()].reset_index(drop=True)
+    irt = np.round(prec['iRT'] * 60, 2)
+    shared = np.where(prec['Protein_name'].str.startswith('1/'), 'FALSE', 'TRUE')
+    pd.DataFrame({
+        'PrecursorMz': prec['PrecursorMz'], 'ProductMz': frag['mz'], 'LibraryIntensity': frag['intensity'],
+        'iRT': irt, 'Protein_name': prec['Protein_name'], 'ModifiedPeptide': prec['ModifiedPeptide'],
+        'StrippedPeptide': prec['StrippedPeptide'], 'FragmentType': frag['ion'] + frag['number'].astype(str),
+        'FragmentNumber': frag['number'], 'PrecursorCharge': prec['PrecursorCharge'],
+        'FragmentCharge': frag['charge'], 'uniprot_id': prec['Protein_name'], 'Tr_recalibrated': irt,
+        'shared': shared, 'decoy': 'FALSE'}, columns=SYSTEMHC_COLUMNS).to_csv(path, sep='\t', index=False)
+    return len(frag)
+
+
+def reference_rt(irt):
+    """RT of the SysteMHC iRT reference for library iRTs: monotone but not linear, so the LOWESS fit has work to do"""
+    irt = np.asarray(irt, dtype=float)
+    return 5 + 1.1 * irt + 6 * np.sin(irt / 15)
+
+
+def write_irt_table(path, pool, seed=0):
+    """SysteMHC iRT reference (irt_SYSTEMHC.csv layout) for IRT_COVERAGE of the pool; returns its rows"""
+    rng = np.random.default_rng(seed)
+    rows = pool.iloc[np.sort(rng.permutation(len(pool))[:int(len(pool) * IRT_COVERAGE)])]
+    pd.DataFrame({'ModifiedPeptide': rows['ModifiedPeptide'], 'PrecursorCharge': rows['PrecursorCharge'],
+                  'RT': reference_rt(rows['iRT']) + rng.normal(0, IRT_NOISE, len(rows))}).to_csv(path, index=False)
+    return len(rows)
+
+
+def generate(out_dir, rows, alleles=3, seed=0):
+    """
+    Write a synthetic data set of about `rows` fragment rows per library to `out_dir`
+
+    The sample SPTXT, the FragPipe sample library and the `alleles`
+    SysteMHC libraries each draw their precursors at random from one pool,
+    about four times the precursors of a library, so they overlap as sample
+    and SysteMHC libraries do; the iRT reference covers IRT_COVERAGE of
+    the pool.
+
+    Returns:
+    --------
+    dict
+        Paths of the files ('sptxt', 'fragpipe', 'systemhc' list, 'irt') and
+        the rows of each ('rows')
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    pool = precursor_pool(max(100, 4 * rows // int(np.mean(LIBRARY_FRAGMENTS))), seed)
+    paths = {'sptxt': os.path.join(out_dir, 'sample.sptxt'), 'fragpipe': os.path.join(out_dir, 'sample_fragpipe.tsv'),
+             'systemhc': [os.path.join(out_dir, f'allele_{i + 1}.tsv') for i in range(alleles)],
+             'irt': os.path.join(out_dir, 'irt_SYSTEMHC.csv')}
+    paths['rows'] = {
+        'sptxt': write_sptxt(paths['sptxt'], pool, rows, seed + 1),
+        'fragpipe': write_fragpipe_library(paths['fragpipe'], pool, rows, seed + 2),
+        'systemhc': [write_systemhc_library(p, pool, rows, seed + 3 + i) for i, p in enumerate(paths['systemhc'])],
+        'irt': write_irt_table(paths['irt'], pool, seed)}
+    return paths
@@ -0,0 +1,137 @@
+# top_fragments.py - Top-N fragment selection for spectral libraries
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# Precursor key columns of the library layouts handled by DIA-Aspire
+FRAGPIPE_PRECURSOR_COLS = ['ModifiedPeptideSequence', 'PrecursorCharge']
+SYSTEMHC_PRECURSOR_COLS = ['ModifiedPeptide', 'PrecursorCharge']
+
+
+def precursor_codes(da, precursor_cols):
+    """
+    Map every row to a dense integer code of its precursor
+
+    Codes follow the sorted order of the key columns, so grouping on them
+    visits precursors in the same order as DataFrame.groupby(sort=True).
+    Rows with a missing key get -1.
+    """
+    if isinstance(precursor_cols, str):
+        precursor_cols = [precursor_cols]
+    if len(precursor_cols) == 1:
+        codes, _ = pd.factorize(da[precursor_cols[0]], sort=True)
+        return codes
+    return da.groupby(list(precursor_cols), sort=True).ngroup().to_numpy()
+
+
+def _group_rank(sorted_codes):
+    """Rank of each element inside its run of equal codes (input already sorted by code)"""
+    n = len(sorted_codes)
+    idx = np.arange(n)
+    start = np.ones(n, dtype=bool)
+    start[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    return idx - np.maximum.accumulate(np.where(start, idx, 0))
+
+
+def select_top_fragments(da, n=12, precursor_cols=SYSTEMHC_PRECURSOR_COLS, intensity_col='LibraryIntensity',
+                         fragment_type_col='FragmentType', quotas=None, codes=None):
+    """
+    Keep the `n` most intense fragments of every precursor
+
+    The library is sorted once on (precursor code, intensity) instead of being
+    split into one DataFrame per precursor. Ties keep their input order, so
+    the result matches concatenating group.head(n) over a groupby of an
+    intensity-sorted frame.
+
+    Parameters:
+    -----------
+    da : pandas.DataFrame
+        Fragment-level library (one row per fragment)
+    n : int
+        Maximum number of fragments kept per precursor
+    precursor_cols : list or str
+        Columns identifying a precursor
+    intensity_col : str
+        Column ranked in descending order
+    fragment_type_col : str
+        Column holding the ion label; only used when `quotas` is given
+    quotas : dict, optional
+        Maximum fragments per ion type and precursor, keyed by the first letter
+        of the ion label (e.g. {'y': 8, 'b': 4}). Ion types not listed are only
+        limited by `n`.
+    codes : numpy.ndarray, optional
+        Precomputed integer precursor codes; skips factorizing `precursor_cols`
+
+    Returns:
+    --------
+    pandas.DataFrame
+        Selected rows, ordered by precursor code and decreasing intensity
+    """
+    if codes is None:
+        codes = precursor_codes(da, precursor_cols)
+    codes = np.asarray(codes)
+    intensity = da[intensity_col].to_numpy(dtype=float)
+
+    valid = np.flatnonzero(codes >= 0)
+    order = valid[np.lexsort((-intensity[valid], codes[valid]))]
+
+    if quotas:
+        ion_type = da[fragment_type_col].astype(str).str[:1].to_numpy()[order]
+        type_codes, type_uniques = pd.factorize(ion_type)
+        limit = np.array([quotas.get(t, n) for t in type_uniques], dtype=np.int64)
+        # stable sort keeps the intensity order inside each (precursor, ion type)
+        sub = np.lexsort((type_codes, codes[order]))
+        type_rank = np.empty(len(order), dtype=np.int64)
+        type_rank[sub] = _group_rank(codes[order][sub] * len(type_uniques) + type_codes[sub])
+        order = order[type_rank < limit[type_codes]]
+
+    rank = _group_rank(codes[order])
+    return da.iloc[order[rank < n]]
+
+
+def select_top_fragments_file(input_path, output_path, n=12, quotas=None):
+    """
+    Standalone top-N stage for FragPipe or SysteMHC TSV libraries
+
+    Parameters:
+    -----------
+    input_path : str
+        Path to the library TSV file
+    output_path : str
+        Path where the selected library will be written
+    n : int
+        Number of most intense fragments kept per precursor
+    quotas : dict, optional
+        Per ion-type limits, see select_top_fragments
+
+    Returns:
+    --------
+    str
+        Path to the selected library file
+    """
+    da = pd.read_csv(input_path, sep='\t')
+    if set(FRAGPIPE_PRECURSOR_COLS).issubset(da.columns):
+        precursor_cols = FRAGPIPE_PRECURSOR_COLS
+    else:
+        precursor_cols = SYSTEMHC_PRECURSOR_COLS
+    dax = select_top_fragments(da, n, precursor_cols=precursor_cols, quotas=quotas)
+    dax.to_csv(output_path, sep='\t', index=False)
+    print(f"Selected top {n} fragments for {dax.shape[0]} rows: {output_path}")
+    return output_path
+
+
+# Allow script to be run directly or imported as a module
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python top_fragments.py <library.tsv> <output.tsv> [n] [ion_type=quota ...]")
+        sys.exit(1)
+
+    n = int(sys.argv[3]) if len(sys.argv) > 3 else 12
+    quotas = {}
+    for arg in sys.argv[4:]:
+        ion_type, quota = arg.split('=')
+        quotas[ion_type] = int(quota)
+
+    select_top_fragments_file(sys.argv[1], sys.argv[2], n, quotas or None)